@@ -28,7 +28,19 @@ CREATE TABLE IF NOT EXISTS band_song (
     title VARCHAR(100) NOT NULL,
     duration INTEGER NOT NULL,
     release_date DATE NOT NULL,
-    lyrics TEXT NOT NULL
+    lyrics TEXT NOT NULL,
+    updated_at DATETIME NOT NULL
+);
+CREATE INDEX IF NOT EXISTS song_release_idx ON band_song (release_date, id);
+CREATE INDEX IF NOT EXISTS song_updated_idx ON band_song (updated_at);
+"""
+
+# Full-text index over songs; the sync triggers are in band/search.py
+band_song_fts_table = """
+CREATE VIRTUAL TABLE IF NOT EXISTS band_song_fts USING fts5(
+    title, lyrics,
+    content='band_song', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
 );
 """
 
@@ -37,9 +49,15 @@ CREATE TABLE IF NOT EXISTS band_photo (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     title VARCHAR(100) NOT NULL,
     image_path VARCHAR(255) NOT NULL,
+    thumbnail_path VARCHAR(255) NOT NULL DEFAULT '',
+    medium_path VARCHAR(255) NOT NULL DEFAULT '',
+    full_path VARCHAR(255) NOT NULL DEFAULT '',
     event_date DATE NOT NULL,
-    description TEXT NOT NULL
+    description TEXT NOT NULL,
+    updated_at DATETIME NOT NULL
 );
+CREATE INDEX IF NOT EXISTS photo_event_idx ON band_photo (event_date, id);
+CREATE INDEX IF NOT EXISTS photo_updated_idx ON band_photo (updated_at);
 """
 
 
@@ -53,8 +71,11 @@ band_concert (
     location VARCHAR(255) NOT NULL,
     date DATETIME NOT NULL,
     price DECIMAL(10,2) NOT NULL,
-    available_tickets INTEGER NOT NULL
+    available_tickets INTEGER NOT NULL,
+    ticket_shards INTEGER NOT NULL DEFAULT 0,
+    updated_at DATETIME NOT NULL
 );
+CREATE INDEX IF NOT EXISTS concert_date_idx ON band_concert (date);
 
 #CREATE TABLE IF NOT EXISTS 
 band_userconcert (
@@ -65,8 +86,68 @@ band_userconcert (
     payment_status VARCHAR(20) NOT NULL DEFAULT 'pending',
     payment_id VARCHAR(255),
     FOREIGN KEY (user_id) REFERENCES auth_user (id),
+    FOREIGN KEY (concert_id) REFERENCES band_concert (id),
+    UNIQUE (user_id, concert_id)
+);
+CREATE INDEX IF NOT EXISTS userconcert_pending_idx ON band_userconcert (concert_id)
+    WHERE payment_status = 'pending';
+
+band_tickethold_table = """
+CREATE TABLE IF NOT EXISTS band_tickethold (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    concert_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 1,
+    status VARCHAR(10) NOT NULL DEFAULT 'held',
+    created_at DATETIME NOT NULL,
+    expires_at DATETIME NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES auth_user (id),
+    FOREIGN KEY (concert_id) REFERENCES band_concert (id)
+);
+CREATE INDEX IF NOT EXISTS tickethold_user_idx ON band_tickethold (user_id, concert_id, status);
+CREATE INDEX IF NOT EXISTS tickethold_expiry_idx ON band_tickethold (status, expires_at);
+"""
+
+band_job_table = """
+CREATE TABLE IF NOT EXISTS band_job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR(100) NOT NULL,
+    payload TEXT NOT NULL,
+    idempotency_key VARCHAR(255) UNIQUE,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at DATETIME NOT NULL,
+    locked_by VARCHAR(100) NOT NULL DEFAULT '',
+    locked_at DATETIME,
+    last_error TEXT NOT NULL DEFAULT '',
+    created_at DATETIME NOT NULL,
+    finished_at DATETIME
+);
+CREATE INDEX IF NOT EXISTS job_ready_idx ON band_job (status, run_at);
+"""
+
+band_ticketshard_table = """
+CREATE TABLE IF NOT EXISTS band_ticketshard (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    concert_id INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    available INTEGER NOT NULL,
+    UNIQUE (concert_id, slot),
+    FOREIGN KEY (concert_id) REFERENCES band_concert (id)
+);
+"""
+
+# Per-concert counts kept by the triggers in band/stats.py
+band_concertstats_table = """
+CREATE TABLE IF NOT EXISTS band_concertstats (
+    concert_id INTEGER PRIMARY KEY,
+    attendees INTEGER NOT NULL DEFAULT 0,
+    paid INTEGER NOT NULL DEFAULT 0,
+    pending_payments INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (concert_id) REFERENCES band_concert (id)
 );
+"""
 Python Implementation
 settings.py
 python
@@ -89,6 +170,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'band.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -100,11 +182,18 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'band_website.urls'
 
+# Compiled templates are kept in memory; set BAND_TEMPLATE_CACHE=0 while
+# editing templates so changes show up without a restart
+TEMPLATE_CACHE = os.environ.get('BAND_TEMPLATE_CACHE', '1') == '1'
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'band/templates')],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -112,16 +201,69 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            'loaders': [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+            if TEMPLATE_CACHE else TEMPLATE_LOADERS,
         },
     },
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # {% cache %} fragments; row keys include updated_at, so entries never go stale
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    # Stand-in for band.sessions.shared; a shared store (redis, memcached) in production
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# band.sessions.cached_db keeps sessions in the database and serves repeat
+# reads from a per-process LRU. band.sessions.shared keeps them only in
+# SESSION_CACHE_ALIAS. django.contrib.sessions.backends.signed_cookies stores
+# nothing server-side, but a logout can't revoke a copied cookie. Both band
+# engines skip the write when a session's data hasn't changed; bench_sessions
+# compares all of them
+SESSION_ENGINE = 'band.sessions.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_LOCAL_TTL = 10  # seconds another process may still serve a session changed elsewhere
+SESSION_LOCAL_MAX_ENTRIES = 10000
+
 WSGI_APPLICATION = 'band_website.wsgi.application'
+ASGI_APPLICATION = 'band_website.asgi.application'
+# Set by band_website/asgi.py; switches band/urls.py to band.async_views
+BAND_ASYNC_VIEWS = os.environ.get('BAND_ASYNC_VIEWS') == '1'
+ASYNC_DB_THREADS = 16
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # band.db.sqlite3 / band.db.postgresql add a connection pool to the stock
+        # backends. With a stock ENGINE, set CONN_MAX_AGE = 60 instead.
+        'ENGINE': 'band.db.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Returned to the pool at the end of every request
+        'CONN_MAX_AGE': 0,
+        'CONN_HEALTH_CHECKS': True,
+        'POOL': {
+            'MAX_SIZE': 20,
+            'IDLE_TIMEOUT': 300,  # close connections idle this long
+            'TIMEOUT': 10,  # wait this long for a free connection
+            'CHECK_AFTER': 30,  # SELECT 1 before reusing a connection idle this long
+        },
+        'OPTIONS': {
+            # Prepared statements kept per connection; the view SQL strings are
+            # fixed, so pooled connections reuse them. On PostgreSQL (psycopg 3)
+            # use 'prepare_threshold': 1 for the same effect.
+            'cached_statements': 256,
+        },
     }
 }
 
@@ -140,6 +282,26 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# band.hashing.PBKDF2PasswordHasher is Django's with its cost set here; existing
+# hashes move to the current cost at their next login. Put
+# band.hashing.Argon2PasswordHasher first (needs argon2-cffi) to switch; the
+# others stay listed so older hashes still verify
+PASSWORD_HASHERS = [
+    'band.hashing.PBKDF2PasswordHasher',
+    'band.hashing.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+PASSWORD_PBKDF2_ITERATIONS = 1000000  # Django 5.2's default, around half a second of CPU per hash
+PASSWORD_ARGON2 = {'time_cost': 2, 'memory_cost': 102400, 'parallelism': 8}  # KiB for memory_cost
+
+# Password checks run on a small pool (band.hashing) so a login rush can't take
+# every core from the rest of the site; past the queue limit logins get a 503
+AUTHENTICATION_BACKENDS = ['band.hashing.ModelBackend']
+PASSWORD_HASHING_WORKERS = 2  # cores hashing at once
+PASSWORD_HASHING_MAX_WAITING = 64
+
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
 USE_I18N = True
@@ -148,6 +310,20 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'band/static')]
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# manage.py collectstatic is the asset build: hashed names, minified band/
+# CSS and JS, and .gz/.br siblings (band.assets). Brotli needs `pip install brotli`.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+        else 'band.assets.CompressedManifestStorage',
+    },
+}
+STATIC_MAX_AGE = 31536000  # one year, for hashed file names
+
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
@@ -156,6 +332,103 @@ LOGOUT_REDIRECT_URL = 'home'
 GOOGLE_PAY_MERCHANT_ID = 'your_merchant_id'
 GOOGLE_PAY_MERCHANT_NAME = 'Band Name'
 GOOGLE_PAY_ENVIRONMENT = 'TEST'  # or 'PRODUCTION'
+
+# Applied to every new SQLite connection (band.signals.apply_sqlite_pragmas)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,  # 256 MB
+    'cache_size': -65536,  # negative = KiB, so 64 MB
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+# Listing cache: band.caching.LRUBackend (per process) or
+# band.caching.SharedBackend with OPTIONS {'alias': '<CACHES alias>'}. The LRU
+# keeps namespace versions in OPTIONS 'versions', re-read every 'version_ttl'
+# seconds; with a CACHES alias all processes share, a change made in one
+# process reaches every other that soon rather than after TTL
+QUERY_CACHE = {
+    'BACKEND': 'band.caching.LRUBackend',
+    'OPTIONS': {'max_entries': 512, 'versions': 'default', 'version_ttl': 1.0},
+    'TTL': 300,
+}
+
+# Photo derivatives: widths in pixels, encoder quality, resize threads
+PHOTO_DERIVATIVE_WIDTHS = {'thumbnail': 320, 'medium': 800, 'full': 1600}
+PHOTO_DERIVATIVE_QUALITY = 80
+PHOTO_DERIVATIVE_WORKERS = 2
+
+# Background jobs (manage.py run_workers)
+JOB_WORKERS = 2
+JOB_POLL_INTERVAL = 1.0  # seconds a worker sleeps when the queue is empty
+JOB_BATCH_SIZE = 10
+JOB_RETRY_BASE = 5  # seconds; doubles on every failed attempt
+JOB_RETRY_MAX = 600
+JOB_LOCK_TIMEOUT = 300  # running jobs older than this are assumed orphaned
+
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+DEFAULT_FROM_EMAIL = 'tickets@example.com'
+
+SEARCH_PAGE_SIZE = 20
+
+# Attendance buttons (band.attendance)
+ATTENDANCE_COALESCE_MS = 0  # e.g. 250: set/unset bursts for one concert become one write
+ATTENDANCE_IDEMPOTENCY_CACHE = 'default'  # CACHES alias; must be shared between processes
+ATTENDANCE_IDEMPOTENCY_TTL = 86400  # seconds an Idempotency-Key is remembered
+ATTENDANCE_BATCH_MAX = 100  # changes accepted per POST /api/attendance/
+
+# Live ticket counts on /concerts/events/ (ASGI only). band.events.LocalBroker
+# reaches this process; band.events.CacheBroker with OPTIONS
+# {'alias': '<shared CACHES alias>', 'poll_interval': 0.5} reaches them all
+EVENT_BROKER = {
+    'BACKEND': 'band.events.LocalBroker',
+    'OPTIONS': {},
+}
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_MAX_SUBSCRIBERS = 10000  # open streams per process; more get a 503
+
+# Waiting room in front of the payment page (band.waiting_room)
+WAITING_ROOM_ENABLED = True
+WAITING_ROOM_CACHE = 'default'  # CACHES alias all processes share (redis, memcached)
+WAITING_ROOM_SINGLE_PROCESS = DEBUG  # lets WAITING_ROOM_CACHE be per process (locmem), as under runserver
+WAITING_ROOM_ADMIT_RATE = 20  # buyers per second per concert, unless Concert.admit_rate is set
+WAITING_ROOM_REFRESH_SECONDS = 1.0  # how often remaining tickets are re-read
+WAITING_ROOM_TOKEN_MAX_AGE = 3600  # seconds a place in line is kept
+WAITING_ROOM_ADMITTED_SECONDS = 120  # a buyer let through counts against stock this long without a hold
+
+# Sliding-window rate limits (band.ratelimit); the rules per URL name are in
+# band/urls.py and RATE_LIMITS here replaces them by name, e.g. {'login': ['ip:5/m']}.
+# band.ratelimit.LocalStore counts per process; band.ratelimit.SharedStore with
+# OPTIONS {'alias': '<shared CACHES alias>'} counts across all of them
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_STORE = {
+    'BACKEND': 'band.ratelimit.LocalStore',
+    'OPTIONS': {'max_keys': 100000},
+}
+RATE_LIMITS = {}
+RATE_LIMIT_CLIENT_IP_HEADER = None  # e.g. 'X-Real-IP' when behind a proxy that sets it
+
+# Request metrics (band.metrics), scraped from /metrics/ by Prometheus
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # staff users can always read them
+SLOW_QUERY_MS = 100  # logged and counted per view
+PROFILE_SAMPLE_RATE = 0.0  # fraction of requests run under cProfile, e.g. 0.01
+PROFILE_THRESHOLD_MS = 500  # sampled requests slower than this are dumped
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')  # open with python -m pstats
+
+# Songs and photos are paged newest first; ?stream=1 streams the whole list
+CATALOG_PAGE_SIZE = 50
+CATALOG_STREAM_CHUNK_SIZE = 500
+
+# Part of every catalog ETag (band.conditional); change it on deploy so
+# browsers refetch pages whose templates changed
+BAND_RELEASE = os.environ.get('BAND_RELEASE', '')
+
+# Ticket reservations
+TICKET_HOLD_SECONDS = 600  # how long a buyer keeps a ticket while paying
+TICKET_GROUP_COMMIT_MS = 5  # how long the writer waits to batch holds
+TICKET_GROUP_COMMIT_MAX = 200  # max holds written in one transaction
+TICKET_REAP_INTERVAL = 30  # seconds between expired-hold sweeps, a job that run_workers starts
 models.py
 python
 # band/models.py
@@ -167,6 +440,15 @@ class Song(models.Model):
     duration = models.IntegerField(help_text="Duration in seconds")
     release_date = models.DateField()
     lyrics = models.TextField()
+    # Part of the song_row.html fragment cache key
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['release_date', 'id'], name='song_release_idx'),
+            # MAX(updated_at) for the ETag in band.conditional
+            models.Index(fields=['updated_at'], name='song_updated_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -176,6 +458,18 @@ class Photo(models.Model):
     image = models.ImageField(upload_to='photos/')
     event_date = models.DateField()
     description = models.TextField()
+    # Resized copies written by band.images; each also has a .webp sibling
+    thumbnail_path = models.CharField(max_length=255, blank=True, default='')
+    medium_path = models.CharField(max_length=255, blank=True, default='')
+    full_path = models.CharField(max_length=255, blank=True, default='')
+    # Part of the photo_row.html fragment cache key
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event_date', 'id'], name='photo_event_idx'),
+            models.Index(fields=['updated_at'], name='photo_updated_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -186,6 +480,14 @@ class Concert(models.Model):
     date = models.DateTimeField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     available_tickets = models.IntegerField()
+    ticket_shards = models.IntegerField(default=0, help_text="0 keeps tickets in available_tickets")
+    admit_rate = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Buyers let through the waiting room per second; blank uses WAITING_ROOM_ADMIT_RATE")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['date'], name='concert_date_idx')]
 
     def __str__(self):
         return f"{self.name} at {self.location}"
@@ -199,63 +501,847 @@ class UserConcert(models.Model):
 
     class Meta:
         unique_together = ('user', 'concert')
+        indexes = [
+            # Raw SQL spells payment_status = 'pending' literally, so SQLite can use it
+            models.Index(fields=['concert'], condition=models.Q(payment_status='pending'),
+                         name='userconcert_pending_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.concert.name}"
+
+class ConcertStats(models.Model):
+    # Created by a band_concert trigger and kept up by the band_userconcert
+    # triggers in band/stats.py; reconcile_concert_stats recounts them
+    concert = models.OneToOneField(Concert, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    attendees = models.IntegerField(default=0)
+    paid = models.IntegerField(default=0)
+    pending_payments = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'concert stats'
+
+    @property
+    def revenue(self):
+        return self.concert.price * self.paid
+
+    def __str__(self):
+        return f"{self.concert.name}: {self.attendees} attending, {self.paid} paid"
+
+class TicketHold(models.Model):
+    HELD = 'held'
+    CONFIRMED = 'confirmed'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (HELD, 'Held'),
+        (CONFIRMED, 'Confirmed'),
+        (EXPIRED, 'Expired'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    concert = models.ForeignKey(Concert, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=1)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=HELD)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'concert', 'status'], name='tickethold_user_idx'),
+            models.Index(fields=['status', 'expires_at'], name='tickethold_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.concert.name} ({self.status})"
+
+class TicketShard(models.Model):
+    concert = models.ForeignKey(Concert, on_delete=models.CASCADE)
+    slot = models.IntegerField()
+    available = models.IntegerField()
+
+    class Meta:
+        unique_together = ('concert', 'slot')
+
+    def __str__(self):
+        return f"{self.concert.name} #{self.slot}"
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.TextField()
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_at = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'], name='job_ready_idx')]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+class ImportProgress(models.Model):
+    # Where an interrupted bulk import stopped; band/bulk.py saves it in the
+    # same transaction as each batch, so the two can't disagree after a crash
+    path = models.CharField(max_length=500, unique=True)
+    offset = models.BigIntegerField(default=0)
+    rows = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'import progress'
+
+    def __str__(self):
+        return f"{self.path}: {self.rows} rows"
+0001_initial.py
+python
+# band/migrations/0001_initial.py
+# Generated by Django 5.2.18 on 2026-10-18 17:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Concert',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('location', models.CharField(max_length=255)),
+                ('date', models.DateTimeField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('available_tickets', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Photo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('image', models.ImageField(upload_to='photos/')),
+                ('event_date', models.DateField()),
+                ('description', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Song',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('duration', models.IntegerField(help_text='Duration in seconds')),
+                ('release_date', models.DateField()),
+                ('lyrics', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserConcert',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attending', models.BooleanField(default=True)),
+                ('payment_status', models.CharField(default='pending', max_length=20)),
+                ('payment_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('concert', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='band.concert')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'concert')},
+            },
+        ),
+    ]
+0002_tickethold.py
+python
+# band/migrations/0002_tickethold.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketHold',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=1)),
+                ('status', models.CharField(choices=[('held', 'Held'), ('confirmed', 'Confirmed'), ('expired', 'Expired')], default='held', max_length=10)),
+                ('created_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField()),
+                ('concert', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='band.concert')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
+0003_ticket_shards.py
+python
+# band/migrations/0003_ticket_shards.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0002_tickethold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='concert',
+            name='ticket_shards',
+            field=models.IntegerField(default=0, help_text='0 keeps tickets in available_tickets'),
+        ),
+        migrations.CreateModel(
+            name='TicketShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.IntegerField()),
+                ('available', models.IntegerField()),
+                ('concert', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='band.concert')),
+            ],
+            options={
+                'unique_together': {('concert', 'slot')},
+            },
+        ),
+    ]
+0004_keyset_indexes.py
+python
+# band/migrations/0004_keyset_indexes.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0003_ticket_shards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['event_date', 'id'], name='photo_event_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['release_date', 'id'], name='song_release_idx'),
+        ),
+    ]
+0005_index_pack.py
+python
+# band/migrations/0005_index_pack.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0004_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='concert',
+            index=models.Index(fields=['date'], name='concert_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tickethold',
+            index=models.Index(fields=['user', 'concert', 'status'], name='tickethold_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tickethold',
+            index=models.Index(fields=['status', 'expires_at'], name='tickethold_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userconcert',
+            index=models.Index(condition=models.Q(('payment_status', 'pending')), fields=['concert'], name='userconcert_pending_idx'),
+        ),
+    ]
+0006_photo_derivatives.py
+python
+# band/migrations/0006_photo_derivatives.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0005_index_pack'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='full_path',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='medium_path',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='thumbnail_path',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
+0007_job.py
+python
+# band/migrations/0007_job.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0006_photo_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('payload', models.TextField()),
+                ('idempotency_key', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=5)),
+                ('run_at', models.DateTimeField()),
+                ('locked_by', models.CharField(blank=True, default='', max_length=100)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_at'], name='job_ready_idx')],
+            },
+        ),
+    ]
+0008_catalog_updated_at.py
+python
+# band/migrations/0008_catalog_updated_at.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+from band.db.operations import RunSQLFor
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0007_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        # Song search (band.search), after the AddField that rebuilds band_song
+        # on SQLite; other databases search with LIKE
+        RunSQLFor(
+            'sqlite',
+            [
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS band_song_fts USING fts5(
+                    title, lyrics,
+                    content='band_song', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS band_song_fts_ai AFTER INSERT ON band_song BEGIN
+                    INSERT INTO band_song_fts (rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics);
+                END
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS band_song_fts_ad AFTER DELETE ON band_song BEGIN
+                    INSERT INTO band_song_fts (band_song_fts, rowid, title, lyrics)
+                    VALUES ('delete', old.id, old.title, old.lyrics);
+                END
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS band_song_fts_au AFTER UPDATE ON band_song BEGIN
+                    INSERT INTO band_song_fts (band_song_fts, rowid, title, lyrics)
+                    VALUES ('delete', old.id, old.title, old.lyrics);
+                    INSERT INTO band_song_fts (rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics);
+                END
+                """,
+                "INSERT INTO band_song_fts (band_song_fts) VALUES ('rebuild')",
+            ],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS band_song_fts_au",
+                "DROP TRIGGER IF EXISTS band_song_fts_ad",
+                "DROP TRIGGER IF EXISTS band_song_fts_ai",
+                "DROP TABLE IF EXISTS band_song_fts",
+            ],
+        ),
+    ]
+0009_conditional_indexes.py
+python
+# band/migrations/0009_conditional_indexes.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0008_catalog_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='concert',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['updated_at'], name='photo_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['updated_at'], name='song_updated_idx'),
+        ),
+    ]
+0010_concert_admit_rate.py
+python
+# band/migrations/0010_concert_admit_rate.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0009_conditional_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='concert',
+            name='admit_rate',
+            field=models.PositiveIntegerField(blank=True, help_text='Buyers let through the waiting room per second; blank uses WAITING_ROOM_ADMIT_RATE', null=True),
+        ),
+    ]
+0011_concertstats.py
+python
+# band/migrations/0011_concertstats.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+from band.db.operations import RunSQLFor
+
+# Frozen copies of band.stats: each write to band_userconcert moves its
+# concert's counts, in the same transaction
+ADD = """
+    INSERT INTO band_concertstats (concert_id, attendees, paid, pending_payments)
+    VALUES (
+        new.concert_id,
+        CASE WHEN new.attending THEN 1 ELSE 0 END,
+        CASE WHEN new.payment_status = 'completed' THEN 1 ELSE 0 END,
+        CASE WHEN new.payment_status = 'pending' THEN 1 ELSE 0 END
+    )
+    ON CONFLICT (concert_id) DO UPDATE SET
+        attendees = band_concertstats.attendees + excluded.attendees,
+        paid = band_concertstats.paid + excluded.paid,
+        pending_payments = band_concertstats.pending_payments + excluded.pending_payments;
+"""
+SUBTRACT = """
+    UPDATE band_concertstats SET
+        attendees = attendees - CASE WHEN old.attending THEN 1 ELSE 0 END,
+        paid = paid - CASE WHEN old.payment_status = 'completed' THEN 1 ELSE 0 END,
+        pending_payments = pending_payments - CASE WHEN old.payment_status = 'pending' THEN 1 ELSE 0 END
+    WHERE concert_id = old.concert_id;
+"""
+CREATE = """
+    INSERT INTO band_concertstats (concert_id, attendees, paid, pending_payments)
+    VALUES (new.id, 0, 0, 0)
+    ON CONFLICT (concert_id) DO NOTHING;
+"""
+TRACKED = 'concert_id, attending, payment_status'
+POPULATE = """
+    INSERT INTO band_concertstats (concert_id, attendees, paid, pending_payments)
+    SELECT c.id,
+        COALESCE(SUM(CASE WHEN uc.attending THEN 1 ELSE 0 END), 0),
+        COALESCE(SUM(CASE WHEN uc.payment_status = 'completed' THEN 1 ELSE 0 END), 0),
+        COALESCE(SUM(CASE WHEN uc.payment_status = 'pending' THEN 1 ELSE 0 END), 0)
+    FROM band_concert c
+    LEFT JOIN band_userconcert uc ON uc.concert_id = c.id
+    GROUP BY c.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0010_concert_admit_rate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConcertStats',
+            fields=[
+                ('concert', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='band.concert')),
+                ('attendees', models.IntegerField(default=0)),
+                ('paid', models.IntegerField(default=0)),
+                ('pending_payments', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'concert stats',
+            },
+        ),
+        # Triggers before the initial count, so no write falls between them
+        RunSQLFor(
+            'sqlite',
+            [
+                f"CREATE TRIGGER band_concertstats_create AFTER INSERT ON band_concert BEGIN {CREATE} END",
+                f"CREATE TRIGGER band_concertstats_ai AFTER INSERT ON band_userconcert BEGIN {ADD} END",
+                f"CREATE TRIGGER band_concertstats_ad AFTER DELETE ON band_userconcert BEGIN {SUBTRACT} END",
+                f"""CREATE TRIGGER band_concertstats_au AFTER UPDATE OF {TRACKED} ON band_userconcert
+                    BEGIN {SUBTRACT} {ADD} END""",
+                POPULATE,
+            ],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS band_concertstats_au",
+                "DROP TRIGGER IF EXISTS band_concertstats_ad",
+                "DROP TRIGGER IF EXISTS band_concertstats_ai",
+                "DROP TRIGGER IF EXISTS band_concertstats_create",
+            ],
+        ),
+        RunSQLFor(
+            'postgresql',
+            [
+                f"""
+                CREATE FUNCTION band_concertstats_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN {SUBTRACT} END IF;
+                    IF TG_OP <> 'DELETE' THEN {ADD} END IF;
+                    RETURN NULL;
+                END $$
+                """,
+                f"""
+                CREATE TRIGGER band_concertstats_sync
+                AFTER INSERT OR DELETE OR UPDATE OF {TRACKED} ON band_userconcert
+                FOR EACH ROW EXECUTE FUNCTION band_concertstats_sync()
+                """,
+                f"""
+                CREATE FUNCTION band_concertstats_create() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    {CREATE}
+                    RETURN NULL;
+                END $$
+                """,
+                """
+                CREATE TRIGGER band_concertstats_create
+                AFTER INSERT ON band_concert
+                FOR EACH ROW EXECUTE FUNCTION band_concertstats_create()
+                """,
+                # Other writers wait for the count rather than slip past it
+                'LOCK TABLE band_userconcert IN SHARE MODE',
+                POPULATE,
+            ],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS band_concertstats_create ON band_concert",
+                "DROP FUNCTION IF EXISTS band_concertstats_create()",
+                "DROP TRIGGER IF EXISTS band_concertstats_sync ON band_userconcert",
+                "DROP FUNCTION IF EXISTS band_concertstats_sync()",
+            ],
+        ),
+    ]
+0012_importprogress.py
+python
+# band/migrations/0012_importprogress.py
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('band', '0011_concertstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('rows', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'import progress',
+            },
+        ),
+    ]
+apps.py
+python
+# band/apps.py
+from django.apps import AppConfig
+
+
+class BandConfig(AppConfig):
+    name = 'band'
+
+    def ready(self):
+        from . import signals, tasks, waiting_room  # noqa: F401
+signals.py
+python
+# band/signals.py
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_init, post_save
+from . import events, metrics
+from .caching import query_cache
+from .jobs import enqueue
+from .models import Song, Photo, Concert
+
+CACHED_LISTINGS = {
+    Song: ('songs',),
+    Photo: ('photos',),
+    Concert: ('concerts',),
+}
+
+
+def invalidate_listings(sender, **kwargs):
+    query_cache.invalidate(*CACHED_LISTINGS[sender])
+
+
+for model in CACHED_LISTINGS:
+    post_save.connect(invalidate_listings, sender=model, dispatch_uid=f'cache-save-{model.__name__}')
+    post_delete.connect(invalidate_listings, sender=model, dispatch_uid=f'cache-delete-{model.__name__}')
+
+
+def remember_photo_image(sender, instance, **kwargs):
+    instance._saved_image = instance.image.name
+
+
+def queue_photo_derivatives(sender, instance, created, **kwargs):
+    if instance.image and (created or instance.image.name != instance._saved_image
+                           or not instance.thumbnail_path):
+        enqueue('build_photo_derivatives', key=f'photo-derivatives:{instance.pk}:{instance.image.name}',
+                photo_id=instance.pk)
+    instance._saved_image = instance.image.name
+
+
+def publish_availability(sender, instance, **kwargs):
+    # Admin edits to available_tickets; holds and purchases publish from band.reservations
+    events.availability_changed(instance.pk)
+
+
+post_save.connect(publish_availability, sender=Concert, dispatch_uid='concert-availability')
+
+
+post_init.connect(remember_photo_image, sender=Photo, dispatch_uid='photo-remember-image')
+post_save.connect(queue_photo_derivatives, sender=Photo, dispatch_uid='photo-derivatives')
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    # Pooled connections keep their pragmas
+    if connection.vendor != 'sqlite' or getattr(connection, 'reused_connection', False):
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(apply_sqlite_pragmas, dispatch_uid='sqlite-pragmas')
+
+
+def install_query_metrics(sender, connection, **kwargs):
+    # Fires on every pool checkout, but the wrapper list outlives the connection
+    if metrics.record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.record_query)
+
+
+connection_created.connect(install_query_metrics, dispatch_uid='query-metrics')
+
 views.py
 python
 # band/views.py
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.db import connection
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+from django.views.decorators.http import require_http_methods, require_POST
+from django.db import IntegrityError, connection
+from django.conf import settings
 from .models import Song, Photo, Concert, UserConcert
+from .caching import query_cache
+from .conditional import concerts_state, conditional, photos_state, songs_state
+from .db.pool import pool_stats
+from .fastjson import FastJsonResponse
+from .pagination import PAGE_SIZE, decode_cursor, fetch_page, iterate_rows
+from . import attendance, hashing, images, jobs, metrics, reservations, search, stats, ticket_shards, waiting_room
 import json
-import uuid
 from datetime import datetime
 
 def home(request):
     return render(request, 'band/home.html')
 
+STREAM_MARKER = '<!--stream-rows-->'
+
+def _stream_page(request, template, context, row_template, rows):
+    # Render the page shell once, then send the rows through as they are read
+    head, tail = render_to_string(template, dict(context, stream=True), request).split(STREAM_MARKER)
+    row_template = get_template(row_template)
+    
+    def chunks():
+        yield head
+        for name, row in rows:
+            yield row_template.render({name: row})
+        yield tail
+    
+    return StreamingHttpResponse(chunks())
+
+SONG_COLUMNS = ['title', 'duration', 'release_date', 'id', 'updated_at']
+
+def _song(row):
+    minutes, seconds = divmod(row[1], 60)
+    return {
+        'title': row[0],
+        'duration': f"{minutes}:{seconds:02d}",
+        'release_date': row[2],
+        'id': row[3],
+        'version': row[4]
+    }
+
+def _song_page(after, limit=PAGE_SIZE):
+    rows, next_cursor = fetch_page('band_song', SONG_COLUMNS, 'release_date', after, limit)
+    return [_song(row[2:]) for row in rows], next_cursor
+
+@conditional(songs_state)
 def songs(request):
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT title, duration, release_date FROM band_song")
-        songs = cursor.fetchall()
-    
-    song_list = []
-    for song in songs:
-        minutes, seconds = divmod(song[1], 60)
-        song_list.append({
-            'title': song[0],
-            'duration': f"{minutes}:{seconds:02d}",
-            'release_date': song[2]
-        })
+    if request.GET.get('stream'):
+        rows = iterate_rows('band_song', SONG_COLUMNS, 'release_date')
+        return _stream_page(request, 'band/songs.html', {}, 'band/song_row.html',
+                            (('song', _song(row)) for row in rows))
     
-    return render(request, 'band/songs.html', {'songs': song_list})
+    after = decode_cursor(request.GET.get('after'))
+    song_list, next_cursor = query_cache.get_or_set('songs', lambda: _song_page(after), after)
+    return render(request, 'band/songs.html', {'songs': song_list, 'next_cursor': next_cursor})
+
+@conditional(songs_state)
+def api_songs(request):
+    after = decode_cursor(request.GET.get('after'))
+    song_list, next_cursor = query_cache.get_or_set('songs', lambda: _song_page(after), after)
+    return JsonResponse({'results': song_list, 'next': next_cursor})
+
+PHOTO_COLUMNS = ['title', 'image', 'event_date', 'description', 'thumbnail_path', 'medium_path', 'full_path',
+                 'id', 'updated_at']
 
+def _photo(row):
+    derivatives = {'thumbnail': row[4], 'medium': row[5], 'full': row[6]}
+    return {
+        'title': row[0],
+        'image_path': settings.MEDIA_URL + row[1],
+        'event_date': row[2],
+        'description': row[3],
+        'src': settings.MEDIA_URL + row[4] if row[4] else settings.MEDIA_URL + row[1],
+        'srcset': images.srcset(derivatives),
+        'srcset_webp': images.srcset(derivatives, webp=True),
+        'id': row[7],
+        'version': row[8]
+    }
+
+def _photo_page(after, limit=PAGE_SIZE):
+    rows, next_cursor = fetch_page('band_photo', PHOTO_COLUMNS, 'event_date', after, limit)
+    return [_photo(row[2:]) for row in rows], next_cursor
+
+@conditional(photos_state)
 def photos(request):
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT title, image_path, event_date, description FROM band_photo")
-        photos = cursor.fetchall()
+    if request.GET.get('stream'):
+        rows = iterate_rows('band_photo', PHOTO_COLUMNS, 'event_date')
+        return _stream_page(request, 'band/photos.html', {}, 'band/photo_row.html',
+                            (('photo', _photo(row)) for row in rows))
     
-    photo_list = [{
-        'title': photo[0],
-        'image_path': photo[1],
-        'event_date': photo[2],
-        'description': photo[3]
-    } for photo in photos]
-    
-    return render(request, 'band/photos.html', {'photos': photo_list})
+    after = decode_cursor(request.GET.get('after'))
+    photo_list, next_cursor = query_cache.get_or_set('photos', lambda: _photo_page(after), after)
+    return render(request, 'band/photos.html', {'photos': photo_list, 'next_cursor': next_cursor})
 
-def concerts(request):
+@conditional(photos_state)
+def api_photos(request):
+    after = decode_cursor(request.GET.get('after'))
+    photo_list, next_cursor = query_cache.get_or_set('photos', lambda: _photo_page(after), after)
+    return JsonResponse({'results': photo_list, 'next': next_cursor})
+
+def _concert_catalog():
     with connection.cursor() as cursor:
         cursor.execute("""
-            SELECT c.id, c.name, c.location, c.date, c.price, c.available_tickets,
-                   CASE WHEN uc.user_id IS NOT NULL THEN 1 ELSE 0 END as is_attending
+            SELECT c.id, c.name, c.location, c.date, c.price,
+                   COALESCE(s.available, c.available_tickets) as available_tickets
             FROM band_concert c
-            LEFT JOIN band_userconcert uc ON c.id = uc.concert_id AND uc.user_id = %s
-        """, [request.user.id if request.user.is_authenticated else None])
+            LEFT JOIN (
+                SELECT concert_id, SUM(available) as available
+                FROM band_ticketshard
+                GROUP BY concert_id
+            ) s ON c.id = s.concert_id
+            ORDER BY c.date
+        """)
         concerts = cursor.fetchall()
     
     concert_list = []
@@ -266,58 +1352,173 @@ def concerts(request):
             'location': concert[2],
             'date': concert[3],
             'price': concert[4],
-            'available_tickets': concert[5],
-            'is_attending': bool(concert[6])
+            'available_tickets': concert[5]
         })
-    
-    return render(request, 'band/concerts.html', {'concerts': concert_list})
+    return concert_list
 
-@login_required
-def toggle_attendance(request, concert_id):
-    if request.method == 'POST':
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT id FROM band_userconcert 
-                WHERE user_id = %s AND concert_id = %s
-            """, [request.user.id, concert_id])
-            existing = cursor.fetchone()
-            
-            if existing:
-                cursor.execute("""
-                    DELETE FROM band_userconcert 
-                    WHERE id = %s
-                """, [existing[0]])
-                attending = False
-            else:
-                cursor.execute("""
-                    INSERT INTO band_userconcert 
-                    (user_id, concert_id, attending, payment_status)
-                    VALUES (%s, %s, %s, %s)
-                """, [request.user.id, concert_id, True, 'pending'])
-                attending = True
-            
-            return JsonResponse({'success': True, 'attending': attending})
+def _attendance(user_id):
+    # Served by the (user_id, concert_id) unique index
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT concert_id, attending, payment_status
+            FROM band_userconcert
+            WHERE user_id = %s
+        """, [user_id])
+        return {row[0]: (bool(row[1]), row[2]) for row in cursor.fetchall()}
+
+def _with_attendance(catalog, attendance):
+    concert_list = []
+    for concert in catalog:
+        attending, payment_status = attendance.get(concert['id'], (False, None))
+        concert_list.append(dict(concert, is_attending=attending, payment_status=payment_status))
+    return concert_list
+
+@conditional(concerts_state)
+def concerts(request):
+    # The catalog is shared by every visitor; only the attendance overlay is per user
+    catalog = query_cache.get_or_set('concerts', _concert_catalog)
+    attending = _attendance(request.user.id) if request.user.is_authenticated else {}
+    return render(request, 'band/concerts.html', {'concerts': _with_attendance(catalog, attending)})
+
+CONCERT_FIELDS = ('id', 'name', 'location', 'date', 'price', 'available_tickets', 'is_attending', 'payment_status')
+
+def _concert_fields(request):
+    # ?fields=id,available_tickets keeps the polling payload small
+    fields = request.GET.get('fields')
+    if not fields:
+        return CONCERT_FIELDS
+    fields = tuple(dict.fromkeys(fields.split(',')))
+    unknown = [field for field in fields if field not in CONCERT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}; choose from {', '.join(CONCERT_FIELDS)}")
+    return fields
+
+def _concert_payload(concert_list, fields):
+    return {'concerts': [{field: concert[field] for field in fields} for concert in concert_list]}
+
+@conditional(concerts_state)
+def api_concerts(request):
+    try:
+        fields = _concert_fields(request)
+    except ValueError as exc:
+        return FastJsonResponse({'error': str(exc)}, status=400)
+    catalog = query_cache.get_or_set('concerts', _concert_catalog)
+    attending = _attendance(request.user.id) if request.user.is_authenticated else {}
+    return FastJsonResponse(_concert_payload(_with_attendance(catalog, attending), fields))
+
+def _search(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+    results, has_next = search.search_songs(query, page) if query else ([], False)
+    return query, page, results, has_next
+
+@conditional(songs_state)
+def song_search(request):
+    query, page, results, has_next = _search(request)
+    return render(request, 'band/search.html', {
+        'query': query, 'page': page, 'results': results, 'has_next': has_next
+    })
+
+@conditional(songs_state)
+def api_search(request):
+    query, page, results, has_next = _search(request)
+    return JsonResponse({'results': results, 'page': page, 'has_next': has_next})
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(query_cache.stats())
+
+@staff_member_required
+def db_pool_stats(request):
+    return JsonResponse(pool_stats())
+
+@staff_member_required
+def concert_report(request):
+    # ?upcoming=1 leaves out past concerts
+    concerts = stats.report(upcoming=request.GET.get('upcoming') == '1')
+    totals = {name: sum(concert[name] for concert in concerts)
+              for name in ('attendees', 'paid', 'pending_payments', 'revenue')}
+    return FastJsonResponse({'concerts': concerts, 'totals': totals})
+
+def metrics_export(request):
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    if request.META.get('REMOTE_ADDR') not in allowed and not request.user.is_staff:
+        return HttpResponseForbidden()
+    
+    # The listing cache and connection pool keep their own counters
+    extra = ['# TYPE band_query_cache_total counter']
+    for namespace, counts in query_cache.stats().items():
+        for result in ('hits', 'misses'):
+            extra.append(f'band_query_cache_total{{namespace="{namespace}",result="{result}"}} {counts[result]}')
+    extra.append('# TYPE band_db_pool gauge')
+    for alias, pool in pool_stats().items():
+        for name, value in pool.items():
+            extra.append(f'band_db_pool{{alias="{alias}",stat="{name}"}} {value}')
+    return HttpResponse(metrics.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def _paid_attendance():
+    return JsonResponse({'success': False, 'attending': True,
+                         'error': 'This ticket is paid for; contact us to cancel it'}, status=409)
+
+@login_required
+@attendance.idempotent
+def toggle_attendance(request, concert_id):
+    if request.method == 'POST':
+        try:
+            attending = attendance.toggle(request.user.id, concert_id)
+        except IntegrityError:
+            raise Http404('No such concert')
+        except attendance.Paid:
+            return _paid_attendance()
+        return JsonResponse({'success': True, 'attending': attending})
     
     return JsonResponse({'success': False}, status=400)
 
+@login_required
+@require_http_methods(['PUT', 'DELETE'])
+@attendance.idempotent
+def set_attendance(request, concert_id):
+    # PUT attends, DELETE cancels; repeating either one changes nothing
+    try:
+        attending = attendance.apply(request.user.id, concert_id, request.method == 'PUT')
+    except IntegrityError:
+        raise Http404('No such concert')
+    except attendance.Paid:
+        return _paid_attendance()
+    return JsonResponse({'success': True, 'attending': attending})
+
+@login_required
+@require_POST
+@attendance.idempotent
+def api_attendance(request):
+    # Several attendance changes in one request, e.g. everything clicked on /concerts/
+    try:
+        states = attendance.parse_changes(request.body)
+    except ValueError as exc:
+        return FastJsonResponse({'success': False, 'error': str(exc)}, status=400)
+    return FastJsonResponse({'success': True, 'attendance': attendance.set_many(request.user.id, states)})
+
+def _hashing_busy(request, template):
+    # Every hashing worker is taken and the queue is full: better a quick retry than a timeout
+    response = render(request, template, {'error': 'Too many people are signing in right now; try again in a moment'},
+                      status=503)
+    response.headers['Retry-After'] = '5'
+    return response
+
 def user_login(request):
     if request.method == 'POST':
         username = request.POST.get('username')
         password = request.POST.get('password')
         
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT id, password FROM auth_user 
-                WHERE username = %s
-            """, [username])
-            user_data = cursor.fetchone()
-            
-            if user_data:
-                user_id, db_password = user_data
-                user = authenticate(request, username=username, password=password)
-                if user is not None:
-                    login(request, user)
-                    return redirect('home')
+        user = authenticate(request, username=username, password=password)
+        if user is None and getattr(request, 'hashing_busy', False):
+            return _hashing_busy(request, 'band/login.html')
+        if user is not None:
+            login(request, user)
+            return redirect('home')
         
         return render(request, 'band/login.html', {'error': 'Invalid credentials'})
     
@@ -332,6 +1533,10 @@ def register(request):
         username = request.POST.get('username')
         password = request.POST.get('password')
         email = request.POST.get('email')
+        try:
+            password = hashing.make_password(password)
+        except hashing.Busy:
+            return _hashing_busy(request, 'band/register.html')
         
         with connection.cursor() as cursor:
             cursor.execute("""
@@ -340,7 +1545,7 @@ def register(request):
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             """, [
                 username,
-                make_password(password),
+                password,
                 email,
                 False,
                 False,
@@ -354,32 +1559,47 @@ def register(request):
     
     return render(request, 'band/register.html')
 
+def queue_status(request, concert_id):
+    # Polled from the waiting room page, so it stays clear of the session and the database
+    token = request.COOKIES.get(waiting_room.cookie_name(concert_id))
+    ticket = waiting_room.read_token(token, concert_id)
+    if ticket is None:
+        return FastJsonResponse({'state': 'not_queued'}, status=404)
+    place, admitted_token = waiting_room.admit(ticket)
+    response = FastJsonResponse(place)
+    response.headers['Cache-Control'] = 'no-store'
+    if admitted_token:
+        waiting_room.set_token(request, response, concert_id, admitted_token)
+    return response
+
 @login_required
+@waiting_room.gate
 def payment(request, concert_id):
     concert = get_object_or_404(Concert, pk=concert_id)
     
     if request.method == 'POST':
         # Process Google Pay payment
         payment_token = request.POST.get('payment_token')
-        payment_id = str(uuid.uuid4())
         
-        # In a real app, you would verify the payment with Google Pay API here
-        # For demo purposes, we'll just simulate a successful payment
+        hold = reservations.active_hold(request.user.id, concert_id)
+        if hold is None:
+            try:
+                hold = reservations.hold_tickets(request.user.id, concert_id)
+            except reservations.SoldOut:
+                return render(request, 'band/sold_out.html', {'concert': concert}, status=409)
+            waiting_room.held(request, concert_id)
         
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE band_userconcert
-                SET payment_status = 'completed', payment_id = %s
-                WHERE user_id = %s AND concert_id = %s
-            """, [payment_id, request.user.id, concert_id])
-            
-            cursor.execute("""
-                UPDATE band_concert
-                SET available_tickets = available_tickets - 1
-                WHERE id = %s
-            """, [concert_id])
+        # Verification and confirmation run on a job worker; the hold keeps the seat meanwhile
+        jobs.enqueue('confirm_payment', key=f'payment:{hold.pk}', user_id=request.user.id,
+                     concert_id=concert_id, hold_id=hold.pk, payment_token=payment_token)
         
-        return render(request, 'band/payment_success.html', {'concert': concert})
+        return render(request, 'band/payment_success.html', {'concert': concert, 'hold': hold})
+    
+    # Viewing the page takes nothing (prefetchers and reloads would hold seats);
+    # the ticket is held when the buyer pays, above
+    hold = reservations.active_hold(request.user.id, concert_id)
+    if hold is None and ticket_shards.available(concert_id) <= 0:
+        return render(request, 'band/sold_out.html', {'concert': concert}, status=409)
     
     # Generate Google Pay payment request
     payment_request = {
@@ -415,434 +1635,6262 @@ def payment(request, concert_id):
     
     return render(request, 'band/payment.html', {
         'concert': concert,
+        'hold': hold,
         'payment_request': json.dumps(payment_request),
         'google_pay_environment': settings.GOOGLE_PAY_ENVIRONMENT
     })
-urls.py (app)
+reservations.py
 python
-# band/urls.py
-from django.urls import path
-from . import views
+# band/reservations.py
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
 
-urlpatterns = [
-    path('', views.home, name='home'),
-    path('songs/', views.songs, name='songs'),
-    path('photos/', views.photos, name='photos'),
-    path('concerts/', views.concerts, name='concerts'),
-    path('concert/<int:concert_id>/toggle/', views.toggle_attendance, name='toggle_attendance'),
-    path('concert/<int:concert_id>/payment/', views.payment, name='payment'),
-    path('login/', views.user_login, name='login'),
-    path('logout/', views.user_logout, name='logout'),
-    path('register/', views.register, name='register'),
-]
-urls.py (project)
-python
-# band_website/urls.py
-from django.contrib import admin
-from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from django.db import connection, transaction
+from django.utils import timezone
+from .caching import query_cache
+from .models import TicketHold
+from . import events, ticket_shards
 
-urlpatterns = [
-    path('admin/', admin.site.urls),
-    path('', include('band.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-HTML Templates
-base.html
-html
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{% block title %}Band Website{% endblock %}</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            margin: 0;
-            padding: 0;
-            line-height: 1.6;
-        }
-        header {
-            background: #333;
-            color: #fff;
-            padding: 1rem 0;
-            text-align: center;
-        }
-        nav {
-            background: #444;
-            padding: 0.5rem;
-        }
-        nav a {
-            color: #fff;
-            text-decoration: none;
-            padding: 0.5rem 1rem;
-        }
-        nav a:hover {
-            background: #555;
-        }
-        .container {
-            width: 80%;
-            margin: auto;
-            padding: 2rem 0;
-        }
-        .auth-links {
-            float: right;
-        }
-        .messages {
-            padding: 1rem;
-            margin: 1rem 0;
-            background: #f4f4f4;
-        }
-        .error {
-            color: red;
-        }
-        .success {
-            color: green;
-        }
-    </style>
-</head>
-<body>
-    <header>
-        <h1>Our Awesome Band</h1>
-    </header>
-    <nav>
-        <a href="{% url 'home' %}">Home</a>
-        <a href="{% url 'songs' %}">Songs</a>
-        <a href="{% url 'photos' %}">Photos</a>
-        <a href="{% url 'concerts' %}">Concerts</a>
-        <div class="auth-links">
-            {% if user.is_authenticated %}
-                <span>Hello, {{ user.username }}!</span>
-                <a href="{% url 'logout' %}">Logout</a>
-            {% else %}
-                <a href="{% url 'login' %}">Login</a>
-                <a href="{% url 'register' %}">Register</a>
-            {% endif %}
-        </div>
-    </nav>
-    <div class="container">
-        {% if messages %}
-        <div class="messages">
-            {% for message in messages %}
-                <div class="{{ message.tags }}">{{ message }}</div>
-            {% endfor %}
-        </div>
-        {% endif %}
-        
-        {% block content %}
-        {% endblock %}
-    </div>
-</body>
-</html>
-home.html
-html
-Run
-{% extends 'band/base.html' %}
+HOLD_SECONDS = getattr(settings, 'TICKET_HOLD_SECONDS', 600)
+GROUP_COMMIT_WAIT = getattr(settings, 'TICKET_GROUP_COMMIT_MS', 5) / 1000.0
+GROUP_COMMIT_MAX = getattr(settings, 'TICKET_GROUP_COMMIT_MAX', 200)
+REAP_INTERVAL = getattr(settings, 'TICKET_REAP_INTERVAL', 30)
 
-{% block title %}Home - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Welcome to Our Band Website!</h2>
-    <p>We are an awesome band that plays great music. Check out our songs, photos, and upcoming concerts!</p>
-    
-    <h3>Latest News</h3>
-    <p>Our new album is coming out soon! Stay tuned for updates.</p>
-{% endblock %}
-songs.html
-html
-Run
-{% extends 'band/base.html' %}
+class SoldOut(Exception):
+    pass
 
-{% block title %}Songs - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Our Songs</h2>
-    
-    <table>
-        <thead>
-            <tr>
-                <th>Title</th>
-                <th>Duration</th>
-                <th>Release Date</th>
-            </tr>
-        </thead>
-        <tbody>
-            {% for song in songs %}
-            <tr>
-                <td>{{ song.title }}</td>
-                <td>{{ song.duration }}</td>
-                <td>{{ song.release_date }}</td>
-            </tr>
-            {% endfor %}
-        </tbody>
-    </table>
-{% endblock %}
-photos.html
-html
-Run
-{% extends 'band/base.html' %}
+class HoldExpired(Exception):
+    pass
 
-{% block title %}Photos - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Photo Gallery</h2>
-    
-    <div class="photo-grid">
-        {% for photo in photos %}
-        <div class="photo-item">
-            <img src="{{ photo.image_path }}" alt="{{ photo.title }}" width="300">
-            <h3>{{ photo.title }}</h3>
-            <p>{{ photo.event_date }}</p>
-            <p>{{ photo.description }}</p>
-        </div>
-        {% endfor %}
-    </div>
-{% endblock %}
-concerts.html
-html
-Run
-{% extends 'band/base.html' %}
+def _take_tickets(cursor, concert_id, quantity):
+    # Conditional decrement: the counter never goes below zero
+    if not ticket_shards.take(cursor, concert_id, quantity):
+        raise SoldOut(concert_id)
 
-{% block title %}Concerts - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Upcoming Concerts</h2>
-    
-    <div class="concert-list">
-        {% for concert in concerts %}
-        <div class="concert-item">
-            <h3>{{ concert.name }}</h3>
-            <p>Location: {{ concert.location }}</p>
-            <p>Date: {{ concert.date }}</p>
-            <p>Price: ${{ concert.price }}</p>
-            <p>Tickets available: {{ concert.available_tickets }}</p>
-            
-            {% if user.is_authenticated %}
-                <button class="toggle-attendance" 
-                        data-concert-id="{{ concert.id }}"
-                        data-attending="{{ concert.is_attending|yesno:'true,false' }}">
-                    {% if concert.is_attending %}
-                        Cancel Attendance
-                    {% else %}
-                        Attend Concert
-                    {% endif %}
-                </button>
-                
-                {% if concert.is_attending and concert.payment_status == 'pending' %}
-                    <a href="{% url 'payment' concert.id %}" class="payment-button">Complete Payment</a>
-                {% endif %}
-            {% else %}
-                <p><a href="{% url 'login' %}">Login</a> to attend this concert</p>
-            {% endif %}
-        </div>
-        {% endfor %}
-    </div>
-    
-    <script>
-        document.querySelectorAll('.toggle-attendance').forEach(button => {
-            button.addEventListener('click', async function() {
-                const concertId = this.dataset.concertId;
-                const isAttending = this.dataset.attending === 'true';
-                
-                try {
-                    const response = await fetch(`/concert/${concertId}/toggle/`, {
-                        method: 'POST',
-                        headers: {
-                            'X-CSRFToken': '{{ csrf_token }}',
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({})
-                    });
-                    
-                    const data = await response.json();
-                    
-                    if (data.success) {
-                        if (data.attending) {
-                            this.textContent = 'Cancel Attendance';
-                            this.dataset.attending = 'true';
-                            // Add payment button if needed
-                            if (!this.nextElementSibling || !this.nextElementSibling.classList.contains('payment-button')) {
-                                const paymentButton = document.createElement('a');
-                                paymentButton.href = `/concert/${concertId}/payment/`;
-                                paymentButton.className = 'payment-button';
-                                paymentButton.textContent = 'Complete Payment';
-                                this.insertAdjacentElement('afterend', paymentButton);
-                            }
-                        } else {
-                            this.textContent = 'Attend Concert';
-                            this.dataset.attending = 'false';
-                            // Remove payment button if exists
-                            if (this.nextElementSibling && this.nextElementSibling.classList.contains('payment-button')) {
-                                this.nextElementSibling.remove();
-                            }
-                        }
-                        // Reload the page to update all concert items
-                        location.reload();
-                    }
-                } catch (error) {
-                    console.error('Error:', error);
-                }
-            });
-        });
-    </script>
-{% endblock %}
-login.html
-html
-Run
-{% extends 'band/base.html' %}
+def _return_tickets(cursor, concert_id, quantity):
+    ticket_shards.give(cursor, concert_id, quantity)
 
-{% block title %}Login - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Login</h2>
-    
-    {% if error %}
-        <p class="error">{{ error }}</p>
-    {% endif %}
-    
-    <form method="post">
-        {% csrf_token %}
-        <div>
-            <label for="username">Username:</label>
-            <input type="text" id="username" name="username" required>
-        </div>
-        <div>
-            <label for="password">Password:</label>
-            <input type="password" id="password" name="password" required>
-        </div>
-        <button type="submit">Login</button>
-    </form>
-    
-    <p>Don't have an account? <a href="{% url 'register' %}">Register here</a></p>
-{% endblock %}
-register.html
-html
-Run
-{% extends 'band/base.html' %}
+def _hold(user_id, concert_id, quantity):
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        _take_tickets(cursor, concert_id, quantity)
+    return TicketHold.objects.create(
+        user_id=user_id,
+        concert_id=concert_id,
+        quantity=quantity,
+        created_at=now,
+        expires_at=now + timedelta(seconds=HOLD_SECONDS),
+    )
 
-{% block title %}Register - Our Awesome Band{% endblock %}
 
-{% block content %}
-    <h2>Register</h2>
-    
-    <form method="post">
-        {% csrf_token %}
-        <div>
-            <label for="username">Username:</label>
-            <input type="text" id="username" name="username" required>
-        </div>
-        <div>
-            <label for="email">Email:</label>
-            <input type="email" id="email" name="email" required>
-        </div>
-        <div>
-            <label for="password">Password:</label>
-            <input type="password" id="password" name="password" required>
+def _confirm(hold_id, user_id, concert_id, payment_id):
+    confirmed = TicketHold.objects.filter(
+        pk=hold_id, user_id=user_id, status=TicketHold.HELD,
+        expires_at__gt=timezone.now(),
+    ).update(status=TicketHold.CONFIRMED)
+    if not confirmed:
+        raise HoldExpired(hold_id)
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE band_userconcert
+            SET payment_status = 'completed', payment_id = %s
+            WHERE user_id = %s AND concert_id = %s
+        """, [payment_id, user_id, concert_id])
+        if cursor.rowcount == 0:
+            cursor.execute("""
+                INSERT INTO band_userconcert
+                (user_id, concert_id, attending, payment_status, payment_id)
+                VALUES (%s, %s, %s, %s, %s)
+            """, [user_id, concert_id, True, 'completed', payment_id])
+
+
+def _purchase(user_id, concert_id, payment_id, quantity):
+    hold = _active_hold(user_id, concert_id)
+    if hold is None:
+        hold = _hold(user_id, concert_id, quantity)
+    _confirm(hold.pk, user_id, concert_id, payment_id)
+    return hold
+
+
+def _release(hold_ids):
+    released = 0
+    for hold in TicketHold.objects.filter(pk__in=hold_ids, status=TicketHold.HELD):
+        # Conditional so a hold confirmed by another process is left alone
+        if TicketHold.objects.filter(pk=hold.pk, status=TicketHold.HELD).update(
+                status=TicketHold.EXPIRED):
+            with connection.cursor() as cursor:
+                _return_tickets(cursor, hold.concert_id, hold.quantity)
+            released += 1
+    return released
+
+
+def _active_hold(user_id, concert_id):
+    return TicketHold.objects.filter(
+        user_id=user_id, concert_id=concert_id, status=TicketHold.HELD,
+        expires_at__gt=timezone.now(),
+    ).order_by('-expires_at').first()
+
+
+class GroupCommitter:
+    """Writer thread that commits queued ticket operations for a concert together."""
+
+    def __init__(self, max_wait=GROUP_COMMIT_WAIT, max_batch=GROUP_COMMIT_MAX):
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._pending = {}
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, concert_id, fn, *args):
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(concert_id, []).append((fn, args, future))
+            self._queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ticket-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = {}
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                if self._pending:
+                    # Give concurrent buyers a moment to join this batch
+                    deadline = time.monotonic() + self.max_wait
+                    while self._queued < self.max_batch:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    pending, self._pending, self._queued = self._pending, {}, 0
+            for concert_id, ops in pending.items():
+                for start in range(0, len(ops), self.max_batch):
+                    self._commit(concert_id, ops[start:start + self.max_batch])
+
+    def _commit(self, concert_id, ops):
+        results = []
+        try:
+            with transaction.atomic():
+                for fn, args, future in ops:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, fn(*args), None))
+                    except (SoldOut, HoldExpired) as exc:
+                        results.append((future, None, exc))
+                # Ticket counts are written with raw SQL, so no model signal fires
+                query_cache.invalidate('concerts')
+                if any(exc is None for future, result, exc in results):
+                    events.availability_changed(concert_id)
+        except Exception as exc:
+            if len(ops) > 1:
+                # Nothing was committed; retry one at a time so only the failing operation fails
+                for op in ops:
+                    self._commit(concert_id, [op])
+                return
+            for fn, args, future in ops:
+                future.set_exception(exc)
+            return
+        self.batches += 1
+        self.operations += len(ops)
+        for future, result, exc in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+committer = GroupCommitter()
+
+
+def active_hold(user_id, concert_id):
+    return _active_hold(user_id, concert_id)
+
+
+def hold_tickets(user_id, concert_id, quantity=1):
+    return committer.submit(concert_id, _hold, user_id, concert_id, quantity)
+
+
+def confirm_hold(hold, payment_id):
+    return committer.submit(hold.concert_id, _confirm, hold.pk, hold.user_id,
+                            hold.concert_id, payment_id)
+
+
+def purchase(user_id, concert_id, payment_id, quantity=1):
+    return committer.submit(concert_id, _purchase, user_id, concert_id, payment_id, quantity)
+
+
+def release_expired(now=None, committer=committer):
+    now = now or timezone.now()
+    expired = {}
+    for hold_id, concert_id in TicketHold.objects.filter(
+            status=TicketHold.HELD, expires_at__lte=now).values_list('id', 'concert_id'):
+        expired.setdefault(concert_id, []).append(hold_id)
+
+    released = 0
+    for concert_id, hold_ids in expired.items():
+        if committer is None:
+            with transaction.atomic():
+                released += _release(hold_ids)
+                events.availability_changed(concert_id)
+        else:
+            released += committer.submit(concert_id, _release, hold_ids)
+    return released
+ticket_shards.py
+python
+# band/ticket_shards.py
+import random
+
+from django.db import connection, transaction
+from .caching import query_cache
+
+
+def shard_count(cursor, concert_id):
+    if connection.vendor == 'postgresql':
+        # Waits out a split() in another process, then reads the shards it left
+        cursor.execute("SELECT ticket_shards FROM band_concert WHERE id = %s FOR KEY SHARE", [concert_id])
+    else:
+        cursor.execute("SELECT ticket_shards FROM band_concert WHERE id = %s", [concert_id])
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def take(cursor, concert_id, quantity):
+    """Take tickets from a random shard, refilling it from the fullest one when it runs dry."""
+    shards = shard_count(cursor, concert_id)
+    if not shards:
+        cursor.execute("""
+            UPDATE band_concert
+            SET available_tickets = available_tickets - %s
+            WHERE id = %s AND available_tickets >= %s
+        """, [quantity, concert_id, quantity])
+        return cursor.rowcount > 0
+
+    slot = random.randrange(shards)
+    if _take_from_slot(cursor, concert_id, slot, quantity):
+        return True
+    if _rebalance(cursor, concert_id, slot, quantity):
+        return _take_from_slot(cursor, concert_id, slot, quantity)
+    return False
+
+
+def give(cursor, concert_id, quantity):
+    shards = shard_count(cursor, concert_id)
+    if not shards:
+        cursor.execute("""
+            UPDATE band_concert
+            SET available_tickets = available_tickets + %s
+            WHERE id = %s
+        """, [quantity, concert_id])
+        return
+    cursor.execute("""
+        UPDATE band_ticketshard
+        SET available = available + %s
+        WHERE concert_id = %s AND slot = %s
+    """, [quantity, concert_id, random.randrange(shards)])
+
+
+def _take_from_slot(cursor, concert_id, slot, quantity):
+    cursor.execute("""
+        UPDATE band_ticketshard
+        SET available = available - %s
+        WHERE concert_id = %s AND slot = %s AND available >= %s
+    """, [quantity, concert_id, slot, quantity])
+    return cursor.rowcount > 0
+
+
+def _rebalance(cursor, concert_id, slot, quantity):
+    # Move half of the fullest shard (at least `quantity`) into the dry one
+    cursor.execute("""
+        SELECT slot, available FROM band_ticketshard
+        WHERE concert_id = %s AND slot != %s
+        ORDER BY available DESC
+        LIMIT 1
+    """, [concert_id, slot])
+    donor = cursor.fetchone()
+    if donor is None or donor[1] < quantity:
+        return _consolidate(cursor, concert_id, slot, quantity)
+
+    moved = max(quantity, donor[1] // 2)
+    cursor.execute("""
+        UPDATE band_ticketshard
+        SET available = available - %s
+        WHERE concert_id = %s AND slot = %s AND available >= %s
+    """, [moved, concert_id, donor[0], moved])
+    if cursor.rowcount == 0:
+        return False
+    cursor.execute("""
+        UPDATE band_ticketshard
+        SET available = available + %s
+        WHERE concert_id = %s AND slot = %s
+    """, [moved, concert_id, slot])
+    return True
+
+
+def _consolidate(cursor, concert_id, slot, quantity):
+    # Last few tickets are scattered in pieces smaller than the order
+    cursor.execute("""
+        SELECT COALESCE(SUM(available), 0) FROM band_ticketshard
+        WHERE concert_id = %s
+    """, [concert_id])
+    total = cursor.fetchone()[0]
+    if total < quantity:
+        return False
+    cursor.execute("""
+        UPDATE band_ticketshard
+        SET available = CASE WHEN slot = %s THEN %s ELSE 0 END
+        WHERE concert_id = %s
+    """, [slot, total, concert_id])
+    return True
+
+
+def available(concert_id):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE(SUM(s.available), c.available_tickets)
+            FROM band_concert c
+            LEFT JOIN band_ticketshard s ON s.concert_id = c.id
+            WHERE c.id = %s
+            GROUP BY c.id
+        """, [concert_id])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def split(concert_id, shards):
+    """Spread a concert's remaining tickets over `shards` counter rows (0 folds them back)."""
+    # On the ticket writer, between this process's takes rather than racing them
+    from .reservations import committer
+    return committer.submit(concert_id, _split, concert_id, shards)
+
+
+def _split(concert_id, shards):
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # Other processes' takes and gives wait in shard_count() until this commits
+            cursor.execute("SELECT id FROM band_concert WHERE id = %s FOR UPDATE", [concert_id])
+        remaining = available(concert_id)
+        cursor.execute("DELETE FROM band_ticketshard WHERE concert_id = %s", [concert_id])
+        if shards:
+            per_shard, extra = divmod(remaining, shards)
+            cursor.executemany("""
+                INSERT INTO band_ticketshard (concert_id, slot, available)
+                VALUES (%s, %s, %s)
+            """, [
+                (concert_id, slot, per_shard + (1 if slot < extra else 0))
+                for slot in range(shards)
+            ])
+        cursor.execute("""
+            UPDATE band_concert
+            SET ticket_shards = %s, available_tickets = %s
+            WHERE id = %s
+        """, [shards, 0 if shards else remaining, concert_id])
+        query_cache.invalidate('concerts')
+    return remaining
+caching.py
+python
+# band/caching.py
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+MISSING = object()
+
+
+def _first_version():
+    # Not 1: after the shared cache is flushed or evicts a version, entries
+    # stored under the versions counted before must not come back
+    return time.time_ns()
+
+
+def _shared_version(cache, namespace):
+    return cache.get_or_set(f'qc-version:{namespace}', _first_version, None)
+
+
+def _bump(cache, namespace):
+    try:
+        return cache.incr(f'qc-version:{namespace}')
+    except ValueError:
+        version = _first_version()
+        cache.set(f'qc-version:{namespace}', version, None)
+        return version
+
+
+class LRUBackend:
+    """Per-process LRU with a TTL on every entry.
+
+    Namespace versions live in the `versions` CACHES alias when one is given,
+    re-read at most every `version_ttl` seconds, so an invalidate() in one
+    process reaches the others that soon. Without it they're per process too.
+    """
+
+    def __init__(self, max_entries=512, versions=None, version_ttl=1.0):
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        self._shared = caches[versions] if versions else None
+        self._data = OrderedDict()
+        # namespace -> (read at, version)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_version(self, namespace):
+        read_at, version = self._versions.get(namespace, (None, 1))
+        if self._shared is not None and (read_at is None or time.monotonic() - read_at >= self.version_ttl):
+            version = _shared_version(self._shared, namespace)
+            self._versions[namespace] = (time.monotonic(), version)
+        return version
+
+    def bump_version(self, namespace):
+        if self._shared is not None:
+            version = _bump(self._shared, namespace)
+            self._versions[namespace] = (time.monotonic(), version)
+            return
+        with self._lock:
+            self._versions[namespace] = (None, self._versions.get(namespace, (None, 1))[1] + 1)
+
+
+class SharedBackend:
+    """Any Django cache alias (memcached, redis); locmem works as a local stand-in."""
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key, MISSING)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def get_version(self, namespace):
+        return _shared_version(self.cache, namespace)
+
+    def bump_version(self, namespace):
+        _bump(self.cache, namespace)
+
+
+class QueryCache:
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def get_or_set(self, namespace, compute, *key_parts, ttl=None):
+        # Bumping the namespace version orphans every key built from the old one
+        version = self.backend.get_version(namespace)
+        key = ':'.join(['qc', namespace, str(version)] + [str(part) for part in key_parts])
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits[namespace] += 1
+            return value
+        self.misses[namespace] += 1
+        value = compute()
+        self.backend.set(key, value, ttl or self.ttl)
+        return value
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            transaction.on_commit(lambda namespace=namespace: self.backend.bump_version(namespace))
+
+    def stats(self):
+        return {
+            namespace: {'hits': self.hits[namespace], 'misses': self.misses[namespace]}
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+def _build():
+    config = getattr(settings, 'QUERY_CACHE', {})
+    backend = import_string(config.get('BACKEND', 'band.caching.LRUBackend'))
+    return QueryCache(backend(**config.get('OPTIONS', {})), ttl=config.get('TTL', 300))
+
+
+query_cache = _build()
+pagination.py
+python
+# band/pagination.py
+import base64
+
+from django.conf import settings
+from django.db import connection
+
+PAGE_SIZE = getattr(settings, 'CATALOG_PAGE_SIZE', 50)
+STREAM_CHUNK_SIZE = getattr(settings, 'CATALOG_STREAM_CHUNK_SIZE', 500)
+
+
+def encode_cursor(sort_value, row_id):
+    raw = f"{sort_value}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        sort_value, row_id = raw.rsplit('|', 1)
+        return sort_value, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        # A mangled cursor just starts from the first page
+        return None
+
+
+def fetch_page(table, columns, sort_column, after=None, limit=PAGE_SIZE):
+    """Newest-first page of `columns` after the (sort value, id) position `after`.
+
+    Rows come back as (id, sort value, *columns) along with the cursor of the
+    next page, or None on the last page. Needs an index on (sort_column, id).
+    """
+    where, params = '', []
+    if after is not None:
+        where = f"WHERE ({sort_column}, id) < (%s, %s)"
+        params = list(after)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id, {sort_column}, {', '.join(columns)}
+            FROM {table}
+            {where}
+            ORDER BY {sort_column} DESC, id DESC
+            LIMIT %s
+        """, params + [limit + 1])
+        rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    return rows, next_cursor
+
+
+def iterate_rows(table, columns, sort_column, chunk_size=STREAM_CHUNK_SIZE):
+    # chunked_cursor() is a server-side cursor on PostgreSQL, so rows are
+    # never all held in memory at once
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(f"""
+            SELECT {', '.join(columns)}
+            FROM {table}
+            ORDER BY {sort_column} DESC, id DESC
+        """)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+images.py
+python
+# band/images.py
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .caching import query_cache
+from .models import Photo
+
+logger = logging.getLogger(__name__)
+
+# Each size is stored as a JPEG in Photo.<size>_path plus a .webp sibling
+WIDTHS = getattr(settings, 'PHOTO_DERIVATIVE_WIDTHS', {'thumbnail': 320, 'medium': 800, 'full': 1600})
+QUALITY = getattr(settings, 'PHOTO_DERIVATIVE_QUALITY', 80)
+
+pool = ThreadPoolExecutor(max_workers=getattr(settings, 'PHOTO_DERIVATIVE_WORKERS', 2),
+                          thread_name_prefix='photo-derivatives')
+
+
+def webp_path(jpeg_path):
+    return os.path.splitext(jpeg_path)[0] + '.webp'
+
+
+def srcset(paths, webp=False):
+    return ', '.join(
+        f"{settings.MEDIA_URL}{webp_path(path) if webp else path} {WIDTHS[size]}w"
+        for size, path in paths.items() if path
+    )
+
+
+def _save(name, image, fmt, **options):
+    buffer = BytesIO()
+    image.save(buffer, fmt, **options)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+    return buffer.tell()
+
+
+def build_derivatives(photo_id):
+    photo = Photo.objects.get(pk=photo_id)
+    with photo.image.open('rb') as f:
+        original = ImageOps.exif_transpose(Image.open(f)).convert('RGB')
+
+    stem = os.path.splitext(os.path.basename(photo.image.name))[0]
+    paths, written = {}, 0
+    for size, width in WIDTHS.items():
+        image = original
+        if original.width > width:
+            image = original.resize((width, round(original.height * width / original.width)), Image.LANCZOS)
+        jpeg = f"photos/derived/{photo_id}-{stem}-{size}.jpg"
+        written += _save(jpeg, image, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+        written += _save(webp_path(jpeg), image, 'WEBP', quality=QUALITY, method=4)
+        paths[f'{size}_path'] = jpeg
+
+    # update() rather than save() so the post_save hook does not queue us again
+    Photo.objects.filter(pk=photo_id).update(updated_at=timezone.now(), **paths)
+    query_cache.invalidate('photos')
+    return written
+
+
+def _build_logged(photo_id):
+    try:
+        return build_derivatives(photo_id)
+    except Exception:
+        logger.exception('Could not build derivatives for photo %s', photo_id)
+        raise
+
+
+def queue_derivatives(photo_id):
+    return pool.submit(_build_logged, photo_id)
+jobs.py
+python
+# band/jobs.py
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = getattr(settings, 'JOB_POLL_INTERVAL', 1.0)
+BATCH_SIZE = getattr(settings, 'JOB_BATCH_SIZE', 10)
+RETRY_BASE = getattr(settings, 'JOB_RETRY_BASE', 5)
+RETRY_MAX = getattr(settings, 'JOB_RETRY_MAX', 600)
+LOCK_TIMEOUT = getattr(settings, 'JOB_LOCK_TIMEOUT', 300)
+
+registry = {}
+
+
+class PermanentFailure(Exception):
+    """Raised by a task when retrying cannot help."""
+
+
+def task(fn=None, *, max_attempts=5):
+    def register(fn):
+        fn.max_attempts = max_attempts
+        registry[fn.__name__] = fn
+        return fn
+    return register(fn) if fn else register
+
+
+def enqueue(name, key=None, delay=0, **kwargs):
+    """Queue `name(**kwargs)`. A repeated `key` returns the existing job instead of adding one.
+
+    The row is written in the caller's transaction, so a rolled-back
+    request never leaves a job behind.
+    """
+    fields = {
+        'name': name,
+        'payload': json.dumps(kwargs),
+        'max_attempts': getattr(registry.get(name), 'max_attempts', 5),
+        'run_at': timezone.now() + timedelta(seconds=delay),
+    }
+    if key is None:
+        return Job.objects.create(**fields)
+    job, created = Job.objects.get_or_create(idempotency_key=key, defaults=fields)
+    return job
+
+
+def requeue_stale(now=None):
+    # Jobs whose worker died mid-run
+    now = now or timezone.now()
+    return Job.objects.filter(
+        status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=LOCK_TIMEOUT),
+    ).update(status=Job.QUEUED, locked_by='')
+
+
+def claim(worker, limit=BATCH_SIZE):
+    now = timezone.now()
+    candidates = list(Job.objects.filter(status=Job.QUEUED, run_at__lte=now)
+                      .order_by('run_at', 'id').values_list('id', flat=True)[:limit])
+    claimed = [
+        job_id for job_id in candidates
+        # Conditional, so two workers can never both take a job
+        if Job.objects.filter(pk=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING, locked_by=worker, locked_at=now, attempts=F('attempts') + 1)
+    ]
+    return list(Job.objects.filter(pk__in=claimed).order_by('run_at', 'id'))
+
+
+def backoff(attempts):
+    delay = min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1))
+    return delay + random.uniform(0, delay / 10)
+
+
+def execute(job):
+    fn = registry.get(job.name)
+    try:
+        if fn is None:
+            raise PermanentFailure(f"Unknown task {job.name!r}")
+        fn(**json.loads(job.payload))
+    except Exception as exc:
+        permanent = isinstance(exc, PermanentFailure) or job.attempts >= job.max_attempts
+        logger.warning('Job %s (%s) attempt %s failed: %r', job.pk, job.name, job.attempts, exc)
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.FAILED if permanent else Job.QUEUED,
+            run_at=timezone.now() + timedelta(seconds=0 if permanent else backoff(job.attempts)),
+            last_error=repr(exc)[:1000],
+            locked_by='',
+        )
+        return False
+    Job.objects.filter(pk=job.pk).update(status=Job.DONE, finished_at=timezone.now(), locked_by='')
+    return True
+
+
+class Worker:
+    def __init__(self, name=None, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopping = False
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self, once=False):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        processed = 0
+        while not self.stopping:
+            close_old_connections()
+            jobs = claim(self.name, self.batch_size)
+            if not jobs:
+                if once:
+                    break
+                requeue_stale()
+                time.sleep(self.poll_interval)
+                continue
+            for job in jobs:
+                execute(job)
+                processed += 1
+        return processed
+tasks.py
+python
+# band/tasks.py
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.mail import send_mail
+from . import images, reservations
+from .jobs import PermanentFailure, enqueue, task
+from .models import Concert, UserConcert
+
+
+@task(max_attempts=8)
+def confirm_payment(user_id, concert_id, hold_id, payment_token):
+    # Derived from the hold so a retried job cannot buy a second ticket
+    payment_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f'band-hold:{hold_id}'))
+    if UserConcert.objects.filter(user_id=user_id, concert_id=concert_id,
+                                  payment_id=payment_id, payment_status='completed').exists():
+        return
+
+    # In a real app, you would verify payment_token with the Google Pay API here
+
+    try:
+        reservations.purchase(user_id, concert_id, payment_id)
+    except reservations.SoldOut:
+        raise PermanentFailure(f"Concert {concert_id} sold out before payment {payment_id} was confirmed")
+    enqueue('send_ticket_email', key=f'ticket-email:{payment_id}', user_id=user_id, concert_id=concert_id)
+
+
+@task
+def send_ticket_email(user_id, concert_id):
+    user = User.objects.get(pk=user_id)
+    concert = Concert.objects.get(pk=concert_id)
+    if not user.email:
+        return
+    send_mail(
+        f"Your ticket for {concert.name}",
+        f"Hi {user.username},\n\nYour payment went through. See you at {concert.location} on {concert.date:%B %d, %Y}!",
+        None,
+        [user.email],
+    )
+
+
+@task(max_attempts=3)
+def build_photo_derivatives(photo_id):
+    images.build_derivatives(photo_id)
+
+
+def schedule_hold_release(delay=0):
+    # One job per TICKET_REAP_INTERVAL slot, however many workers schedule it
+    slot = int((time.time() + delay) // reservations.REAP_INTERVAL)
+    return enqueue('release_expired_holds', key=f'release-expired-holds:{slot}', delay=delay)
+
+
+@task
+def release_expired_holds():
+    try:
+        reservations.release_expired(committer=None)
+    finally:
+        schedule_hold_release(delay=reservations.REAP_INTERVAL)
+async_db.py
+python
+# band/async_db.py
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# Each thread keeps its own database connection, so queries from
+# different requests run in parallel instead of queueing on one thread
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASYNC_DB_THREADS', 16),
+                              thread_name_prefix='async-db')
+
+
+def _call(fn, args, kwargs):
+    close_old_connections()
+    return fn(*args, **kwargs)
+
+
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Carry context variables over, so queries count towards band.metrics' request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, partial(context.run, _call, fn, args, kwargs))
+async_views.py
+python
+# band/async_views.py
+from django.contrib.auth.views import redirect_to_login
+from django.db import IntegrityError
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render
+from django.template.loader import get_template, render_to_string
+from django.views.decorators.http import require_http_methods, require_POST
+from . import async_db, attendance, events, views
+from .caching import query_cache
+from .conditional import concerts_state, conditional, photos_state, songs_state
+from .fastjson import FastJsonResponse
+from .pagination import STREAM_CHUNK_SIZE, decode_cursor
+
+
+async def _stream_page(request, template, row_template, name, fetch_page):
+    page = await async_db.run(render_to_string, template, {'stream': True}, request)
+    head, tail = page.split(views.STREAM_MARKER)
+    row_template = get_template(row_template)
+
+    async def chunks():
+        # Walk the keyset pages so no cursor has to stay open across awaits
+        yield head
+        after = None
+        while True:
+            rows, next_cursor = await async_db.run(fetch_page, after, STREAM_CHUNK_SIZE)
+            yield ''.join(row_template.render({name: row}) for row in rows)
+            if next_cursor is None:
+                break
+            after = decode_cursor(next_cursor)
+        yield tail
+
+    return StreamingHttpResponse(chunks())
+
+
+async def _catalog_page(request, namespace, fetch_page, template, name):
+    after = decode_cursor(request.GET.get('after'))
+    items, next_cursor = await async_db.run(query_cache.get_or_set, namespace, lambda: fetch_page(after), after)
+    if template is None:
+        return JsonResponse({'results': items, 'next': next_cursor})
+    return await async_db.run(render, request, template, {name: items, 'next_cursor': next_cursor})
+
+
+@conditional(songs_state)
+async def songs(request):
+    if request.GET.get('stream'):
+        return await _stream_page(request, 'band/songs.html', 'band/song_row.html', 'song', views._song_page)
+    return await _catalog_page(request, 'songs', views._song_page, 'band/songs.html', 'songs')
+
+
+@conditional(songs_state)
+async def api_songs(request):
+    return await _catalog_page(request, 'songs', views._song_page, None, 'songs')
+
+
+@conditional(photos_state)
+async def photos(request):
+    if request.GET.get('stream'):
+        return await _stream_page(request, 'band/photos.html', 'band/photo_row.html', 'photo', views._photo_page)
+    return await _catalog_page(request, 'photos', views._photo_page, 'band/photos.html', 'photos')
+
+
+@conditional(photos_state)
+async def api_photos(request):
+    return await _catalog_page(request, 'photos', views._photo_page, None, 'photos')
+
+
+@conditional(concerts_state)
+async def concerts(request):
+    user = await request.auser()
+    catalog = await async_db.run(query_cache.get_or_set, 'concerts', views._concert_catalog)
+    attending = await async_db.run(views._attendance, user.id) if user.is_authenticated else {}
+    concert_list = views._with_attendance(catalog, attending)
+    return await async_db.run(render, request, 'band/concerts.html', {'concerts': concert_list})
+
+
+@conditional(concerts_state)
+async def api_concerts(request):
+    try:
+        fields = views._concert_fields(request)
+    except ValueError as exc:
+        return FastJsonResponse({'error': str(exc)}, status=400)
+    user = await request.auser()
+    catalog = await async_db.run(query_cache.get_or_set, 'concerts', views._concert_catalog)
+    attending = await async_db.run(views._attendance, user.id) if user.is_authenticated else {}
+    return FastJsonResponse(views._concert_payload(views._with_attendance(catalog, attending), fields))
+
+
+@attendance.idempotent
+async def toggle_attendance(request, concert_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    if request.method == 'POST':
+        try:
+            attending = await async_db.run(attendance.toggle, user.id, concert_id)
+        except IntegrityError:
+            raise Http404('No such concert')
+        except attendance.Paid:
+            return views._paid_attendance()
+        return JsonResponse({'success': True, 'attending': attending})
+    
+    return JsonResponse({'success': False}, status=400)
+
+
+@require_http_methods(['PUT', 'DELETE'])
+@attendance.idempotent
+async def set_attendance(request, concert_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    try:
+        attending = await async_db.run(attendance.apply, user.id, concert_id, request.method == 'PUT')
+    except IntegrityError:
+        raise Http404('No such concert')
+    except attendance.Paid:
+        return views._paid_attendance()
+    return JsonResponse({'success': True, 'attending': attending})
+
+
+def _availability_event(concert_id, available_tickets):
+    return f'event: availability\ndata: {{"id": {concert_id}, "available_tickets": {available_tickets}}}\n\n'
+
+
+async def concert_events(request):
+    """Server-sent events: every concert's ticket count, then each change."""
+    if events.broker.subscribers() >= getattr(settings, 'EVENTS_MAX_SUBSCRIBERS', 10000):
+        return HttpResponse('Too many listeners', status=503, headers={'Retry-After': '30'})
+
+    async def stream():
+        # Subscribed inside the generator so a client gone before the first
+        # chunk never leaves a subscription behind
+        subscription = events.broker.subscribe(events.AVAILABILITY)
+        try:
+            # Subscribe first, then read: a change in between is sent twice, never missed
+            catalog = await async_db.run(query_cache.get_or_set, 'concerts', views._concert_catalog)
+            yield 'retry: 5000\n' + ''.join(
+                _availability_event(concert['id'], concert['available_tickets']) for concert in catalog)
+            async for changes in subscription:
+                yield ''.join(_availability_event(*change) for change in changes) or ': keepalive\n\n'
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_POST
+@attendance.idempotent
+async def api_attendance(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    try:
+        states = attendance.parse_changes(request.body)
+    except ValueError as exc:
+        return FastJsonResponse({'success': False, 'error': str(exc)}, status=400)
+    return FastJsonResponse({'success': True, 'attendance': await async_db.run(attendance.set_many, user.id, states)})
+loadgen.py
+python
+# band/loadgen.py
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('server closed the connection')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    return status, headers.get('connection', '').lower() != 'close'
+
+
+async def _client(host, port, paths, deadline, stats, offset):
+    reader = writer = None
+    sent = offset
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            path = paths[sent % len(paths)]
+            sent += 1
+            started = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode())
+            await writer.drain()
+            status, keep_alive = await _read_response(reader)
+            stats['latencies'].append(time.perf_counter() - started)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            stats['errors'] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+async def _run(base_url, paths, clients, duration):
+    url = urlsplit(base_url)
+    stats = {'latencies': [], 'statuses': {}, 'errors': 0}
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _client(url.hostname, url.port or 80, paths, deadline, stats, offset)
+        for offset in range(clients)
+    ])
+    stats['elapsed'] = time.perf_counter() - started
+    return stats
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def run_load(base_url, paths, clients=100, duration=10.0):
+    """Drive `paths` round-robin from `clients` keep-alive connections for `duration` seconds."""
+    stats = asyncio.run(_run(base_url, paths, clients, duration))
+    latencies = sorted(stats['latencies'])
+    return {
+        'requests': len(latencies),
+        'errors': stats['errors'],
+        'statuses': stats['statuses'],
+        'throughput': len(latencies) / stats['elapsed'],
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'mean': (statistics.fmean(latencies) * 1000) if latencies else 0.0,
+    }
+pool.py
+python
+# band/db/pool.py
+import threading
+import time
+from collections import Counter, deque
+from functools import partial
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of raw DB-API connections with idle eviction and borrow-time health checks."""
+
+    def __init__(self, alias, connect, max_size=20, idle_timeout=300, timeout=10, check_after=30):
+        self.alias = alias
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.check_after = check_after
+        self.metrics = Counter()
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Return (connection, reused)."""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._evict_idle()
+                while self._idle:
+                    # Most recently used first: its statement cache is warmest
+                    conn, returned_at = self._idle.pop()
+                    if time.monotonic() - returned_at < self.check_after or self._healthy(conn):
+                        self.metrics['reused'] += 1
+                        return conn, True
+                    self.metrics['health_check_failures'] += 1
+                    self._discard(conn)
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.metrics['timeouts'] += 1
+                    raise PoolTimeout(f"No connection available in pool {self.alias!r} after {self.timeout}s")
+                self.metrics['waits'] += 1
+                self._cond.wait(remaining)
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self.metrics['created'] += 1
+        return conn, False
+
+    def release(self, conn, broken=False):
+        if not broken:
+            try:
+                # Never hand the next borrower an open transaction
+                conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            if broken:
+                self.metrics['discarded'] += 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            conn, returned_at = self._idle.popleft()
+            self.metrics['idle_closed'] += 1
+            self._discard(conn)
+
+    def _discard(self, conn):
+        self._size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._cond:
+            return dict(self.metrics, size=self._size, idle=len(self._idle),
+                        in_use=self._size - len(self._idle), max_size=self.max_size)
+
+
+def get_pool(alias, connect, options):
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(
+                alias, connect,
+                max_size=options.get('MAX_SIZE', 20),
+                idle_timeout=options.get('IDLE_TIMEOUT', 300),
+                timeout=options.get('TIMEOUT', 10),
+                check_after=options.get('CHECK_AFTER', 30),
+            )
+        return _pools[alias]
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.stats() for alias, pool in pools.items()}
+
+
+class PooledDatabaseWrapperMixin:
+    """Borrow connections from a per-alias pool instead of opening one per request.
+
+    Django's close() (end of request with CONN_MAX_AGE = 0, or
+    close_old_connections()) hands the connection back to the pool.
+    """
+
+    reused_connection = False
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, partial(super().get_new_connection, conn_params),
+                        self.settings_dict.get('POOL', {}))
+        connection, self.reused_connection = pool.acquire()
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            pool = _pools[self.alias]
+            pool.release(self.connection, broken=self.errors_occurred and not self.is_usable())
+base.py (SQLite)
+python
+# band/db/sqlite3/base.py
+from django.db.backends.sqlite3 import base
+from band.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
+base.py (PostgreSQL)
+python
+# band/db/postgresql/base.py
+from django.db.backends.postgresql import base
+from band.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
+operations.py (db)
+python
+# band/db/operations.py
+from django.db import migrations
+
+
+class RunSQLFor(migrations.RunSQL):
+    """RunSQL for one database vendor ('sqlite', 'postgresql'); others skip it.
+
+    sqlmigrate prints the statements for the vendor of the database it's given.
+    """
+
+    def __init__(self, vendor, sql, reverse_sql=None, **kwargs):
+        self.vendor = vendor
+        super().__init__(sql, reverse_sql, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        return name, [self.vendor] + list(args), kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return f"Raw SQL operation ({self.vendor} only)"
+base.py (sessions)
+python
+# band/sessions/base.py
+import copy
+
+from django.conf import settings
+from band.caching import MISSING, LRUBackend
+
+LOCAL_TTL = getattr(settings, 'SESSION_LOCAL_TTL', 10)
+
+
+class LocalCache:
+    """The slice of the cache API the session stores use, over a per-process
+    LRU. Entries live at most SESSION_LOCAL_TTL seconds, which bounds how long
+    another process can keep serving a session changed or ended elsewhere."""
+
+    def __init__(self, max_entries):
+        self._lru = LRUBackend(max_entries)
+
+    def get(self, key, default=None):
+        value = self._lru.get(key)
+        # Callers mutate the dict they're given; other requests must not see that
+        return default if value is MISSING else copy.deepcopy(value)
+
+    def set(self, key, value, timeout):
+        self._lru.set(key, copy.deepcopy(value), min(timeout, LOCAL_TTL))
+
+    def delete(self, key):
+        self._lru.delete(key)
+
+    def __contains__(self, key):
+        return self._lru.get(key) is not MISSING
+
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def aset(self, key, value, timeout):
+        self.set(key, value, timeout)
+
+    async def adelete(self, key):
+        self.delete(key)
+
+
+class SkipUnchangedMixin:
+    """Don't write a session back when its data is what was loaded.
+
+    Setting a key marks the session modified even when the value is the same,
+    and SessionMiddleware then saves it. With SESSION_SAVE_EVERY_REQUEST on,
+    every save is kept, since that's how the expiry slides forward.
+    """
+
+    _loaded = None
+
+    def _snapshot(self, data):
+        return self.serializer().dumps(data)
+
+    def _unchanged(self, must_create):
+        return (not must_create and not settings.SESSION_SAVE_EVERY_REQUEST
+                and self._loaded is not None and self._snapshot(self._session) == self._loaded)
+
+    def load(self):
+        data = super().load()
+        self._loaded = self._snapshot(data)
+        return data
+
+    async def aload(self):
+        data = await super().aload()
+        self._loaded = self._snapshot(data)
+        return data
+
+    def save(self, must_create=False):
+        if self._unchanged(must_create):
+            return
+        super().save(must_create)
+        self._loaded = self._snapshot(self._session)
+
+    async def asave(self, must_create=False):
+        if self._unchanged(must_create):
+            return
+        await super().asave(must_create)
+        self._loaded = self._snapshot(self._session)
+cached_db.py (sessions)
+python
+# band/sessions/cached_db.py
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from .base import LocalCache, SkipUnchangedMixin
+
+_cache = LocalCache(getattr(settings, 'SESSION_LOCAL_MAX_ENTRIES', 10000))
+
+
+class SessionStore(SkipUnchangedMixin, cached_db.SessionStore):
+    """Database-backed sessions read through a per-process LRU, so repeat
+    requests from a signed-in user skip the django_session SELECT."""
+    cache_key_prefix = 'band.sessions.cached_db'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._cache = _cache
+shared.py (sessions)
+python
+# band/sessions/shared.py
+from django.contrib.sessions.backends import cache
+from .base import SkipUnchangedMixin
+
+
+class SessionStore(SkipUnchangedMixin, cache.SessionStore):
+    """Sessions kept only in SESSION_CACHE_ALIAS. Point that at redis or
+    memcached; a locmem alias is a stand-in that only works for one process."""
+search.py
+python
+# band/search.py
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+PAGE_SIZE = getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+MAX_PAGE = 50
+
+# External-content FTS5 index over band_song, kept in sync by triggers.
+# Migration 0008 creates them; a later migration that rebuilds band_song on
+# SQLite drops the triggers with the old table, and must create them again
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS band_song_fts USING fts5(
+        title, lyrics,
+        content='band_song', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS band_song_fts_ai AFTER INSERT ON band_song BEGIN
+        INSERT INTO band_song_fts (rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS band_song_fts_ad AFTER DELETE ON band_song BEGIN
+        INSERT INTO band_song_fts (band_song_fts, rowid, title, lyrics) VALUES ('delete', old.id, old.title, old.lyrics);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS band_song_fts_au AFTER UPDATE ON band_song BEGIN
+        INSERT INTO band_song_fts (band_song_fts, rowid, title, lyrics) VALUES ('delete', old.id, old.title, old.lyrics);
+        INSERT INTO band_song_fts (rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics);
+    END
+    """,
+]
+
+# Control characters can't appear in lyrics, so they mark highlights safely until escaping
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+def install(using='default', rebuild=False):
+    """Create the index and triggers if missing; manage.py rebuild_search_index."""
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'band_song_fts'")
+        existed = cursor.fetchone() is not None
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+        if rebuild or not existed:
+            cursor.execute("INSERT INTO band_song_fts (band_song_fts) VALUES ('rebuild')")
+
+
+def match_expression(query):
+    # Every word must match, and the last may be a prefix (search-as-you-type)
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(text):
+    return mark_safe(escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def search_songs(query, page=1):
+    """Ranked matches for `query`; returns (results, has_next)."""
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    page = max(1, min(page, MAX_PAGE))
+    if connection.vendor != 'sqlite':
+        return _search_like(query, page)
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT s.id, s.duration, s.release_date,
+                   highlight(band_song_fts, 0, char(2), char(3)),
+                   snippet(band_song_fts, 1, char(2), char(3), '…', 12)
+            FROM band_song_fts
+            JOIN band_song s ON s.id = band_song_fts.rowid
+            WHERE band_song_fts MATCH %s
+            ORDER BY bm25(band_song_fts, 10.0, 1.0)
+            LIMIT %s OFFSET %s
+        """, [expression, PAGE_SIZE + 1, (page - 1) * PAGE_SIZE])
+        rows = cursor.fetchall()
+
+    results = []
+    for row in rows[:PAGE_SIZE]:
+        minutes, seconds = divmod(row[1], 60)
+        results.append({
+            'id': row[0],
+            'title': _highlight(row[3]),
+            'duration': f"{minutes}:{seconds:02d}",
+            'release_date': row[2],
+            'excerpt': _highlight(row[4]),
+        })
+    return results, len(rows) > PAGE_SIZE
+
+
+def _search_like(query, page):
+    # Unranked fallback for databases without FTS5
+    from .models import Song
+
+    songs = list(Song.objects.filter(title__icontains=query).order_by('-release_date', '-id')
+                 [(page - 1) * PAGE_SIZE:page * PAGE_SIZE + 1])
+    results = [{
+        'id': song.id,
+        'title': escape(song.title),
+        'duration': f"{song.duration // 60}:{song.duration % 60:02d}",
+        'release_date': song.release_date,
+        'excerpt': '',
+    } for song in songs[:PAGE_SIZE]]
+    return results, len(songs) > PAGE_SIZE
+assets.py
+python
+# band/assets.py
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_AGE = getattr(settings, 'STATIC_MAX_AGE', 31536000)
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+# ManifestStaticFilesStorage names look like site.0123456789ab.css
+HASHED = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # Conservative: indentation, blank lines and whole-line // comments only,
+    # so strings and regex literals are never touched
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    """Hashed file names, minified project assets and .gz/.br siblings."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name, hashed_name in self.hashed_files.items():
+            extension = os.path.splitext(name)[1]
+            if extension not in COMPRESSIBLE:
+                continue
+            path = self.path(hashed_name)
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Only our own files; third-party assets ship minified already
+            if name.startswith('band/') and extension in MINIFIERS:
+                content = MINIFIERS[extension](content.decode()).encode()
+                with open(path, 'wb') as f:
+                    f.write(content)
+            self._write_variant(path + '.gz', content, gzip.compress(content, 9))
+            if brotli is not None:
+                self._write_variant(path + '.br', content, brotli.compress(content, quality=11))
+
+    def _write_variant(self, path, original, compressed):
+        if len(compressed) < len(original):
+            with open(path, 'wb') as f:
+                f.write(compressed)
+
+
+def serve(request, path):
+    """STATIC_ROOT for when no front-end server sits in front of Django.
+
+    Picks a precompressed sibling the client accepts; hashed names are cached
+    for a year since their content can never change.
+    """
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except ValueError:
+        raise Http404(path)
+    if not os.path.isfile(fullpath):
+        raise Http404(path)
+
+    content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+    accepted = request.headers.get('Accept-Encoding', '')
+    encoding = None
+    for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+        if name in accepted and os.path.isfile(fullpath + suffix):
+            fullpath, encoding = fullpath + suffix, name
+            break
+
+    response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if HASHED.search(path):
+        patch_cache_control(response, public=True, max_age=MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=300)
+    return response
+conditional.py
+python
+# band/conditional.py
+import datetime
+import hashlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from . import async_db
+from .caching import query_cache
+
+# Bump on deploy so pages cached by ETag pick up template changes
+RELEASE = getattr(settings, 'BAND_RELEASE', '')
+
+
+def _aware(value):
+    # SQLite hands back aggregates of datetime columns as text
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+def table_state(table):
+    """(MAX(updated_at), COUNT(*)) of `table`; the count catches deletes."""
+    def state(request):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MAX(updated_at), COUNT(*) FROM {table}")
+            modified, count = cursor.fetchone()
+        return (modified, count), _aware(modified)
+    return state
+
+
+# One row however many concerts the user marked. Weighting by concert_id
+# means moving attendance or a payment from one concert to another changes it
+ATTENDANCE_STATE = """
+    SELECT COUNT(*), MAX(id),
+           SUM(CASE WHEN attending THEN concert_id ELSE 0 END),
+           SUM(CASE WHEN payment_status = 'completed' THEN concert_id ELSE 0 END)
+    FROM band_userconcert
+    WHERE user_id = %s
+"""
+
+
+def concerts_state(request):
+    # Ticket counts change through raw UPDATEs that leave updated_at alone, so
+    # there is no Last-Modified. Every concert's row, from the listing cache
+    # the view reads too, so a sale on one concert and a released hold on
+    # another can't cancel out
+    from .views import _concert_catalog
+    catalog = query_cache.get_or_set('concerts', _concert_catalog)
+    fingerprint = [tuple(concert.values()) for concert in catalog]
+    if request.user.is_authenticated:
+        with connection.cursor() as cursor:
+            cursor.execute(ATTENDANCE_STATE, [request.user.id])
+            fingerprint.append(cursor.fetchone())
+    return fingerprint, None
+
+
+def conditional(state):
+    """Answer If-None-Match / If-Modified-Since before the view runs.
+
+    `state(request)` returns a fingerprint and an optional last-modified
+    datetime from a query much cheaper than the view's own; when the client's
+    copy is current the response is a 304 and the view is skipped.
+    """
+    def validators(request):
+        fingerprint, modified = state(request)
+        digest = hashlib.md5(repr((RELEASE, request.user.id, fingerprint)).encode()).hexdigest()
+        # Weak: the CSRF token in the page is re-masked on every render
+        etag = f'W/"{digest}"'
+        return etag, int(modified.timestamp()) if modified else None
+
+    def finish(request, response, etag, last_modified):
+        response.headers['ETag'] = etag
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        # Always revalidate; a 304 costs one aggregate query
+        patch_cache_control(response, no_cache=True)
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True)
+        return response
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return await view(request, *args, **kwargs)
+                etag, last_modified = await async_db.run(validators, request)
+                response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return finish(request, response, etag, last_modified)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return view(request, *args, **kwargs)
+                etag, last_modified = validators(request)
+                response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                if response is None:
+                    response = view(request, *args, **kwargs)
+                return finish(request, response, etag, last_modified)
+        return wrapper
+    return decorator
+
+
+songs_state = table_state('band_song')
+photos_state = table_state('band_photo')
+bulk.py
+python
+# band/bulk.py
+import csv
+import json
+import os
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from .caching import query_cache
+from .models import Song, Photo, Concert, UserConcert, ImportProgress
+
+# Columns read and written for each model; ids are kept so that
+# attendances still point at the right users and concerts after a move
+MODELS = {
+    'song': (Song, ['id', 'title', 'duration', 'release_date', 'lyrics'], ('songs',)),
+    'photo': (Photo, ['id', 'title', 'image', 'event_date', 'description',
+                      'thumbnail_path', 'medium_path', 'full_path'], ('photos',)),
+    'concert': (Concert, ['id', 'name', 'location', 'date', 'price', 'available_tickets', 'ticket_shards'],
+                ('concerts',)),
+    'userconcert': (UserConcert, ['id', 'user_id', 'concert_id', 'attending', 'payment_status', 'payment_id'],
+                    ('concerts',)),
+}
+
+
+def file_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+class Progress:
+    """Position of the last exported chunk, kept next to the data file."""
+
+    def __init__(self, path):
+        self.path = path + '.progress'
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, **state):
+        # Write then rename, so a crash never leaves half a progress file
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Lines:
+    # Decoded lines of a binary file, counting bytes so a CSV record
+    # boundary can be turned back into a seek position
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+def read_records(f, fmt, offset=0):
+    """Yield (record dict, byte offset just past it) from `offset` on."""
+    if fmt == 'jsonl':
+        f.seek(offset)
+        lines = _Lines(f)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line), lines.offset
+        return
+
+    f.seek(0)
+    lines = _Lines(f)
+    header = next(csv.reader(lines))
+    if offset:
+        f.seek(offset)
+        lines.offset = offset
+    for row in csv.reader(lines):
+        if row:
+            yield dict(zip(header, row)), lines.offset
+
+
+def _values(model, columns, record, fmt):
+    values = {}
+    for column in columns:
+        if column not in record:
+            continue
+        value = record[column]
+        field = model._meta.get_field(column)
+        # CSV has no null: an empty cell means "let the database decide"
+        if fmt == 'csv' and value == '' and (field.primary_key or field.null):
+            continue
+        values[field.attname] = field.to_python(value)
+    return values
+
+
+def import_progress(path):
+    """{'offset', 'rows'} of an interrupted import of `path`, or None."""
+    return ImportProgress.objects.filter(path=os.path.abspath(path)).values('offset', 'rows').first()
+
+
+def import_rows(name, path, fmt=None, batch_size=5000, resume=True, ignore_conflicts=False, report=None):
+    """Stream `path` into the model called `name`, one transaction per batch.
+
+    Each batch records its end offset in band_importprogress within its own
+    transaction, so an interrupted import picks up where it stopped without
+    repeating or skipping a batch. Returns (rows, seconds).
+    """
+    model, columns, namespaces = MODELS[name]
+    fmt = file_format(path, fmt)
+    key = os.path.abspath(path)
+    state = (import_progress(path) if resume else None) or {'offset': 0, 'rows': 0}
+    rows, started = state['rows'], time.perf_counter()
+    imported = 0
+
+    def flush(batch, offset):
+        nonlocal rows, imported
+        with transaction.atomic():
+            model.objects.bulk_create(batch, ignore_conflicts=ignore_conflicts)
+            ImportProgress.objects.update_or_create(path=key, defaults={'offset': offset, 'rows': rows + len(batch)})
+        rows += len(batch)
+        imported += len(batch)
+        if report:
+            report(rows, imported / (time.perf_counter() - started))
+
+    with open(path, 'rb') as f:
+        batch, offset = [], state['offset']
+        for record, offset in read_records(f, fmt, state['offset']):
+            batch.append(model(**_values(model, columns, record, fmt)))
+            if len(batch) >= batch_size:
+                flush(batch, offset)
+                batch = []
+        if batch:
+            flush(batch, offset)
+
+    ImportProgress.objects.filter(path=key).delete()
+    # bulk_create sends no post_save, so the listing caches are told directly
+    query_cache.invalidate(*namespaces)
+    return imported, time.perf_counter() - started
+
+
+def export_rows(name, path, fmt=None, batch_size=5000, resume=True, report=None):
+    """Write the model called `name` to `path` in primary key order.
+
+    Rows are read in keyset batches, so memory stays flat; a resumed export
+    appends after the last primary key written. Returns (rows, seconds).
+    """
+    model, columns, _ = MODELS[name]
+    fmt = file_format(path, fmt)
+    progress = Progress(path)
+    state = (progress.load() if resume and os.path.exists(path) else None) or {'last_id': 0, 'rows': 0}
+    rows, started = state['rows'], time.perf_counter()
+    exported = 0
+
+    with open(path, 'a' if state['last_id'] else 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            if not state['last_id']:
+                writer.writerow(columns)
+        last_id = state['last_id']
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list(*columns)[:batch_size])
+            if not batch:
+                break
+            if fmt == 'csv':
+                writer.writerows(['' if value is None else value for value in row] for row in batch)
+            else:
+                f.writelines(json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n' for row in batch)
+            f.flush()
+            last_id = batch[-1][0]
+            rows += len(batch)
+            exported += len(batch)
+            progress.save(last_id=last_id, rows=rows)
+            if report:
+                report(rows, exported / (time.perf_counter() - started))
+
+    progress.clear()
+    return exported, time.perf_counter() - started
+metrics.py
+python
+# band/metrics.py
+import cProfile
+import contextvars
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+PROFILE_THRESHOLD = getattr(settings, 'PROFILE_THRESHOLD_MS', 500) / 1000
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', 'profiles')
+SLOW_QUERY = getattr(settings, 'SLOW_QUERY_MS', 100) / 1000
+SLOWEST_KEPT = 20
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._series = {}  # label values -> [count per bucket..., +Inf], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts, total = self._series.get(label_values) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[label_values] = (counts, total + value)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _labels(self.labels + ('le',), label_values + (str(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+REQUEST_SECONDS = Histogram('band_request_duration_seconds', 'Time spent in the view and middleware',
+                            ('view', 'method', 'status'), LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram('band_request_queries', 'SQL statements per request', ('view',), QUERY_COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram('band_request_sql_seconds', 'Time spent in SQL per request',
+                                ('view',), LATENCY_BUCKETS)
+SLOW_QUERIES = Counter('band_slow_queries_total', 'Statements slower than SLOW_QUERY_MS', ('view',))
+PROFILES = Counter('band_profiles_written_total', 'Sampled requests over the threshold dumped to PROFILE_DIR', ())
+RATE_LIMITED = Counter('band_rate_limited_total', 'Requests refused with a 429 by band.ratelimit', ('view', 'key'))
+HASHING_REJECTED = Counter('band_hashing_rejected_total', 'Logins and sign-ups refused because the hashing queue was full', ())
+METRICS = [REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_SQL_SECONDS, SLOW_QUERIES, PROFILES, RATE_LIMITED, HASHING_REJECTED]
+
+
+class SlowestStatements:
+    """The slowest SQL seen by this process, worst duration per statement."""
+
+    def __init__(self, keep=SLOWEST_KEPT):
+        self.keep = keep
+        self._worst = {}  # sql -> (seconds, view)
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, view):
+        with self._lock:
+            if seconds <= self._worst.get(sql, (0, None))[0]:
+                return
+            if len(self._worst) >= self.keep and sql not in self._worst:
+                fastest = min(self._worst, key=lambda key: self._worst[key][0])
+                if self._worst[fastest][0] >= seconds:
+                    return
+                del self._worst[fastest]
+            self._worst[sql] = (seconds, view)
+
+    def render(self):
+        yield '# HELP band_sql_slowest_seconds Worst duration of the slowest statements seen'
+        yield '# TYPE band_sql_slowest_seconds gauge'
+        with self._lock:
+            worst = sorted(self._worst.items(), key=lambda item: -item[1][0])
+        for sql, (seconds, view) in worst:
+            yield f"band_sql_slowest_seconds{_labels(('view', 'sql'), (view, sql))} {seconds}"
+
+
+slowest = SlowestStatements()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return (match.url_name or match.view_name) if match else '<unresolved>'
+
+
+class RequestStats:
+    __slots__ = ('request', 'queries', 'sql_seconds')
+
+    def __init__(self, request):
+        self.request = request
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+# Set for the duration of a request; band.async_db copies it into its threads
+current = contextvars.ContextVar('band_request_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """connection.execute_wrapper hook, installed on every connection."""
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats = current.get()
+        view = view_name(stats.request) if stats else '<no request>'
+        if stats:
+            stats.queries += 1
+            stats.sql_seconds += elapsed
+        statement = ' '.join(sql.split())[:200]
+        slowest.record(statement, elapsed, view)
+        if elapsed >= SLOW_QUERY:
+            SLOW_QUERIES.inc(view)
+            logger.warning('Slow query (%.0f ms) in %s: %s', elapsed * 1000, view, statement)
+
+
+_profile_lock = threading.Lock()
+_profile_ids = itertools.count()
+
+
+class MetricsMiddleware:
+    """Per-view latency, query count and SQL time, plus sampled cProfile dumps.
+
+    Keep it first in MIDDLEWARE so the timing covers the other middleware.
+    Streaming responses are timed up to the first byte. Under ASGI the
+    profile only sees the event loop thread, not the async_db workers.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        stats, token, profiler, started = self._start(request)
+        response = None
+        try:
+            response = self.get_response(request)
+        finally:
+            self._finish(request, response, stats, token, profiler, started)
+        return response
+
+    async def _acall(self, request):
+        stats, token, profiler, started = self._start(request)
+        response = None
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._finish(request, response, stats, token, profiler, started)
+        return response
+
+    def _start(self, request):
+        stats = RequestStats(request)
+        token = current.set(stats)
+        profiler = None
+        # One profile at a time: the interpreter allows a single active profiler
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return stats, token, profiler, time.perf_counter()
+
+    def _finish(self, request, response, stats, token, profiler, started):
+        elapsed = time.perf_counter() - started
+        current.reset(token)
+        view = view_name(request)
+        status = response.status_code if response is not None else 500
+
+        if profiler is not None:
+            profiler.disable()
+            try:
+                if elapsed >= PROFILE_THRESHOLD:
+                    os.makedirs(PROFILE_DIR, exist_ok=True)
+                    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{view}-{os.getpid()}-{next(_profile_ids)}.prof")
+                    profiler.dump_stats(path)
+                    PROFILES.inc()
+                    logger.info('Profiled %s (%.0f ms): %s', view, elapsed * 1000, path)
+            finally:
+                _profile_lock.release()
+
+        REQUEST_SECONDS.observe(elapsed, view, request.method, status)
+        REQUEST_QUERIES.observe(stats.queries, view)
+        REQUEST_SQL_SECONDS.observe(stats.sql_seconds, view)
+
+
+def render(extra=()):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(slowest.render())
+    lines.extend(extra)
+    return '\n'.join(lines) + '\n'
+benchmark.py
+python
+# band/benchmark.py
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.utils import timezone
+from .loadgen import percentile
+from .models import Song, Photo, Concert, UserConcert
+from .pagination import encode_cursor
+
+BENCH_PASSWORD = 'bench-password'
+WORDS = ('love night fire heart road city rain dance dream light shadow river summer '
+         'highway ghost electric midnight golden broken wild ocean thunder echo neon').split()
+
+
+def seed(users=200, songs=5000, photos=1000, concerts=20, attendances=2000, tickets=500, log=print):
+    """Add a synthetic catalog plus bench-user-N accounts and one bench-staff."""
+    rng = random.Random(7)
+    # One hash shared by every account, so seeding doesn't spend minutes in PBKDF2
+    password = make_password(BENCH_PASSWORD)
+    started = time.perf_counter()
+    with transaction.atomic():
+        first = User.objects.filter(username__startswith='bench-user-').count()
+        User.objects.bulk_create([
+            User(username=f'bench-user-{i}', password=password, email=f'bench-user-{i}@example.com')
+            for i in range(first, users)
+        ], batch_size=1000)
+        if not User.objects.filter(username='bench-staff').exists():
+            User.objects.create(username='bench-staff', password=password, is_staff=True)
+
+        Song.objects.bulk_create([
+            Song(title=' '.join(rng.choices(WORDS, k=3)).title(), duration=rng.randint(120, 420),
+                 release_date=date(1990, 1, 1) + timedelta(days=rng.randint(0, 12000)),
+                 lyrics=' '.join(rng.choices(WORDS, k=80)))
+            for _ in range(songs)
+        ], batch_size=2000)
+        Photo.objects.bulk_create([
+            Photo(title=f'Live {i}', image=f'photos/bench-{i % 50}.jpg', description='From the pit',
+                  event_date=date(2015, 1, 1) + timedelta(days=rng.randint(0, 3650)))
+            for i in range(photos)
+        ], batch_size=2000)
+        Concert.objects.bulk_create([
+            Concert(name=f'Bench Tour {i}', location=f'Arena {i % 7}', price=rng.choice([25, 40, 65]),
+                    date=timezone.now() + timedelta(days=rng.randint(1, 365)), available_tickets=tickets)
+            for i in range(concerts)
+        ])
+
+        user_ids = list(User.objects.filter(username__startswith='bench-user-').values_list('id', flat=True))
+        concert_ids = list(Concert.objects.filter(name__startswith='Bench Tour').values_list('id', flat=True))
+        pairs = {(rng.choice(user_ids), rng.choice(concert_ids))
+                 for _ in range(min(attendances, len(user_ids) * len(concert_ids)))}
+        UserConcert.objects.bulk_create([
+            UserConcert(user_id=user_id, concert_id=concert_id,
+                        payment_status=rng.choice(['pending', 'completed']))
+            for user_id, concert_id in pairs
+        ], batch_size=2000, ignore_conflicts=True)
+    log(f"Seeded {users} users, {songs} songs, {photos} photos, {concerts} concerts, "
+        f"{len(pairs)} attendances in {time.perf_counter() - started:.1f}s")
+
+
+class Context:
+    """Ids the routes pick from, loaded once before a run."""
+
+    def __init__(self):
+        self.user_ids = list(User.objects.filter(username__startswith='bench-user-').values_list('id', flat=True))
+        if not self.user_ids:
+            raise ValueError('No bench users; run with --seed first')
+        self.staff = User.objects.get(username='bench-staff')
+        self.concert_ids = list(Concert.objects.filter(date__gte=timezone.now()).values_list('id', flat=True))
+        songs = list(Song.objects.order_by('?').values_list('release_date', 'id')[:100])
+        photos = list(Photo.objects.order_by('?').values_list('event_date', 'id')[:100])
+        self.song_cursors = [encode_cursor(*row) for row in songs] or ['']
+        self.photo_cursors = [encode_cursor(*row) for row in photos] or ['']
+        self.registered = Counter()
+        self._lock = threading.Lock()
+
+    def new_username(self):
+        with self._lock:
+            self.registered['n'] += 1
+            return f"bench-new-{time.time_ns()}-{self.registered['n']}"
+
+
+def _get(path):
+    return lambda ctx, rng: ('get', path(ctx, rng) if callable(path) else path, None)
+
+
+def _post(path, data=lambda ctx, rng: {}):
+    return lambda ctx, rng: ('post', path(ctx, rng), data(ctx, rng))
+
+
+def _send(method, path):
+    return lambda ctx, rng: (method, path(ctx, rng), None)
+
+
+def _post_json(path, body):
+    return lambda ctx, rng: ('post', path(ctx, rng), json.dumps(body(ctx, rng)), 'application/json')
+
+
+# name -> (who makes the request, request builder); covers every route in band/urls.py
+# except the never-ending /concerts/events/ stream, which bench_events measures,
+# and /concert/<id>/queue/, which only means something from inside the onsale scenario
+ROUTES = {
+    'home': (None, _get('/')),
+    'songs': (None, _get('/songs/')),
+    'songs_page': (None, _get(lambda ctx, rng: f"/songs/?after={rng.choice(ctx.song_cursors)}")),
+    'songs_stream': (None, _get('/songs/?stream=1')),
+    'photos': (None, _get('/photos/')),
+    'photos_page': (None, _get(lambda ctx, rng: f"/photos/?after={rng.choice(ctx.photo_cursors)}")),
+    'api_songs': (None, _get('/api/songs/')),
+    'api_photos': (None, _get('/api/photos/')),
+    'search': (None, _get(lambda ctx, rng: f"/search/?q={rng.choice(WORDS)}+{rng.choice(WORDS)[:3]}")),
+    'api_search': (None, _get(lambda ctx, rng: f"/api/search/?q={rng.choice(WORDS)}")),
+    'concerts': (None, _get('/concerts/')),
+    'concerts_user': ('user', _get('/concerts/')),
+    'api_concerts': (None, _get('/api/concerts/')),
+    'api_concerts_poll': ('user', _get('/api/concerts/?fields=id,available_tickets')),
+    'api_attendance': ('user', _post_json(lambda ctx, rng: '/api/attendance/', lambda ctx, rng: {'changes': [
+        {'concert_id': concert_id, 'attending': rng.random() < 0.5}
+        for concert_id in rng.sample(ctx.concert_ids, min(3, len(ctx.concert_ids)))]})),
+    'toggle_attendance': ('user', _post(lambda ctx, rng: f"/concert/{rng.choice(ctx.concert_ids)}/toggle/")),
+    'set_attendance': ('user', _send('put', lambda ctx, rng: f"/concert/{rng.choice(ctx.concert_ids)}/attendance/")),
+    'unset_attendance': ('user', _send('delete', lambda ctx, rng: f"/concert/{rng.choice(ctx.concert_ids)}/attendance/")),
+    'payment_page': ('user', _get(lambda ctx, rng: f"/concert/{rng.choice(ctx.concert_ids)}/payment/")),
+    'payment_submit': ('user', _post(lambda ctx, rng: f"/concert/{rng.choice(ctx.concert_ids)}/payment/",
+                                     lambda ctx, rng: {'payment_token': 'bench-token'})),
+    'login': (None, _post(lambda ctx, rng: '/login/', lambda ctx, rng: {
+        'username': f"bench-user-{rng.randrange(len(ctx.user_ids))}", 'password': BENCH_PASSWORD})),
+    'logout': ('user', _get('/logout/')),
+    'register': (None, _post(lambda ctx, rng: '/register/', lambda ctx, rng: {
+        'username': ctx.new_username(), 'password': BENCH_PASSWORD, 'email': 'new@example.com'})),
+    'cache_stats': ('staff', _get('/cache/stats/')),
+    'db_pool_stats': ('staff', _get('/db/pool/')),
+    'concert_report': ('staff', _get('/reports/concerts/')),
+    'metrics': ('staff', _get('/metrics/')),
+}
+
+# Rough shape of on-sale day traffic: mostly browsing, some buying
+MIX = {
+    'home': 10, 'songs': 12, 'songs_page': 4, 'photos': 8, 'photos_page': 2, 'api_songs': 4, 'api_photos': 3,
+    'search': 6, 'api_search': 3, 'concerts': 14, 'concerts_user': 12, 'api_concerts_poll': 10, 'api_attendance': 4,
+    'payment_page': 4, 'payment_submit': 3, 'login': 4, 'logout': 1, 'register': 1,
+}
+
+# Doors-open sign-in spike: mostly logins, with browsing alongside to show what hashing costs it
+LOGIN_RUSH = {'login': 6, 'register': 1, 'concerts': 2, 'api_concerts_poll': 1}
+
+
+def _host():
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+    return hosts[0] if hosts else 'localhost'
+
+
+def _timed(client, method, path, data=None, content_type=None):
+    """(seconds, status, SQL statements, response) for one request, body included."""
+    queries = 0
+    extra = {'content_type': content_type} if content_type else {}
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    with connection.execute_wrapper(count):
+        response = getattr(client, method)(path, data, **extra) if data is not None else getattr(client, method)(path)
+        if getattr(response, 'streaming', False):
+            b''.join(response.streaming_content)
+    return time.perf_counter() - started, response.status_code, queries, response
+
+
+class VirtualUser:
+    """One thread's clients: anonymous, a logged-in bench user and staff."""
+
+    def __init__(self, ctx, rng):
+        self.ctx, self.rng = ctx, rng
+        self.clients = {}
+
+    def client(self, role):
+        client = self.clients.get(role)
+        if client is None:
+            client = self.clients[role] = Client(HTTP_HOST=_host())
+            # force_login skips the password hasher; the login route measures that
+            if role == 'user':
+                client.force_login(User.objects.get(pk=self.rng.choice(self.ctx.user_ids)))
+            elif role == 'staff':
+                client.force_login(self.ctx.staff)
+        return client
+
+    def request(self, route):
+        role, build = ROUTES[route]
+        client = self.client(role)
+        elapsed, status, queries, _ = _timed(client, *build(self.ctx, self.rng))
+        if route in ('login', 'logout'):
+            # The session changed hands; start the next request from a clean client
+            self.clients.pop(role)
+        return route, elapsed, status, queries
+
+
+def run(routes, requests, threads, ctx, seed=1):
+    """Send `requests` requests drawn from `routes` (a weight dict) across `threads` virtual users."""
+    names, weights = list(routes), list(routes.values())
+    samples = []
+    lock = threading.Lock()
+    local = threading.local()
+    counter = iter(range(requests))
+
+    def worker(index):
+        local.user = VirtualUser(ctx, random.Random(seed * 1000 + index))
+        rng = random.Random(seed + index)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            route = rng.choices(names, weights)[0]
+            try:
+                sample = local.user.request(route)
+            except Exception as exc:
+                sample = (route, 0.0, type(exc).__name__, 0)
+            with lock:
+                samples.append(sample)
+        connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def summarize(samples, elapsed):
+    by_route = {}
+    for route, seconds, status, queries in samples:
+        by_route.setdefault(route, []).append((seconds, status, queries))
+    report = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(seconds for seconds, _, _ in rows)
+        statuses = Counter(str(status) for _, status, _ in rows)
+        report[route] = {
+            'requests': len(rows),
+            'throughput': len(rows) / elapsed,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'queries': statistics.fmean(queries for _, _, queries in rows),
+            'errors': sum(1 for _, status, _ in rows if not isinstance(status, int) or status >= 500),
+            'statuses': dict(statuses),
+        }
+    latencies = sorted(seconds for _, seconds, _, _ in samples)
+    report['ALL'] = {
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'queries': statistics.fmean(queries for _, _, _, queries in samples) if samples else 0.0,
+        'errors': sum(row['errors'] for row in report.values()),
+        'statuses': dict(sum((Counter(row['statuses']) for row in report.values()), Counter())),
+    }
+    return report
+
+
+def login_rush(ctx, requests, threads):
+    """LOGIN_RUSH across `threads` virtual users, with the hasher settings it ran under."""
+    from . import hashing
+    report = run(LOGIN_RUSH, requests, threads, ctx)
+    report['ALL'].update(hashing.describe())
+    return report
+
+
+def onsale(ctx, buyers, tickets, threads, queue_timeout=60):
+    """Buyers rush one fresh concert: wait their turn in the waiting room,
+    open the payment page, then pay, which is when the ticket is held.
+
+    Returns the summary plus tickets sold and how many were oversold.
+    """
+    from .models import TicketHold
+    concert = Concert.objects.create(name='Bench On-sale', location='Arena', price=50,
+                                     date=timezone.now() + timedelta(days=30), available_tickets=tickets)
+    users = User.objects.filter(pk__in=ctx.user_ids[:buyers])
+    samples = []
+    lock = threading.Lock()
+
+    queued = []
+
+    def buy(user):
+        client = Client(HTTP_HOST=_host())
+        client.force_login(user)
+        path = f"/concert/{concert.pk}/payment/"
+
+        def request(route, method, path, data=None):
+            try:
+                elapsed, status, queries, response = _timed(client, method, path, data)
+            except Exception as exc:
+                elapsed, status, queries, response = 0.0, type(exc).__name__, 0, None
+            with lock:
+                samples.append((route, elapsed, status, queries))
+            return response
+
+        response = request('payment_page', 'get', path)
+        if response is not None and 'Retry-After' in response.headers:
+            # In the waiting room: poll like waiting_room.js until let through
+            with lock:
+                queued.append(user.pk)
+            deadline = time.monotonic() + queue_timeout
+            place = {'state': 'waiting', 'retry_after': int(response.headers['Retry-After'])}
+            # A sold-out line can move again as holds expire; a bench buyer gives up
+            while place['state'] == 'waiting' and time.monotonic() < deadline:
+                time.sleep(min(place['retry_after'], 2))
+                status = request('queue_status', 'get', f"/concert/{concert.pk}/queue/")
+                place = status.json() if status is not None and status.status_code == 200 else place
+            response = request('payment_page', 'get', path) if place['state'] == 'admitted' else None
+        if response is not None and response.status_code == 200:
+            request('payment_submit', 'post', path, {'payment_token': 'bench'})
+        connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(buy, users))
+    report = summarize(samples, time.perf_counter() - started)
+
+    concert.refresh_from_db()
+    sold = TicketHold.objects.filter(concert=concert).exclude(status=TicketHold.EXPIRED).count()
+    report['ALL'].update(buyers=len(users), tickets=tickets, sold=sold, queued=len(queued),
+                         oversold=max(0, sold - tickets) + max(0, -concert.available_tickets))
+    return report
+attendance.py
+python
+# band/attendance.py
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.http import HttpResponse, JsonResponse
+
+BATCH_MAX = getattr(settings, 'ATTENDANCE_BATCH_MAX', 100)
+COALESCE_WINDOW = getattr(settings, 'ATTENDANCE_COALESCE_MS', 0) / 1000.0
+IDEMPOTENCY_CACHE = getattr(settings, 'ATTENDANCE_IDEMPOTENCY_CACHE', 'default')
+IDEMPOTENCY_TTL = getattr(settings, 'ATTENDANCE_IDEMPOTENCY_TTL', 86400)
+# A claim outlives its request only if the process died mid-request
+IDEMPOTENCY_CLAIM_TTL = 60
+IN_PROGRESS = 'in-progress'
+
+
+class Paid(Exception):
+    """The attendance is a paid ticket; cancelling it here would lose the sale."""
+
+
+def _attend(cursor, user_id, concert_id):
+    cursor.execute("""
+        INSERT INTO band_userconcert
+        (user_id, concert_id, attending, payment_status)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_id, concert_id) DO NOTHING
+    """, [user_id, concert_id, True, 'pending'])
+    return cursor.rowcount
+
+
+def _cancel(cursor, user_id, concert_id):
+    # Paid attendances stay: the ticket goes back through a refund, not here
+    cursor.execute("""
+        DELETE FROM band_userconcert
+        WHERE user_id = %s AND concert_id = %s AND payment_status <> 'completed'
+    """, [user_id, concert_id])
+    return cursor.rowcount
+
+
+def _paid(cursor, user_id, concert_id):
+    cursor.execute("""
+        SELECT 1 FROM band_userconcert
+        WHERE user_id = %s AND concert_id = %s AND payment_status = 'completed'
+    """, [user_id, concert_id])
+    return cursor.fetchone() is not None
+
+
+def set_attendance(user_id, concert_id, attending):
+    """One write either way; repeating a call writes nothing.
+
+    Raises Paid, changing nothing, to cancel a paid attendance.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        if attending:
+            _attend(cursor, user_id, concert_id)
+        elif not _cancel(cursor, user_id, concert_id) and _paid(cursor, user_id, concert_id):
+            raise Paid(concert_id)
+    return attending
+
+
+def toggle(user_id, concert_id):
+    # No SELECT first: whatever the DELETE missed gets inserted. Two racing
+    # toggles both end up attending instead of tripping unique_together; only
+    # a row the DELETE had to leave, a paid one, makes the toggle refuse.
+    with transaction.atomic(), connection.cursor() as cursor:
+        if _cancel(cursor, user_id, concert_id):
+            return False
+        if not _attend(cursor, user_id, concert_id) and _paid(cursor, user_id, concert_id):
+            raise Paid(concert_id)
+    return True
+
+
+def parse_changes(body):
+    """{concert_id: attending} from {"changes": [{"concert_id": 1, "attending": true}, ...]}.
+
+    The last change for a concert wins. Raises ValueError with a message
+    fit for the client.
+    """
+    try:
+        changes = json.loads(body)['changes']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Expected {"changes": [{"concert_id": <int>, "attending": <bool>}, ...]}')
+    if not isinstance(changes, list) or len(changes) > BATCH_MAX:
+        raise ValueError(f'"changes" must be a list of at most {BATCH_MAX} changes')
+    states = {}
+    for change in changes:
+        concert_id = change.get('concert_id') if isinstance(change, dict) else None
+        attending = change.get('attending') if isinstance(change, dict) else None
+        if type(concert_id) is not int or type(attending) is not bool:
+            raise ValueError('Each change needs an integer "concert_id" and a boolean "attending"')
+        states[concert_id] = attending
+    return states
+
+
+def set_many(user_id, states):
+    """Apply parse_changes() output with one lookup, then at most one INSERT
+    and one DELETE. Returns the states applied; unknown concerts are left out,
+    and paid attendances are kept and reported as attending."""
+    if not states:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id FROM band_concert
+            WHERE id IN ({', '.join(['%s'] * len(states))})
+        """, list(states))
+        states = {row[0]: states[row[0]] for row in cursor.fetchall()}
+    attend = [concert_id for concert_id, attending in states.items() if attending]
+    cancel = [concert_id for concert_id, attending in states.items() if not attending]
+    # Read outside the transaction: on SQLite a read that later turns into a
+    # write can't wait for the lock and fails with "database is locked"
+    with transaction.atomic(), connection.cursor() as cursor:
+        if attend:
+            cursor.execute(f"""
+                INSERT INTO band_userconcert
+                (user_id, concert_id, attending, payment_status)
+                VALUES {', '.join(['(%s, %s, %s, %s)'] * len(attend))}
+                ON CONFLICT (user_id, concert_id) DO NOTHING
+            """, [value for concert_id in attend for value in (user_id, concert_id, True, 'pending')])
+        if cancel:
+            cursor.execute(f"""
+                DELETE FROM band_userconcert
+                WHERE user_id = %s AND concert_id IN ({', '.join(['%s'] * len(cancel))})
+                AND payment_status <> 'completed'
+            """, [user_id, *cancel])
+            if cursor.rowcount < len(cancel):
+                cursor.execute(f"""
+                    SELECT concert_id FROM band_userconcert
+                    WHERE user_id = %s AND concert_id IN ({', '.join(['%s'] * len(cancel))})
+                """, [user_id, *cancel])
+                states.update((row[0], True) for row in cursor.fetchall())
+    return {str(concert_id): attending for concert_id, attending in states.items()}
+
+
+class Coalescer:
+    """Collapses set/unset calls for one user and concert that land within
+    `window` seconds of each other into a single write of the last state."""
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self.window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.writes = 0
+
+    def submit(self, user_id, concert_id, attending):
+        key = (user_id, concert_id)
+        with self._lock:
+            self.requests += 1
+            entry = self._pending.get(key)
+            if entry is not None:
+                # Someone is already waiting to write; the latest request wins
+                entry['attending'] = attending
+                leader = False
+            else:
+                entry = self._pending[key] = {'attending': attending, 'future': Future()}
+                leader = True
+        if not leader:
+            return entry['future'].result()
+
+        time.sleep(self.window)
+        with self._lock:
+            del self._pending[key]
+            attending = entry['attending']
+            self.writes += 1
+        try:
+            entry['future'].set_result(set_attendance(user_id, concert_id, attending))
+        except Exception as exc:
+            entry['future'].set_exception(exc)
+        return entry['future'].result()
+
+
+coalescer = Coalescer()
+
+
+def apply(user_id, concert_id, attending):
+    if coalescer.window > 0:
+        return coalescer.submit(user_id, concert_id, attending)
+    return set_attendance(user_id, concert_id, attending)
+
+
+def _key(request, user_id):
+    key = request.headers.get('Idempotency-Key')
+    if not key or request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return None
+    # Bound to the user and the request, so a reused key can't replay another call
+    digest = hashlib.md5(f'{request.method} {request.path} {key}'.encode()).hexdigest()
+    return f'attendance-idempotency:{user_id}:{digest}'
+
+
+def _replay(stored):
+    if stored == IN_PROGRESS:
+        return JsonResponse({'success': False, 'error': 'A request with this Idempotency-Key is in progress'},
+                            status=409)
+    status, content = stored
+    response = HttpResponse(content, status=status, content_type='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _stored(response):
+    # Server errors are worth retrying, so they don't stick to the key
+    if response.status_code >= 500:
+        return None
+    return response.status_code, response.content
+
+
+def idempotent(view):
+    """Replay the first response for a repeated Idempotency-Key header.
+
+    Keys are kept per user in the ATTENDANCE_IDEMPOTENCY_CACHE alias; with
+    several processes that has to be a shared cache.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            user = await request.auser()
+            key = _key(request, user.id) if user.is_authenticated else None
+            if key is None:
+                return await view(request, *args, **kwargs)
+            cache = caches[IDEMPOTENCY_CACHE]
+            if not await cache.aadd(key, IN_PROGRESS, IDEMPOTENCY_CLAIM_TTL):
+                stored = await cache.aget(key)
+                if stored is not None:
+                    return _replay(stored)
+            try:
+                response = await view(request, *args, **kwargs)
+            except Exception:
+                await cache.adelete(key)
+                raise
+            stored = _stored(response)
+            if stored is None:
+                await cache.adelete(key)
+            else:
+                await cache.aset(key, stored, IDEMPOTENCY_TTL)
+            return response
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = _key(request, request.user.id) if request.user.is_authenticated else None
+            if key is None:
+                return view(request, *args, **kwargs)
+            cache = caches[IDEMPOTENCY_CACHE]
+            if not cache.add(key, IN_PROGRESS, IDEMPOTENCY_CLAIM_TTL):
+                stored = cache.get(key)
+                if stored is not None:
+                    return _replay(stored)
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                cache.delete(key)
+                raise
+            stored = _stored(response)
+            if stored is None:
+                cache.delete(key)
+            else:
+                cache.set(key, stored, IDEMPOTENCY_TTL)
+            return response
+    return wrapper
+fastjson.py
+python
+# band/fastjson.py
+import datetime
+import decimal
+import json
+
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:  # pip install orjson; the stdlib encoder writes the same bytes, slower
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            # Raw SQLite rows come back naive, in UTC
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(data):
+    if orjson is not None:
+        # Dates go through _default too, so both encoders agree on the format
+        return orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, default=_default, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+class FastJsonResponse(HttpResponse):
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(dumps(data), **kwargs)
+events.py
+python
+# band/events.py
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+from . import ticket_shards
+
+KEEPALIVE = getattr(settings, 'EVENTS_KEEPALIVE_SECONDS', 15)
+AVAILABILITY = 'availability'
+
+
+class _Topic:
+    """A channel's latest value per key, on one event loop. Only that loop's
+    thread touches it; other threads go through call_soon_threadsafe."""
+
+    def __init__(self, loop, channel, keepalive):
+        self.loop = loop
+        self.channel = channel
+        self.keepalive = keepalive
+        self.seq = 0
+        self.latest = {}  # key -> (seq, data)
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self._since = {}
+        self._timer = None
+
+    def push(self, key, data):
+        if key in self.latest and self.latest[key][1] == data:
+            return
+        self.seq += 1
+        self.latest[key] = (self.seq, data)
+        self._since.clear()
+        self._wake()
+
+    def changes_since(self, seq):
+        # Most subscribers are at the same seq, so they share one list
+        if seq not in self._since:
+            self._since[seq] = [(key, data) for key, (changed, data) in self.latest.items() if changed > seq]
+        return self._since[seq]
+
+    def _wake(self):
+        # Waiters hold the old event; later waits go on a fresh one
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def start_keepalive(self):
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.keepalive, self._tick)
+
+    def _tick(self):
+        # One timer per loop wakes every subscriber, instead of a timeout each
+        self._timer = None
+        if self.subscribers:
+            self._wake()
+            self.start_keepalive()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class Subscription:
+    def __init__(self, broker, topic):
+        self.broker = broker
+        self.topic = topic
+        self.seq = topic.seq
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """[(key, data)] changed since the last call, newest value only; [] on a keepalive tick."""
+        if self.topic.seq == self.seq:
+            await self.topic.changed.wait()
+        changes = self.topic.changes_since(self.seq)
+        self.seq = self.topic.seq
+        return changes
+
+    def close(self):
+        if self.topic is not None:
+            self.broker._unsubscribe(self.topic)
+            self.topic = None
+
+
+class LocalBroker:
+    """In-process fan-out; only subscribers in this process see a message.
+
+    Channels keep the latest value per key, so a subscriber that falls behind
+    skips straight to the newest ticket count instead of queueing every one.
+    """
+
+    def __init__(self, keepalive=KEEPALIVE):
+        self.keepalive = keepalive
+        self._topics = {}  # (loop, channel) -> _Topic
+        self._lock = threading.Lock()
+
+    def publish(self, channel, key, data):
+        # Safe from any thread; each loop applies the message on its own thread
+        with self._lock:
+            topics = [topic for (loop, name), topic in self._topics.items() if name == channel]
+        for topic in topics:
+            try:
+                topic.loop.call_soon_threadsafe(topic.push, key, data)
+            except RuntimeError:
+                # The loop is closed; its subscribers are gone with it
+                self._discard(topic)
+
+    def subscribe(self, channel):
+        """Must be called from the event loop that will read the subscription."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            topic = self._topics.get((loop, channel))
+            if topic is None:
+                topic = self._topics[(loop, channel)] = _Topic(loop, channel, self.keepalive)
+            topic.subscribers += 1
+        topic.start_keepalive()
+        return Subscription(self, topic)
+
+    def subscribers(self):
+        with self._lock:
+            return sum(topic.subscribers for topic in self._topics.values())
+
+    def _unsubscribe(self, topic):
+        with self._lock:
+            topic.subscribers -= 1
+            if topic.subscribers:
+                return
+            self._topics.pop((topic.loop, topic.channel), None)
+        topic.stop()
+
+    def _discard(self, topic):
+        with self._lock:
+            self._topics.pop((topic.loop, topic.channel), None)
+
+
+class CacheBroker:
+    """Stand-in for a shared broker (Redis pub/sub and the like) on a Django
+    cache alias. Publishers write a ring of recent messages; one thread per
+    process polls it and fans out through a LocalBroker. locmem only reaches
+    the current process, memcached or redis reach all of them.
+    """
+
+    RING = 1024
+
+    def __init__(self, alias='default', poll_interval=0.5, keepalive=KEEPALIVE):
+        self.alias = alias
+        self.poll_interval = poll_interval
+        self.local = LocalBroker(keepalive)
+        self._seen = {}  # channel -> last seq fanned out
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def publish(self, channel, key, data):
+        cache = caches[self.alias]
+        cache.add(f'events:{channel}:seq', 0, None)
+        seq = cache.incr(f'events:{channel}:seq')
+        cache.set(f'events:{channel}:{seq % self.RING}', (seq, key, data), None)
+
+    def subscribe(self, channel):
+        with self._lock:
+            if channel not in self._seen:
+                self._seen[channel] = caches[self.alias].get(f'events:{channel}:seq', 0)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-poller', daemon=True)
+                self._thread.start()
+        return self.local.subscribe(channel)
+
+    def subscribers(self):
+        return self.local.subscribers()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                seen = dict(self._seen)
+            for channel, last in seen.items():
+                try:
+                    last = self._poll(channel, last)
+                except Exception:
+                    # Cache unreachable; try again on the next round
+                    continue
+                with self._lock:
+                    self._seen[channel] = last
+
+    def _poll(self, channel, last):
+        cache = caches[self.alias]
+        newest = cache.get(f'events:{channel}:seq', 0)
+        if newest <= last:
+            return last
+        # Messages older than the ring are gone; the newer ones carry the current counts
+        first = max(last + 1, newest - self.RING + 1)
+        keys = {seq: f'events:{channel}:{seq % self.RING}' for seq in range(first, newest + 1)}
+        entries = cache.get_many(list(keys.values()))
+        for seq, key in keys.items():
+            entry = entries.get(key)
+            if entry is None or entry[0] < seq:
+                # Counted but not written yet; pick it up next round
+                break
+            if entry[0] == seq:
+                self.local.publish(channel, entry[1], entry[2])
+            last = seq
+        return last
+
+
+def _build():
+    config = getattr(settings, 'EVENT_BROKER', {})
+    backend = import_string(config.get('BACKEND', 'band.events.LocalBroker'))
+    return backend(**config.get('OPTIONS', {}))
+
+
+broker = _build()
+
+
+def availability_changed(concert_id):
+    """Publish the concert's ticket count once the current transaction commits."""
+    transaction.on_commit(
+        lambda: broker.publish(AVAILABILITY, concert_id, ticket_shards.available(concert_id)))
+waiting_room.py
+python
+# band/waiting_room.py
+import math
+import time
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core import checks, signing
+from django.core.cache import caches
+from django.db import connection
+from django.http import JsonResponse
+from django.shortcuts import render
+
+ENABLED = getattr(settings, 'WAITING_ROOM_ENABLED', True)
+CACHE = getattr(settings, 'WAITING_ROOM_CACHE', 'default')
+ADMIT_RATE = getattr(settings, 'WAITING_ROOM_ADMIT_RATE', 20)
+REFRESH_INTERVAL = getattr(settings, 'WAITING_ROOM_REFRESH_SECONDS', 1.0)
+TOKEN_MAX_AGE = getattr(settings, 'WAITING_ROOM_TOKEN_MAX_AGE', 3600)
+ADMITTED_SECONDS = getattr(settings, 'WAITING_ROOM_ADMITTED_SECONDS', 120)
+SALT = 'band.waiting_room'
+# Each process would keep its own line and let its own stock's worth through
+LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@checks.register(checks.Tags.caches)
+def check_cache(app_configs, **kwargs):
+    alias = getattr(settings, 'WAITING_ROOM_CACHE', 'default')
+    if not getattr(settings, 'WAITING_ROOM_ENABLED', True):
+        return []
+    if alias not in settings.CACHES:
+        return [checks.Error(f"WAITING_ROOM_CACHE {alias!r} is not in CACHES", id='band.E001')]
+    backend = settings.CACHES[alias]['BACKEND']
+    if backend in LOCAL_CACHES and not getattr(settings, 'WAITING_ROOM_SINGLE_PROCESS', False):
+        return [checks.Error(
+            f"WAITING_ROOM_CACHE {alias!r} uses {backend}, which every process keeps to itself",
+            hint="Use a cache all processes share (redis, memcached), or set "
+                 "WAITING_ROOM_SINGLE_PROCESS = True if the site runs in one process.",
+            id='band.E002')]
+    return []
+
+
+def cookie_name(concert_id):
+    return f'queue_{concert_id}'
+
+
+def _keys(concert_id):
+    prefix = f'waiting-room:{concert_id}'
+    return f'{prefix}:epoch', f'{prefix}:tail', f'{prefix}:gate', f'{prefix}:pending'
+
+
+def _capacity(concert_id):
+    """(admit rate, tickets left) for the concert, or None if it doesn't exist."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.admit_rate,
+                   COALESCE((SELECT SUM(s.available) FROM band_ticketshard s
+                             WHERE s.concert_id = c.id), c.available_tickets)
+            FROM band_concert c
+            WHERE c.id = %s
+        """, [concert_id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0] or ADMIT_RATE, max(row[1], 0)
+
+
+def _sign(concert_id, user_id, position, epoch, admitted=False, held=False):
+    return signing.dumps({'c': concert_id, 'u': user_id, 'p': position, 'e': epoch, 'a': admitted, 'h': held},
+                         salt=SALT)
+
+
+def join(concert_id, user_id):
+    """Take the next place in line; returns its signed token."""
+    cache = caches[CACHE]
+    epoch_key, tail_key = _keys(concert_id)[:2]
+    # A new epoch (cache flushed or evicted) sends old tokens to the back
+    cache.add(epoch_key, uuid.uuid4().hex, None)
+    cache.add(tail_key, 0, None)
+    position = cache.incr(tail_key)
+    return _sign(concert_id, user_id, position, cache.get(epoch_key))
+
+
+def read_token(token, concert_id, user_id=None):
+    """The token's fields, or None if it's missing, forged, expired, from an
+    old epoch or for another concert (or user, when `user_id` is given)."""
+    if not token:
+        return None
+    try:
+        ticket = signing.loads(token, salt=SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if ticket.get('c') != concert_id or (user_id is not None and ticket.get('u') != user_id):
+        return None
+    if ticket.get('e') != caches[CACHE].get(_keys(concert_id)[0]):
+        return None
+    return ticket
+
+
+def status(concert_id, position):
+    """Where `position` stands in line. Cache reads only, plus one capacity
+    query per concert every REFRESH_INTERVAL seconds."""
+    cache = caches[CACHE]
+    _, tail_key, gate_key, pending_key = _keys(concert_id)
+    values = cache.get_many([tail_key, gate_key])
+    tail = values.get(tail_key, 0)
+    # The gate lets `rate` places a second through, but no more than the
+    # tickets left at the last refresh less the buyers let through who don't
+    # hold one yet; `recent` is when those were let through
+    frontier, refreshed_at, rate, available, left, recent = values.get(
+        gate_key, (0, 0.0, ADMIT_RATE, 0, 0, ()))
+    now = time.time()
+    # One caller per interval refreshes; the rest read the gate as it stands
+    refresh = now - refreshed_at >= REFRESH_INTERVAL and cache.add(
+        f'{gate_key}:{int(now // REFRESH_INTERVAL)}', 1, math.ceil(REFRESH_INTERVAL * 2))
+    if refresh:
+        capacity = _capacity(concert_id)
+        if capacity is None:
+            # No such concert; the view answers with its 404
+            return {'state': 'admitted', 'position': position}
+        rate, left = capacity
+        # Buyers who haven't held a ticket within ADMITTED_SECONDS stop counting
+        recent = tuple((at, count) for at, count in recent if now - at < ADMITTED_SECONDS)
+        pending = min(max(cache.get(pending_key, 0), 0), sum(count for _, count in recent))
+        cache.set(pending_key, pending, None)
+        available = max(left - pending, 0)
+    # At most one interval of credit, so a quiet spell doesn't bank a burst
+    elapsed = min(now - refreshed_at, REFRESH_INTERVAL)
+    admitted = min(tail, frontier + available, frontier + int(rate * elapsed))
+    if refresh:
+        let_through = admitted - frontier
+        if let_through:
+            recent += ((now, let_through),)
+            cache.incr(pending_key, let_through)
+        cache.set(gate_key, (admitted, now, rate, available - let_through, left, recent), None)
+
+    if position <= admitted:
+        return {'state': 'admitted', 'position': position}
+    ahead = position - admitted - 1
+    wait = math.ceil((ahead + 1) / rate) if rate else None
+    if left <= 0:
+        # Only expired holds can move the line now
+        return {'state': 'sold_out', 'position': position, 'ahead': ahead, 'retry_after': 30}
+    return {
+        'state': 'waiting',
+        'position': position,
+        'ahead': ahead,
+        'estimated_wait': wait,
+        'retry_after': min(30, max(1, (wait or 60) // 2)),
+    }
+
+
+def admit(ticket):
+    """status() for a read_token() ticket, and a new token to hand out if
+    this check let it through (None otherwise)."""
+    if ticket['a']:
+        return {'state': 'admitted', 'position': ticket['p']}, None
+    place = status(ticket['c'], ticket['p'])
+    if place['state'] != 'admitted':
+        return place, None
+    # Once through, stay through, even if the gate tightens afterwards
+    return place, _sign(ticket['c'], ticket['u'], ticket['p'], ticket['e'], admitted=True)
+
+
+def held(request, concert_id):
+    """Call once the admitted buyer making `request` holds a ticket, so they
+    stop counting against stock as let through but not yet holding."""
+    ticket = getattr(request, 'waiting_room_ticket', None)
+    if ticket is None or ticket.get('h'):
+        return
+    try:
+        caches[CACHE].decr(_keys(concert_id)[3])
+    except ValueError:
+        # Gate state was flushed along with the count
+        pass
+    ticket['h'] = True
+
+
+def set_token(request, response, concert_id, token):
+    response.set_cookie(cookie_name(concert_id), token, max_age=TOKEN_MAX_AGE, httponly=True,
+                        samesite='Lax', secure=request.is_secure())
+
+
+def gate(view):
+    """Queue callers of a `concert_id` view; only admitted places reach it.
+
+    Everyone else gets a small page that polls band.views.queue_status,
+    so the view's queries and ticket holds only run for admitted buyers.
+    Other methods than GET and HEAD get a 503 with their place instead.
+    """
+    @wraps(view)
+    def wrapper(request, concert_id, *args, **kwargs):
+        if not ENABLED:
+            return view(request, concert_id, *args, **kwargs)
+        token = request.COOKIES.get(cookie_name(concert_id))
+        ticket = read_token(token, concert_id, request.user.id)
+        if ticket is None:
+            token = join(concert_id, request.user.id)
+            ticket = read_token(token, concert_id)
+
+        place, admitted_token = admit(ticket)
+        if place['state'] == 'admitted':
+            # For held(); a changed 'h' goes back out in the token
+            request.waiting_room_ticket = dict(ticket, a=True)
+            response = view(request, concert_id, *args, **kwargs)
+            if request.waiting_room_ticket.get('h') and not ticket.get('h'):
+                admitted_token = _sign(ticket['c'], ticket['u'], ticket['p'], ticket['e'], admitted=True, held=True)
+        else:
+            if request.method in ('GET', 'HEAD'):
+                response = render(request, 'band/waiting_room.html', dict(place, concert_id=concert_id))
+            else:
+                # Not let through (the place expired, or the line was lost): the
+                # view didn't run, and a 200 would pass for a payment taken
+                response = JsonResponse(place, status=503)
+            response.headers['Retry-After'] = str(place['retry_after'])
+            response.headers['Cache-Control'] = 'no-store'
+        token = admitted_token or token
+        if request.COOKIES.get(cookie_name(concert_id)) != token:
+            set_token(request, response, concert_id, token)
+        return response
+    return wrapper
+ratelimit.py
+python
+# band/ratelimit.py
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+from django.utils.module_loading import import_string
+from . import metrics
+
+ENABLED = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+# Behind a proxy REMOTE_ADDR is the proxy; name the header it puts the client in
+CLIENT_IP_HEADER = getattr(settings, 'RATE_LIMIT_CLIENT_IP_HEADER', None)
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+Rule = namedtuple('Rule', 'key count period')
+
+
+def parse(rule):
+    """'user:30/m' -> Rule('user', 30, 60). Keys are 'ip' and 'user'; anonymous
+    users count against their IP."""
+    key, _, rate = rule.partition(':')
+    count, _, period = rate.partition('/')
+    if key not in ('ip', 'user') or period not in PERIODS:
+        raise ValueError(f"Bad rate limit {rule!r}; expected e.g. 'ip:10/m' or 'user:100/h'")
+    return Rule(key, int(count), PERIODS[period])
+
+
+class LocalStore:
+    """Sliding-window counters for this process.
+
+    Each key keeps two fixed windows; the previous one counts in proportion
+    to how much of it still overlaps the sliding window.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._windows = OrderedDict()  # key -> [window start, this window, previous window]
+        self._lock = threading.Lock()
+
+    def hit(self, key, period, now=None):
+        """Count one request; returns the sliding-window total including it."""
+        now = time.time() if now is None else now
+        start = now - now % period
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or entry[0] < start - period:
+                entry = self._windows[key] = [start, 0, 0]
+            elif entry[0] < start:
+                entry[:] = [start, 0, entry[1]]
+            entry[1] += 1
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+            return entry[1] + entry[2] * (1 - (now - start) / period)
+
+
+class SharedStore:
+    """Counters in a Django cache alias (memcached, redis), so every process
+    shares the limit; locmem works as a local stand-in."""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    def hit(self, key, period, now=None):
+        now = time.time() if now is None else now
+        window = int(now // period)
+        cache = caches[self.alias]
+        current = f'ratelimit:{key}:{window}'
+        cache.add(current, 0, period * 2)
+        try:
+            count = cache.incr(current)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(current, 1, period * 2)
+            count = 1
+        previous = cache.get(f'ratelimit:{key}:{window - 1}', 0)
+        return count + previous * (1 - (now % period) / period)
+
+
+def _build():
+    config = getattr(settings, 'RATE_LIMIT_STORE', {})
+    backend = import_string(config.get('BACKEND', 'band.ratelimit.LocalStore'))
+    return backend(**config.get('OPTIONS', {}))
+
+
+store = _build()
+
+
+def client_ip(request):
+    if CLIENT_IP_HEADER:
+        forwarded = request.headers.get(CLIENT_IP_HEADER)
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _check(request, user, name, rules):
+    """None if the request may go ahead, else the 429 response."""
+    now = time.time()
+    for rule in rules:
+        if rule.key == 'user' and user is not None and user.is_authenticated:
+            ident = f'user:{user.pk}'
+        else:
+            ident = f'ip:{client_ip(request)}'
+        if store.hit(f'{name}:{ident}:{rule.period}', rule.period, now) > rule.count:
+            metrics.RATE_LIMITED.inc(name, rule.key)
+            retry_after = max(1, math.ceil(rule.period - now % rule.period))
+            message = f'Too many requests; try again in {retry_after} seconds'
+            if 'json' in request.headers.get('Accept', '') or 'json' in request.content_type:
+                response = JsonResponse({'success': False, 'error': message}, status=429)
+            else:
+                response = HttpResponse(message, status=429, content_type='text/plain; charset=utf-8')
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+    return None
+
+
+def limit(name, *rules):
+    """Throttle a view with rules like 'ip:10/m'; `name` keys its counters
+    and labels band_rate_limited_total."""
+    rules = [parse(rule) for rule in rules]
+    by_user = any(rule.key == 'user' for rule in rules)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if ENABLED:
+                    user = await request.auser() if by_user else None
+                    rejected = _check(request, user, name, rules)
+                    if rejected is not None:
+                        return rejected
+                return await view(request, *args, **kwargs)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if ENABLED:
+                    rejected = _check(request, request.user if by_user else None, name, rules)
+                    if rejected is not None:
+                        return rejected
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def apply(urlpatterns, limits):
+    """Wrap the named patterns in `limits` ({url name: [rule, ...]}) with
+    limit(). settings.RATE_LIMITS entries replace them by name; [] lifts one."""
+    limits = dict(limits, **getattr(settings, 'RATE_LIMITS', {}))
+    for pattern in urlpatterns:
+        rules = limits.get(getattr(pattern, 'name', None))
+        if rules:
+            pattern.callback = limit(pattern.name, *rules)(pattern.callback)
+    return urlpatterns
+hashing.py
+python
+# band/hashing.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import backends, get_user_model, hashers
+from django.core.exceptions import PermissionDenied
+from . import metrics
+
+# hashlib and argon2 drop the GIL while hashing, so each worker keeps one core busy
+WORKERS = getattr(settings, 'PASSWORD_HASHING_WORKERS', 2)
+MAX_WAITING = getattr(settings, 'PASSWORD_HASHING_MAX_WAITING', 64)
+ARGON2 = getattr(settings, 'PASSWORD_ARGON2', {})
+
+
+class Busy(Exception):
+    """More hashes are waiting than PASSWORD_HASHING_MAX_WAITING."""
+
+
+_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='band-hashing')
+_slots = threading.BoundedSemaphore(WORKERS + MAX_WAITING)
+_lock = threading.Lock()
+_in_flight = 0
+
+
+def _count(delta):
+    global _in_flight
+    with _lock:
+        _in_flight += delta
+
+
+def saturated():
+    """True while every worker has a hash; another one would have to queue."""
+    return _in_flight >= WORKERS
+
+
+def _done(future):
+    _count(-1)
+    _slots.release()
+
+
+def run(fn, *args):
+    """Run fn on the hashing pool and wait for it; raises Busy rather than
+    queueing without bound. fn must not touch the database: the pool threads
+    have no request and would each hold a connection open."""
+    if not _slots.acquire(blocking=False):
+        metrics.HASHING_REJECTED.inc()
+        raise Busy()
+    _count(1)
+    try:
+        future = _pool.submit(fn, *args)
+    except BaseException:
+        _done(None)
+        raise
+    future.add_done_callback(_done)
+    return future.result()
+
+
+def make_password(password):
+    return run(hashers.make_password, password)
+
+
+def describe():
+    """What a benchmark should record next to its login numbers."""
+    hasher = hashers.get_hasher()
+    cost = {name: getattr(hasher, name) for name in ('iterations', 'time_cost', 'memory_cost', 'parallelism')
+            if hasattr(hasher, name)}
+    return {'hasher': hasher.algorithm, 'cost': cost, 'hashing_workers': WORKERS}
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """Django's PBKDF2 with PASSWORD_PBKDF2_ITERATIONS. Stored hashes move to
+    the configured count at their next login, in either direction."""
+    iterations = getattr(settings, 'PASSWORD_PBKDF2_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """Django's Argon2 (needs argon2-cffi) with costs from PASSWORD_ARGON2."""
+    time_cost = ARGON2.get('time_cost', hashers.Argon2PasswordHasher.time_cost)
+    memory_cost = ARGON2.get('memory_cost', hashers.Argon2PasswordHasher.memory_cost)
+    parallelism = ARGON2.get('parallelism', hashers.Argon2PasswordHasher.parallelism)
+
+
+class ModelBackend(backends.ModelBackend):
+    """ModelBackend with the password check on the hashing pool. The user is
+    looked up, and an outdated hash re-saved, on the request thread.
+
+    A full pool raises PermissionDenied, which authenticate() turns into a
+    failed login for every caller, the admin's included; request.hashing_busy
+    lets band's own login page answer 503 instead.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        try:
+            return self._authenticate(username, password, **kwargs)
+        except Busy:
+            if request is not None:
+                request.hashing_busy = True
+            raise PermissionDenied('Too many password checks waiting')
+
+    def _authenticate(self, username, password, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash anyway, so a missing username takes as long as a wrong password
+            make_password(password)
+            return None
+        outdated = []
+        if not run(hashers.check_password, password, user.password, outdated.append):
+            return None
+        # Upgrading costs a second hash; during a rush it waits for a later login
+        if outdated and not saturated():
+            try:
+                user.password = make_password(password)
+            except Busy:
+                pass
+            else:
+                user.save(update_fields=['password'])
+        return user if self.user_can_authenticate(user) else None
+stats.py
+python
+# band/stats.py
+from django.db import connections, transaction
+from django.utils import timezone
+from .models import Concert
+
+# band_concertstats column -> which band_userconcert rows it counts
+COUNTS = {
+    'attendees': '{row}.attending',
+    'paid': "{row}.payment_status = 'completed'",
+    'pending_payments': "{row}.payment_status = 'pending'",
+}
+
+
+def _flags(row):
+    return ', '.join(f'CASE WHEN {condition.format(row=row)} THEN 1 ELSE 0 END' for condition in COUNTS.values())
+
+
+# Run inside the writing statement's transaction, so stats commit or roll back with it.
+# Only the add upserts: a delete cascading from band_concert mustn't recreate the row
+ADD = f"""
+    INSERT INTO band_concertstats (concert_id, {', '.join(COUNTS)})
+    VALUES (new.concert_id, {_flags('new')})
+    ON CONFLICT (concert_id) DO UPDATE SET
+        {', '.join(f'{column} = band_concertstats.{column} + excluded.{column}' for column in COUNTS)};
+"""
+SUBTRACT = f"""
+    UPDATE band_concertstats SET
+        {', '.join(f'{column} = {column} - CASE WHEN {condition.format(row="old")} THEN 1 ELSE 0 END'
+                   for column, condition in COUNTS.items())}
+    WHERE concert_id = old.concert_id;
+"""
+TRACKED = 'concert_id, attending, payment_status'
+# A new concert gets its zero row straight away, not at its first band_userconcert row
+CREATE = f"""
+    INSERT INTO band_concertstats (concert_id, {', '.join(COUNTS)})
+    VALUES (new.id, {', '.join(['0'] * len(COUNTS))})
+    ON CONFLICT (concert_id) DO NOTHING;
+"""
+
+SQLITE_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS band_concertstats_create AFTER INSERT ON band_concert BEGIN {CREATE} END",
+    f"CREATE TRIGGER IF NOT EXISTS band_concertstats_ai AFTER INSERT ON band_userconcert BEGIN {ADD} END",
+    f"CREATE TRIGGER IF NOT EXISTS band_concertstats_ad AFTER DELETE ON band_userconcert BEGIN {SUBTRACT} END",
+    f"""CREATE TRIGGER IF NOT EXISTS band_concertstats_au AFTER UPDATE OF {TRACKED} ON band_userconcert
+        BEGIN {SUBTRACT} {ADD} END""",
+]
+
+POSTGRES_TRIGGERS = [
+    f"""
+    CREATE OR REPLACE FUNCTION band_concertstats_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN {SUBTRACT} END IF;
+        IF TG_OP <> 'DELETE' THEN {ADD} END IF;
+        RETURN NULL;
+    END $$
+    """,
+    "DROP TRIGGER IF EXISTS band_concertstats_sync ON band_userconcert",
+    f"""
+    CREATE TRIGGER band_concertstats_sync
+    AFTER INSERT OR DELETE OR UPDATE OF {TRACKED} ON band_userconcert
+    FOR EACH ROW EXECUTE FUNCTION band_concertstats_sync()
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION band_concertstats_create() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        {CREATE}
+        RETURN NULL;
+    END $$
+    """,
+    "DROP TRIGGER IF EXISTS band_concertstats_create ON band_concert",
+    """
+    CREATE TRIGGER band_concertstats_create
+    AFTER INSERT ON band_concert
+    FOR EACH ROW EXECUTE FUNCTION band_concertstats_create()
+    """,
+]
+
+RECOUNT = f"""
+    SELECT c.id, {', '.join(f'COALESCE(SUM(CASE WHEN {condition.format(row="uc")} THEN 1 ELSE 0 END), 0)'
+                           for condition in COUNTS.values())}
+    FROM band_concert c
+    LEFT JOIN band_userconcert uc ON uc.concert_id = c.id
+    GROUP BY c.id
+"""
+
+
+def install(using='default'):
+    """Reinstall the triggers and recount; manage.py reconcile_concert_stats.
+
+    Migration 0011 creates them; this repairs a database where they were
+    lost, e.g. to a later migration that rebuilds band_userconcert on SQLite.
+    """
+    connection = connections[using]
+    statements = POSTGRES_TRIGGERS if connection.vendor == 'postgresql' else SQLITE_TRIGGERS
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    return rebuild(using)
+
+
+def rebuild(using='default', dry_run=False):
+    """Recount every concert from band_userconcert in one pass.
+
+    Returns [(concert_id, stored, recounted)] for the concerts whose stats
+    had drifted; with dry_run nothing is written.
+    """
+    connection = connections[using]
+    connection.ensure_connection()
+    outermost = not connection.in_atomic_block
+    mode = getattr(connection, 'transaction_mode', None)
+    if connection.vendor == 'sqlite' and not dry_run:
+        # Writers wait for the recount rather than racing it. A deferred BEGIN
+        # would read first and then fail to upgrade to the write lock with
+        # "database is locked" if anyone wrote meanwhile; IMMEDIATE takes it up front
+        connection.transaction_mode = 'IMMEDIATE'
+    try:
+        with transaction.atomic(using), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                if not dry_run:
+                    cursor.execute('LOCK TABLE band_userconcert IN SHARE MODE')
+                elif outermost:
+                    # A dry run locks nothing, but compares both reads from one snapshot
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute(f"SELECT concert_id, {', '.join(COUNTS)} FROM band_concertstats")
+            stored = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+            cursor.execute(RECOUNT)
+            counts = cursor.fetchall()
+            if not dry_run:
+                cursor.execute('DELETE FROM band_concertstats')
+                cursor.executemany(
+                    f"INSERT INTO band_concertstats (concert_id, {', '.join(COUNTS)}) "
+                    f"VALUES ({', '.join(['%s'] * (len(COUNTS) + 1))})",
+                    counts)
+    finally:
+        if connection.vendor == 'sqlite':
+            connection.transaction_mode = mode
+    zero = (0,) * len(COUNTS)
+    return [(row[0], stored.get(row[0], zero), tuple(row[1:]))
+            for row in counts if stored.get(row[0], zero) != tuple(row[1:])]
+
+
+def report(upcoming=False):
+    """Every concert, in date order, with its stats; no aggregate over band_userconcert."""
+    concerts = Concert.objects.order_by('date', 'id')
+    if upcoming:
+        concerts = concerts.filter(date__gte=timezone.now())
+    rows = []
+    for row in concerts.values('id', 'name', 'location', 'date', 'price', 'stats__attendees',
+                               'stats__paid', 'stats__pending_payments'):
+        paid = row.pop('stats__paid') or 0
+        rows.append(dict(row, attendees=row.pop('stats__attendees') or 0, paid=paid,
+                         pending_payments=row.pop('stats__pending_payments') or 0, revenue=row['price'] * paid))
+    return rows
+urls.py (app)
+python
+# band/urls.py
+from django.conf import settings
+from django.urls import path
+from . import ratelimit, views
+
+# Under ASGI the read views and the attendance toggle have async versions
+read_views = views
+if settings.BAND_ASYNC_VIEWS:
+    from . import async_views as read_views
+
+urlpatterns = [
+    path('', views.home, name='home'),
+    path('songs/', read_views.songs, name='songs'),
+    path('photos/', read_views.photos, name='photos'),
+    path('api/songs/', read_views.api_songs, name='api_songs'),
+    path('api/photos/', read_views.api_photos, name='api_photos'),
+    path('search/', views.song_search, name='search'),
+    path('api/search/', views.api_search, name='api_search'),
+    path('concerts/', read_views.concerts, name='concerts'),
+    path('api/concerts/', read_views.api_concerts, name='api_concerts'),
+    path('api/attendance/', read_views.api_attendance, name='api_attendance'),
+    path('concert/<int:concert_id>/toggle/', read_views.toggle_attendance, name='toggle_attendance'),
+    path('concert/<int:concert_id>/attendance/', read_views.set_attendance, name='attendance'),
+    path('concert/<int:concert_id>/payment/', views.payment, name='payment'),
+    path('concert/<int:concert_id>/queue/', views.queue_status, name='queue_status'),
+    path('login/', views.user_login, name='login'),
+    path('logout/', views.user_logout, name='logout'),
+    path('register/', views.register, name='register'),
+    path('cache/stats/', views.cache_stats, name='cache_stats'),
+    path('db/pool/', views.db_pool_stats, name='db_pool_stats'),
+    path('reports/concerts/', views.concert_report, name='concert_report'),
+    path('metrics/', views.metrics_export, name='metrics'),
+]
+
+# An open event stream needs the event loop; under WSGI each one would pin a
+# worker thread, so concerts.js falls back to polling /api/concerts/ there
+if settings.BAND_ASYNC_VIEWS:
+    urlpatterns.append(path('concerts/events/', read_views.concert_events, name='concert_events'))
+
+# Requests allowed per client: 'ip', or 'user' (anonymous users count by IP),
+# then count/s|m|h|d. Everything that writes or checks a password is covered;
+# settings.RATE_LIMITS replaces entries by name
+RATE_LIMITS = {
+    'login': ['ip:10/m', 'ip:100/h'],
+    'register': ['ip:5/m', 'ip:20/h'],
+    'toggle_attendance': ['user:30/m'],
+    'attendance': ['user:30/m'],
+    'api_attendance': ['user:30/m'],
+    'payment': ['user:20/m', 'ip:100/m'],
+}
+urlpatterns = ratelimit.apply(urlpatterns, RATE_LIMITS)
+urls.py (project)
+python
+# band_website/urls.py
+from django.contrib import admin
+from django.urls import path, include
+from django.conf import settings
+from django.conf.urls.static import static
+from band import assets
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('', include('band.urls')),
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+if not settings.DEBUG:
+    # Collected assets with far-future headers; a front-end server can serve
+    # STATIC_ROOT directly instead (gzip_static / brotli_static find the siblings)
+    urlpatterns += [path(settings.STATIC_URL.lstrip('/') + '<path:path>', assets.serve)]
+asgi.py
+python
+# band_website/asgi.py
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'band_website.settings')
+# band/urls.py routes the read views to band.async_views under ASGI
+os.environ.setdefault('BAND_ASYNC_VIEWS', '1')
+
+application = get_asgi_application()
+HTML Templates
+base.html
+html
+{% load cache static %}
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{% block title %}Band Website{% endblock %}</title>
+    <link rel="stylesheet" href="{% static 'band/css/site.css' %}">
+</head>
+<body>
+    <header>
+        <h1>Our Awesome Band</h1>
+    </header>
+    <nav>
+        {% cache None base_nav using="fragments" %}
+        <a href="{% url 'home' %}">Home</a>
+        <a href="{% url 'songs' %}">Songs</a>
+        <a href="{% url 'photos' %}">Photos</a>
+        <a href="{% url 'concerts' %}">Concerts</a>
+        <a href="{% url 'search' %}">Search</a>
+        {% endcache %}
+        <div class="auth-links">
+            {% if user.is_authenticated %}
+                <span>Hello, {{ user.username }}!</span>
+                <a href="{% url 'logout' %}">Logout</a>
+            {% else %}
+                <a href="{% url 'login' %}">Login</a>
+                <a href="{% url 'register' %}">Register</a>
+            {% endif %}
+        </div>
+    </nav>
+    <div class="container">
+        {% if messages %}
+        <div class="messages">
+            {% for message in messages %}
+                <div class="{{ message.tags }}">{{ message }}</div>
+            {% endfor %}
+        </div>
+        {% endif %}
+        
+        {% block content %}
+        {% endblock %}
+    </div>
+</body>
+</html>
+home.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Home - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Welcome to Our Band Website!</h2>
+    <p>We are an awesome band that plays great music. Check out our songs, photos, and upcoming concerts!</p>
+    
+    <h3>Latest News</h3>
+    <p>Our new album is coming out soon! Stay tuned for updates.</p>
+{% endblock %}
+songs.html
+html
+Run
+{% extends 'band/base.html' %}
+{% load static %}
+
+{% block title %}Songs - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Our Songs</h2>
+    
+    <table>
+        <thead>
+            <tr>
+                <th>Title</th>
+                <th>Duration</th>
+                <th>Release Date</th>
+            </tr>
+        </thead>
+        <tbody id="song-rows">
+            {% if stream %}<!--stream-rows-->{% endif %}
+            {% for song in songs %}
+                {% include 'band/song_row.html' %}
+            {% endfor %}
+        </tbody>
+    </table>
+    
+    {% if next_cursor %}
+        <a id="load-more" href="?after={{ next_cursor }}"
+           data-api="{% url 'api_songs' %}" data-after="{{ next_cursor }}">Older songs</a>
+    {% endif %}
+    
+    <script src="{% static 'band/js/songs.js' %}" defer></script>
+{% endblock %}
+song_row.html
+html
+Run
+{% load cache %}
+{% cache None song_row song.id song.version using="fragments" %}
+<tr>
+    <td>{{ song.title }}</td>
+    <td>{{ song.duration }}</td>
+    <td>{{ song.release_date }}</td>
+</tr>
+{% endcache %}
+photos.html
+html
+Run
+{% extends 'band/base.html' %}
+{% load static %}
+
+{% block title %}Photos - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Photo Gallery</h2>
+    
+    <div class="photo-grid" id="photo-grid">
+        {% if stream %}<!--stream-rows-->{% endif %}
+        {% for photo in photos %}
+            {% include 'band/photo_row.html' %}
+        {% endfor %}
+    </div>
+    
+    {% if next_cursor %}
+        <a id="load-more" href="?after={{ next_cursor }}"
+           data-api="{% url 'api_photos' %}" data-after="{{ next_cursor }}">Older photos</a>
+    {% endif %}
+    
+    <script src="{% static 'band/js/photos.js' %}" defer></script>
+{% endblock %}
+photo_row.html
+html
+Run
+{% load cache %}
+{% cache None photo_row photo.id photo.version using="fragments" %}
+<div class="photo-item">
+    <picture>
+        {% if photo.srcset_webp %}<source type="image/webp" srcset="{{ photo.srcset_webp }}" sizes="300px">{% endif %}
+        <img src="{{ photo.src }}" {% if photo.srcset %}srcset="{{ photo.srcset }}" sizes="300px"{% endif %}
+             alt="{{ photo.title }}" width="300" loading="lazy">
+    </picture>
+    <h3>{{ photo.title }}</h3>
+    <p>{{ photo.event_date }}</p>
+    <p>{{ photo.description }}</p>
+</div>
+{% endcache %}
+concerts.html
+html
+Run
+{% extends 'band/base.html' %}
+{% load static %}
+
+{% block title %}Concerts - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Upcoming Concerts</h2>
+    
+    <div class="concert-list">
+        {% for concert in concerts %}
+        <div class="concert-item" data-concert-id="{{ concert.id }}">
+            <h3>{{ concert.name }}</h3>
+            <p>Location: {{ concert.location }}</p>
+            <p>Date: {{ concert.date }}</p>
+            <p>Price: ${{ concert.price }}</p>
+            <p>Tickets available: <span class="tickets-available">{{ concert.available_tickets }}</span></p>
+            
+            {% if user.is_authenticated %}
+                <button class="toggle-attendance" 
+                        data-concert-id="{{ concert.id }}"
+                        data-attending="{{ concert.is_attending|yesno:'true,false' }}">
+                    {% if concert.is_attending %}
+                        Cancel Attendance
+                    {% else %}
+                        Attend Concert
+                    {% endif %}
+                </button>
+                
+                {% if concert.is_attending and concert.payment_status == 'pending' %}
+                    <a href="{% url 'payment' concert.id %}" class="payment-button">Complete Payment</a>
+                {% endif %}
+            {% else %}
+                <p><a href="{% url 'login' %}">Login</a> to attend this concert</p>
+            {% endif %}
+        </div>
+        {% endfor %}
+    </div>
+    
+    {% url 'concert_events' as events_url %}
+    <script src="{% static 'band/js/concerts.js' %}" data-csrf-token="{{ csrf_token }}" data-events-url="{{ events_url }}" defer></script>
+{% endblock %}
+login.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Login - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Login</h2>
+    
+    {% if error %}
+        <p class="error">{{ error }}</p>
+    {% endif %}
+    
+    <form method="post">
+        {% csrf_token %}
+        <div>
+            <label for="username">Username:</label>
+            <input type="text" id="username" name="username" required>
+        </div>
+        <div>
+            <label for="password">Password:</label>
+            <input type="password" id="password" name="password" required>
+        </div>
+        <button type="submit">Login</button>
+    </form>
+    
+    <p>Don't have an account? <a href="{% url 'register' %}">Register here</a></p>
+{% endblock %}
+register.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Register - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Register</h2>
+    
+    <form method="post">
+        {% csrf_token %}
+        <div>
+            <label for="username">Username:</label>
+            <input type="text" id="username" name="username" required>
+        </div>
+        <div>
+            <label for="email">Email:</label>
+            <input type="email" id="email" name="email" required>
+        </div>
+        <div>
+            <label for="password">Password:</label>
+            <input type="password" id="password" name="password" required>
         </div>
         <button type="submit">Register</button>
     </form>
     
-    <p>Already have an account? <a href="{% url 'login' %}">Login here</a></p>
+    <p>Already have an account? <a href="{% url 'login' %}">Login here</a></p>
+{% endblock %}
+payment.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Payment - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Complete Payment for {{ concert.name }}</h2>
+    <p>Amount: ${{ concert.price }}</p>
+    {% if hold %}
+    <p>Your ticket is held until {{ hold.expires_at|time:"H:i" }}.</p>
+    {% endif %}
+    
+    <div id="google-pay-button"></div>
+    
+    <script src="https://pay.google.com/gp/p/js/pay.js"></script>
+    <script>
+        const paymentRequest = {{ payment_request|safe }};
+        const paymentsClient = new google.payments.api.PaymentsClient({
+            environment: '{{ google_pay_environment|lower }}'
+        });
+        
+        function onGooglePayLoaded() {
+            paymentsClient.isReadyToPay({
+                apiVersion: 2,
+                apiVersionMinor: 0,
+                allowedPaymentMethods: paymentRequest.allowedPaymentMethods
+            }).then(function(response) {
+                if (response.result) {
+                    addGooglePayButton();
+                }
+            }).catch(function(err) {
+                console.error('Error checking Google Pay readiness:', err);
+            });
+        }
+        
+        function addGooglePayButton() {
+            const button = paymentsClient.createButton({
+                onClick: onGooglePaymentButtonClicked,
+                buttonColor: 'black',
+                buttonType: 'pay'
+            });
+            document.getElementById('google-pay-button').appendChild(button);
+        }
+        
+        function onGooglePaymentButtonClicked() {
+            paymentsClient.loadPaymentData(paymentRequest).then(function(paymentData) {
+                processPayment(paymentData);
+            }).catch(function(err) {
+                console.error('Error loading payment data:', err);
+            });
+        }
+        
+        function processPayment(paymentData) {
+            const paymentToken = paymentData.paymentMethodData.tokenizationData.token;
+            
+            fetch(window.location.href, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'X-CSRFToken': '{{ csrf_token }}'
+                },
+                body: `payment_token=${encodeURIComponent(paymentToken)}`
+            }).then(response => {
+                if (response.ok) {
+                    window.location.href = "{% url 'concerts' %}";
+                } else if (response.status === 503) {
+                    // Not let through the waiting room; nothing was held or charged
+                    alert('Your place in line has expired and no payment was taken. Taking you back to the line.');
+                    window.location.reload();
+                } else {
+                    alert('Payment processing failed');
+                }
+            }).catch(error => {
+                console.error('Error:', error);
+                alert('Payment processing failed');
+            });
+        }
+        
+        window.onGooglePayLoaded = onGooglePayLoaded;
+    </script>
+    <script async src="https://pay.google.com/gp/p/js/pay.js" onload="onGooglePayLoaded()"></script>
+{% endblock %}
+payment_success.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Payment Successful - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Payment Received!</h2>
+    <p>Thank you for purchasing tickets to {{ concert.name }}.</p>
+    <p>We're confirming your payment now. Your ticket is held for you, and you'll get an email once it's confirmed.</p>
+    <p><a href="{% url 'concerts' %}">Back to concerts</a></p>
+{% endblock %}
+search.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Search - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Search Songs</h2>
+    
+    <form method="get" action="{% url 'search' %}">
+        <input type="search" name="q" value="{{ query }}" placeholder="Title or lyrics" autofocus>
+        <button type="submit">Search</button>
+    </form>
+    
+    {% if query %}
+        {% for song in results %}
+        <div class="search-result">
+            <h3>{{ song.title }}</h3>
+            <p>{{ song.duration }} &middot; {{ song.release_date }}</p>
+            {% if song.excerpt %}<p>{{ song.excerpt }}</p>{% endif %}
+        </div>
+        {% empty %}
+            <p>No songs match "{{ query }}".</p>
+        {% endfor %}
+        
+        {% if page > 1 %}
+            <a href="?q={{ query|urlencode }}&page={{ page|add:'-1' }}">Previous</a>
+        {% endif %}
+        {% if has_next %}
+            <a href="?q={{ query|urlencode }}&page={{ page|add:'1' }}">Next</a>
+        {% endif %}
+    {% endif %}
 {% endblock %}
-payment.html
+sold_out.html
+html
+Run
+{% extends 'band/base.html' %}
+
+{% block title %}Sold Out - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>Sold Out</h2>
+    <p>Sorry, there are no tickets left for {{ concert.name }}.</p>
+    <p><a href="{% url 'concerts' %}">Back to concerts</a></p>
+{% endblock %}
+waiting_room.html
 html
 Run
 {% extends 'band/base.html' %}
+{% load static %}
+
+{% block title %}Waiting Room - Our Awesome Band{% endblock %}
+
+{% block content %}
+    <h2>You're in line</h2>
+    <div id="waiting-room" data-status-url="{% url 'queue_status' concert_id %}" data-retry-after="{{ retry_after }}">
+        {% if state == 'sold_out' %}
+            <p class="queue-state">Every remaining ticket is being bought right now. Keep this page open: if any are released, the line moves again.</p>
+        {% else %}
+            <p class="queue-state">{{ ahead }} buyer{{ ahead|pluralize }} ahead of you, about {{ estimated_wait }}s to go.</p>
+        {% endif %}
+        <p>This page moves on to payment when it's your turn. Reloading keeps your place.</p>
+    </div>
+    <script src="{% static 'band/js/waiting_room.js' %}" defer></script>
+{% endblock %}
+Static Files
+site.css
+css
+/* band/static/band/css/site.css */
+body {
+    font-family: Arial, sans-serif;
+    margin: 0;
+    padding: 0;
+    line-height: 1.6;
+}
+header {
+    background: #333;
+    color: #fff;
+    padding: 1rem 0;
+    text-align: center;
+}
+nav {
+    background: #444;
+    padding: 0.5rem;
+}
+nav a {
+    color: #fff;
+    text-decoration: none;
+    padding: 0.5rem 1rem;
+}
+nav a:hover {
+    background: #555;
+}
+.container {
+    width: 80%;
+    margin: auto;
+    padding: 2rem 0;
+}
+.auth-links {
+    float: right;
+}
+.messages {
+    padding: 1rem;
+    margin: 1rem 0;
+    background: #f4f4f4;
+}
+.error {
+    color: red;
+}
+.success {
+    color: green;
+}
+songs.js
+javascript
+// band/static/band/js/songs.js
+// Infinite scroll: fetch the next page when the "Older songs" link comes into view
+const loadMore = document.getElementById('load-more');
+if (loadMore) {
+    let loading = false;
+    new IntersectionObserver(async entries => {
+        if (!entries[0].isIntersecting || loading || !loadMore.dataset.after) return;
+        loading = true;
+        const response = await fetch(`${loadMore.dataset.api}?after=${loadMore.dataset.after}`);
+        const data = await response.json();
+        const rows = document.getElementById('song-rows');
+        data.results.forEach(song => {
+            const row = rows.insertRow();
+            [song.title, song.duration, song.release_date].forEach(value => {
+                row.insertCell().textContent = value;
+            });
+        });
+        if (data.next) {
+            loadMore.dataset.after = data.next;
+            loadMore.href = `?after=${data.next}`;
+        } else {
+            loadMore.remove();
+        }
+        loading = false;
+    }).observe(loadMore);
+}
+photos.js
+javascript
+// band/static/band/js/photos.js
+// Infinite scroll: fetch the next page when the "Older photos" link comes into view
+const loadMore = document.getElementById('load-more');
+if (loadMore) {
+    let loading = false;
+    new IntersectionObserver(async entries => {
+        if (!entries[0].isIntersecting || loading || !loadMore.dataset.after) return;
+        loading = true;
+        const response = await fetch(`${loadMore.dataset.api}?after=${loadMore.dataset.after}`);
+        const data = await response.json();
+        const grid = document.getElementById('photo-grid');
+        data.results.forEach(photo => {
+            const item = document.createElement('div');
+            item.className = 'photo-item';
+            const picture = document.createElement('picture');
+            if (photo.srcset_webp) {
+                const source = document.createElement('source');
+                source.type = 'image/webp';
+                source.srcset = photo.srcset_webp;
+                source.sizes = '300px';
+                picture.appendChild(source);
+            }
+            const img = document.createElement('img');
+            img.src = photo.src;
+            if (photo.srcset) {
+                img.srcset = photo.srcset;
+                img.sizes = '300px';
+            }
+            img.alt = photo.title;
+            img.width = 300;
+            img.loading = 'lazy';
+            picture.appendChild(img);
+            item.appendChild(picture);
+            [['h3', photo.title], ['p', photo.event_date], ['p', photo.description]].forEach(([tag, text]) => {
+                const el = document.createElement(tag);
+                el.textContent = text;
+                item.appendChild(el);
+            });
+            grid.appendChild(item);
+        });
+        if (data.next) {
+            loadMore.dataset.after = data.next;
+            loadMore.href = `?after=${data.next}`;
+        } else {
+            loadMore.remove();
+        }
+        loading = false;
+    }).observe(loadMore);
+}
+concerts.js
+javascript
+// band/static/band/js/concerts.js
+const csrfToken = document.currentScript.dataset.csrfToken;
+// Set when the site runs under ASGI and can push ticket counts
+const eventsUrl = document.currentScript.dataset.eventsUrl;
+// Clicks inside this window go out together in one request
+const SETTLE_MS = 300;
+// Without the event stream, ticket counts are polled from /api/concerts/
+const POLL_MS = 15000;
+
+const buttons = new Map();  // concert id -> button
+const saved = new Map();  // concert id -> attending, as last confirmed by the server
+const clicked = new Set();  // concert ids clicked since the last batch went out
+let timer = null;
+
+function showAttendance(button, attending) {
+    const concertId = button.dataset.concertId;
+    button.textContent = attending ? 'Cancel Attendance' : 'Attend Concert';
+    button.dataset.attending = attending ? 'true' : 'false';
+    const next = button.nextElementSibling;
+    const hasPayment = next && next.classList.contains('payment-button');
+    if (attending && !hasPayment) {
+        const paymentButton = document.createElement('a');
+        paymentButton.href = `/concert/${concertId}/payment/`;
+        paymentButton.className = 'payment-button';
+        paymentButton.textContent = 'Complete Payment';
+        button.insertAdjacentElement('afterend', paymentButton);
+    } else if (!attending && hasPayment) {
+        next.remove();
+    }
+}
+
+function requestKey() {
+    // crypto.randomUUID is only there on HTTPS and localhost
+    return window.crypto && crypto.randomUUID ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+async function sendChanges(changes, key) {
+    const request = () => fetch('/api/attendance/', {
+        method: 'POST',
+        headers: {
+            'X-CSRFToken': csrfToken,
+            'Content-Type': 'application/json',
+            'Idempotency-Key': key
+        },
+        body: JSON.stringify({changes})
+    });
+    let response;
+    try {
+        response = await request();
+    } catch (error) {
+        // Same key, so a batch that did reach the server isn't applied twice
+        response = await request();
+    }
+    const data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error || `attendance update failed (${response.status})`);
+    }
+    return data.attendance;
+}
+
+async function flush() {
+    timer = null;
+    const sent = [...clicked];
+    clicked.clear();
+    // Buttons clicked back to where they started need no request
+    const changes = sent
+        .map(concertId => ({concert_id: Number(concertId), attending: buttons.get(concertId).dataset.attending === 'true'}))
+        .filter(change => change.attending !== saved.get(String(change.concert_id)));
+    if (changes.length) {
+        try {
+            const attendance = await sendChanges(changes, requestKey());
+            for (const [concertId, attending] of Object.entries(attendance)) {
+                saved.set(concertId, attending);
+            }
+        } catch (error) {
+            console.error('Error:', error);
+        }
+    }
+    // Show what the server has, except on buttons clicked again meanwhile
+    for (const concertId of sent) {
+        if (!clicked.has(concertId)) {
+            showAttendance(buttons.get(concertId), saved.get(concertId));
+        }
+    }
+}
+
+document.querySelectorAll('.toggle-attendance').forEach(button => {
+    const concertId = button.dataset.concertId;
+    buttons.set(concertId, button);
+    saved.set(concertId, button.dataset.attending === 'true');
+    button.addEventListener('click', () => {
+        showAttendance(button, button.dataset.attending !== 'true');
+        clicked.add(concertId);
+        clearTimeout(timer);
+        timer = setTimeout(flush, SETTLE_MS);
+    });
+});
+
+function showTickets(concertId, availableTickets) {
+    const count = document.querySelector(`.concert-item[data-concert-id="${concertId}"] .tickets-available`);
+    if (count) {
+        count.textContent = availableTickets;
+    }
+}
+
+async function refreshTickets() {
+    if (document.hidden) {
+        return;
+    }
+    try {
+        // Revalidated with the ETag, so an unchanged list costs a 304
+        const response = await fetch('/api/concerts/?fields=id,available_tickets');
+        if (!response.ok) {
+            return;
+        }
+        const data = await response.json();
+        for (const concert of data.concerts) {
+            showTickets(concert.id, concert.available_tickets);
+        }
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+function startPolling() {
+    setInterval(refreshTickets, POLL_MS);
+    document.addEventListener('visibilitychange', refreshTickets);
+}
+
+if (eventsUrl && window.EventSource) {
+    const source = new EventSource(eventsUrl);
+    source.addEventListener('availability', event => {
+        const concert = JSON.parse(event.data);
+        showTickets(concert.id, concert.available_tickets);
+    });
+    // EventSource reconnects by itself; it only gives up on errors like a 503
+    source.addEventListener('error', () => {
+        if (source.readyState === EventSource.CLOSED) {
+            startPolling();
+        }
+    });
+} else {
+    startPolling();
+}
+waiting_room.js
+javascript
+// band/static/band/js/waiting_room.js
+const room = document.getElementById('waiting-room');
+const SOLD_OUT = 'Every remaining ticket is being bought right now. Keep this page open: if any are released, the line moves again.';
+
+async function poll() {
+    let delay = Number(room.dataset.retryAfter) || 5;
+    try {
+        const response = await fetch(room.dataset.statusUrl, {cache: 'no-store'});
+        const place = await response.json();
+        if (place.state === 'admitted' || place.state === 'not_queued') {
+            // Admitted: the payment page lets us through now. Not queued: rejoin
+            location.reload();
+            return;
+        }
+        room.querySelector('.queue-state').textContent = place.state === 'sold_out' ? SOLD_OUT
+            : `${place.ahead} buyer${place.ahead === 1 ? '' : 's'} ahead of you, about ${place.estimated_wait}s to go.`;
+        delay = place.retry_after;
+    } catch (error) {
+        console.error('Error:', error);
+    }
+    setTimeout(poll, delay * 1000);
+}
+
+setTimeout(poll, (Number(room.dataset.retryAfter) || 5) * 1000);
+Admin Setup
+python
+# band/admin.py
+from django.contrib import admin
+from django.db.models import F
+from .models import Song, Photo, Concert, UserConcert, TicketHold, TicketShard, Job, ImportProgress
+
+admin.site.register(Song)
+admin.site.register(Photo)
+
+
+@admin.register(Concert)
+class ConcertAdmin(admin.ModelAdmin):
+    # Counts come from band_concertstats, one join rather than an aggregate per page
+    list_display = ('name', 'location', 'date', 'price', 'available_tickets',
+                    'attendees', 'paid', 'pending_payments', 'revenue')
+    list_select_related = ('stats',)
+
+    def _stat(self, concert, name):
+        stats = getattr(concert, 'stats', None)
+        return getattr(stats, name) if stats else 0
+
+    @admin.display(ordering='stats__attendees')
+    def attendees(self, concert):
+        return self._stat(concert, 'attendees')
+
+    @admin.display(ordering='stats__paid')
+    def paid(self, concert):
+        return self._stat(concert, 'paid')
+
+    @admin.display(ordering='stats__pending_payments')
+    def pending_payments(self, concert):
+        return self._stat(concert, 'pending_payments')
+
+    @admin.display(ordering=F('stats__paid') * F('price'))
+    def revenue(self, concert):
+        return concert.price * self._stat(concert, 'paid')
+
+
+admin.site.register(UserConcert)
+admin.site.register(TicketHold)
+admin.site.register(TicketShard)
+admin.site.register(Job)
+admin.site.register(ImportProgress)
+tests.py
+python
+# band/tests.py
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import authenticate, hashers
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from . import attendance, bulk, events, hashing, ratelimit, reservations, stats, ticket_shards, waiting_room
+from .caching import MISSING, LRUBackend, QueryCache, SharedBackend, query_cache
+from .models import Concert, ConcertStats, ImportProgress, Song, TicketHold, UserConcert
+from .pagination import decode_cursor, fetch_page
+
+
+def fresh_listings():
+    # Versions are re-read once a second; tests are quicker than that
+    for namespace in ('songs', 'photos', 'concerts'):
+        query_cache.backend.bump_version(namespace)
+
+
+class ReservationTests(TransactionTestCase):
+    # Holds are committed by the writer thread, so each test needs real commits
+
+    def setUp(self):
+        self.concert = Concert.objects.create(name='Test Gig', location='Hall', price=20, available_tickets=5,
+                                              date=timezone.now() + timedelta(days=7))
+        self.users = [User.objects.create(username=f'buyer-{i}') for i in range(20)]
+
+    def _rush(self):
+        def buy(user):
+            try:
+                return reservations.hold_tickets(user.id, self.concert.id)
+            except reservations.SoldOut:
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            return [hold for hold in pool.map(buy, self.users) if hold is not None]
+
+    def test_concurrent_holds_never_oversell(self):
+        holds = self._rush()
+        self.assertEqual(len(holds), 5)
+        self.concert.refresh_from_db()
+        self.assertEqual(self.concert.available_tickets, 0)
+        self.assertEqual(TicketHold.objects.filter(concert=self.concert, status=TicketHold.HELD).count(), 5)
+
+    def test_concurrent_holds_never_oversell_sharded(self):
+        ticket_shards.split(self.concert.id, 3)
+        holds = self._rush()
+        self.assertEqual(len(holds), 5)
+        self.assertEqual(ticket_shards.available(self.concert.id), 0)
+
+    def test_split_during_takes_keeps_every_ticket(self):
+        Concert.objects.filter(pk=self.concert.pk).update(available_tickets=15)
+        rushing = threading.Event()
+        rushing.set()
+
+        def resplit():
+            splits = 0
+            try:
+                while rushing.is_set():
+                    ticket_shards.split(self.concert.id, splits % 4)
+                    splits += 1
+            finally:
+                connection.close()
+            return splits
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            splits = pool.submit(resplit)
+            holds = self._rush()
+            rushing.clear()
+            self.assertGreater(splits.result(), 1)
+        self.assertEqual(len(holds), 15)
+        self.assertEqual(ticket_shards.available(self.concert.id), 0)
+        self.assertEqual(TicketHold.objects.filter(concert=self.concert).count(), 15)
+
+    def test_expired_hold_is_released(self):
+        hold = reservations.hold_tickets(self.users[0].id, self.concert.id)
+        self.assertEqual(reservations.release_expired(now=hold.expires_at - timedelta(seconds=1)), 0)
+
+        self.assertEqual(reservations.release_expired(now=hold.expires_at + timedelta(seconds=1)), 1)
+        hold.refresh_from_db()
+        self.assertEqual(hold.status, TicketHold.EXPIRED)
+        self.concert.refresh_from_db()
+        self.assertEqual(self.concert.available_tickets, 5)
+        # A second sweep finds nothing left to return
+        self.assertEqual(reservations.release_expired(now=hold.expires_at + timedelta(seconds=1)), 0)
+
+    def test_confirming_expired_hold_fails(self):
+        hold = reservations.hold_tickets(self.users[0].id, self.concert.id)
+        TicketHold.objects.filter(pk=hold.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        with self.assertRaises(reservations.HoldExpired):
+            reservations.confirm_hold(hold, 'payment-1')
+        hold.refresh_from_db()
+        self.assertEqual(hold.status, TicketHold.HELD)
+        self.assertFalse(UserConcert.objects.filter(payment_id='payment-1').exists())
+
+    def test_failing_operation_does_not_fail_its_batch(self):
+        def broken(*args):
+            raise RuntimeError('broken')
+
+        def submit(index):
+            fn = broken if index == 0 else reservations._hold
+            try:
+                return reservations.committer.submit(self.concert.id, fn, self.users[index].id, self.concert.id, 1)
+            except RuntimeError:
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(submit, range(4)))
+        self.assertIsNone(results[0])
+        self.assertTrue(all(isinstance(hold, TicketHold) for hold in results[1:]))
+        self.concert.refresh_from_db()
+        self.assertEqual(self.concert.available_tickets, 2)
+
+
+class WaitingRoomTests(TestCase):
+
+    def setUp(self):
+        caches[waiting_room.CACHE].clear()
+        self.concert = Concert.objects.create(name='Test Gig', location='Hall', price=20, available_tickets=5,
+                                              admit_rate=1000, date=timezone.now() + timedelta(days=7))
+        self.user = User.objects.create(username='buyer')
+        self.client.force_login(self.user)
+        self.path = f'/concert/{self.concert.id}/payment/'
+
+    def _join(self, count):
+        return [waiting_room.read_token(waiting_room.join(self.concert.id, user_id), self.concert.id)
+                for user_id in range(1000, 1000 + count)]
+
+    def _admitted(self, tickets, now):
+        with mock.patch('band.waiting_room.time') as clock:
+            clock.time.return_value = now
+            return [ticket for ticket in tickets if waiting_room.admit(ticket)[0]['state'] == 'admitted']
+
+    def test_admits_no_more_than_the_tickets_left(self):
+        tickets = self._join(12)
+        admitted = self._admitted(tickets, 1000.0)
+        self.assertEqual(len(admitted), 5)
+
+        # Two of them hold a ticket; the other three still have theirs coming
+        for ticket in admitted[:2]:
+            Concert.objects.filter(pk=self.concert.pk).update(available_tickets=F('available_tickets') - 1)
+            waiting_room.held(SimpleNamespace(waiting_room_ticket=dict(ticket)), self.concert.id)
+        self.assertEqual(len(self._admitted(tickets, 1002.0)), 5)
+
+        # The three who never held stop counting against stock
+        self.assertEqual(len(self._admitted(tickets, 1003.0 + waiting_room.ADMITTED_SECONDS)), 8)
+
+    def test_get_outside_the_line_shows_the_waiting_room(self):
+        self._join(50)
+        Concert.objects.filter(pk=self.concert.pk).update(admit_rate=1)
+        response = self.client.get(self.path)
+        self.assertTemplateUsed(response, 'band/waiting_room.html')
+        self.assertIn('Retry-After', response.headers)
+
+    def test_post_with_unknown_or_expired_token_takes_nothing(self):
+        self._join(50)
+        Concert.objects.filter(pk=self.concert.pk).update(admit_rate=1)
+        stale = waiting_room._sign(self.concert.id, self.user.id, 1, 'old-epoch', admitted=True)
+        for token in ['not-a-token', stale]:
+            self.client.cookies[waiting_room.cookie_name(self.concert.id)] = token
+            response = self.client.post(self.path, {'payment_token': 'token'})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)
+            self.assertEqual(response.json()['state'], 'waiting')
+        self.assertFalse(TicketHold.objects.exists())
+        self.concert.refresh_from_db()
+        self.assertEqual(self.concert.available_tickets, 5)
+
+    def test_cache_must_be_shared(self):
+        with override_settings(WAITING_ROOM_SINGLE_PROCESS=False):
+            self.assertEqual([error.id for error in waiting_room.check_cache(None)], ['band.E002'])
+        with override_settings(WAITING_ROOM_SINGLE_PROCESS=True):
+            self.assertEqual(waiting_room.check_cache(None), [])
+
+
+class QueryCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_saving_a_model_invalidates_its_listing(self):
+        compute = mock.Mock(side_effect=['before', 'after'])
+        self.assertEqual(query_cache.get_or_set('songs', compute, 'page'), 'before')
+        self.assertEqual(query_cache.get_or_set('songs', compute, 'page'), 'before')
+        with self.captureOnCommitCallbacks(execute=True):
+            Song.objects.create(title='New', duration=200, release_date='2024-01-01', lyrics='')
+        self.assertEqual(query_cache.get_or_set('songs', compute, 'page'), 'after')
+        self.assertEqual(compute.call_count, 2)
+
+    def test_rolled_back_change_keeps_the_listing(self):
+        cache = QueryCache(LRUBackend())
+        cache.get_or_set('songs', lambda: 'cached')
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            cache.invalidate('songs')
+            transaction.set_rollback(True)
+        self.assertEqual(cache.get_or_set('songs', lambda: 'recomputed'), 'cached')
+
+    def test_invalidate_reaches_other_processes(self):
+        # Two LRUs sharing a versions cache stand in for two worker processes
+        first, second = (QueryCache(LRUBackend(versions='default', version_ttl=0)) for _ in range(2))
+        first.get_or_set('songs', lambda: 'old')
+        second.get_or_set('songs', lambda: 'old')
+        with self.captureOnCommitCallbacks(execute=True):
+            first.invalidate('songs')
+        self.assertEqual(first.get_or_set('songs', lambda: 'new'), 'new')
+        self.assertEqual(second.get_or_set('songs', lambda: 'new'), 'new')
+
+    def test_flushed_versions_dont_revive_old_entries(self):
+        cache = QueryCache(LRUBackend(versions='default', version_ttl=0))
+        cache.get_or_set('songs', lambda: 'old')
+        caches['default'].clear()
+        self.assertEqual(cache.get_or_set('songs', lambda: 'new'), 'new')
+
+    def test_shared_backend_delete(self):
+        backend = SharedBackend('default')
+        backend.set('key', 'value', 60)
+        backend.delete('key')
+        self.assertIs(backend.get('key'), MISSING)
+
+
+class ConditionalTests(TestCase):
+
+    def setUp(self):
+        fresh_listings()
+        date = timezone.now() + timedelta(days=7)
+        self.first, self.second = (
+            Concert.objects.create(name=name, location='Hall', price=20, available_tickets=5, date=date)
+            for name in ('First', 'Second'))
+        self.user = User.objects.create(username='fan')
+
+    def _etag(self, path='/concerts/', etag=None):
+        response = self.client.get(path, **({'HTTP_IF_NONE_MATCH': etag} if etag else {}))
+        return response.status_code, response.headers.get('ETag')
+
+    def _tickets(self, concert, change):
+        # What the ticket writer does: a raw UPDATE, then invalidate the listing
+        with self.captureOnCommitCallbacks(execute=True):
+            Concert.objects.filter(pk=concert.pk).update(available_tickets=F('available_tickets') + change)
+            query_cache.invalidate('concerts')
+
+    def test_catalog_lists_past_concerts(self):
+        Concert.objects.filter(pk=self.first.pk).update(date=timezone.now() - timedelta(days=1))
+        fresh_listings()
+        names = [concert['name'] for concert in self.client.get('/api/concerts/').json()['concerts']]
+        self.assertEqual(names, ['First', 'Second'])
+
+    def test_unchanged_catalog_is_not_modified(self):
+        status, etag = self._etag()
+        self.assertEqual(status, 200)
+        self.assertEqual(self._etag(etag=etag), (304, etag))
+
+    def test_offsetting_ticket_changes_change_the_etag(self):
+        _, etag = self._etag()
+        # A sale on one concert and a released hold on the other
+        self._tickets(self.first, -1)
+        self._tickets(self.second, 1)
+        status, new_etag = self._etag(etag=etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+
+    def test_moving_attendance_changes_the_etag(self):
+        self.client.force_login(self.user)
+        attendance = UserConcert.objects.create(user=self.user, concert=self.first)
+        _, etag = self._etag()
+        UserConcert.objects.filter(pk=attendance.pk).update(concert=self.second)
+        status, new_etag = self._etag(etag=etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+
+    def test_song_change_changes_the_etag(self):
+        song = Song.objects.create(title='Old', duration=200, release_date='2024-01-01', lyrics='')
+        _, etag = self._etag('/songs/')
+        Song.objects.filter(pk=song.pk).delete()
+        self.assertEqual(self._etag('/songs/', etag)[0], 200)
+
+class PaginationTests(TestCase):
+
+    def setUp(self):
+        fresh_listings()
+        # Three songs share a release date, so pages have to split ties by id
+        dates = ['2024-01-01', '2024-02-01', '2024-02-01', '2024-02-01', '2024-03-01', '2024-04-01', '2024-05-01']
+        self.songs = [Song.objects.create(title=f'Song {i}', duration=200, release_date=date, lyrics='')
+                      for i, date in enumerate(dates)]
+        self.newest_first = list(Song.objects.order_by('-release_date', '-id').values_list('id', flat=True))
+
+    def _walk(self, limit):
+        seen, after = [], None
+        while True:
+            rows, next_cursor = fetch_page('band_song', ['title'], 'release_date', after, limit)
+            seen += [row[0] for row in rows]
+            if next_cursor is None:
+                return seen
+            after = decode_cursor(next_cursor)
+
+    def test_pages_list_every_row_once_newest_first(self):
+        for limit in (1, 2, 3, 7, 50):
+            self.assertEqual(self._walk(limit), self.newest_first)
+
+    def test_new_row_doesnt_shift_the_next_page(self):
+        rows, next_cursor = fetch_page('band_song', ['title'], 'release_date', None, 3)
+        Song.objects.create(title='Newest', duration=200, release_date='2024-06-01', lyrics='')
+        rest, _ = fetch_page('band_song', ['title'], 'release_date', decode_cursor(next_cursor), 50)
+        self.assertEqual([row[0] for row in rows + rest], self.newest_first)
+
+    def test_mangled_cursor_starts_from_the_first_page(self):
+        self.assertIsNone(decode_cursor('not a cursor!'))
+        response = self.client.get('/api/songs/', {'after': 'not a cursor!'})
+        self.assertEqual(response.json()['results'][0]['id'], self.newest_first[0])
+
+    def test_api_follows_next_to_the_end(self):
+        ids, after = [], ''
+        with mock.patch('band.views._song_page.__defaults__', (3,)):
+            while after is not None:
+                body = self.client.get('/api/songs/', {'after': after} if after else {}).json()
+                ids += [song['id'] for song in body['results']]
+                after = body['next']
+        self.assertEqual(ids, self.newest_first)
+
+    def test_stream_lists_every_song(self):
+        response = self.client.get('/songs/', {'stream': '1'})
+        body = b''.join(response.streaming_content).decode()
+        for song in self.songs:
+            self.assertIn(song.title, body)
+
+
+class ConcertStatsTests(TestCase):
+    """The triggers from migration 0011 keep band_concertstats in step."""
+
+    def setUp(self):
+        self.concert = Concert.objects.create(name='Stats', location='Hall', price=20, available_tickets=5,
+                                              date=timezone.now() + timedelta(days=7))
+        self.fans = [User.objects.create(username=f'fan{n}') for n in range(3)]
+
+    def _stats(self):
+        stats = ConcertStats.objects.get(concert=self.concert)
+        return stats.attendees, stats.paid, stats.pending_payments
+
+    def test_new_concert_gets_a_zero_row(self):
+        self.assertEqual(self._stats(), (0, 0, 0))
+
+    def test_inserts_updates_and_deletes_move_the_counts(self):
+        first, second, third = (UserConcert.objects.create(user=fan, concert=self.concert) for fan in self.fans)
+        self.assertEqual(self._stats(), (3, 0, 3))
+        UserConcert.objects.filter(pk=first.pk).update(payment_status='completed')
+        self.assertEqual(self._stats(), (3, 1, 2))
+        UserConcert.objects.filter(pk=second.pk).update(attending=False)
+        self.assertEqual(self._stats(), (2, 1, 2))
+        third.delete()
+        self.assertEqual(self._stats(), (1, 1, 1))
+        self.assertEqual(stats.rebuild(dry_run=True), [])
+
+    def test_moving_a_row_between_concerts(self):
+        other = Concert.objects.create(name='Other', location='Hall', price=20, available_tickets=5,
+                                       date=timezone.now() + timedelta(days=8))
+        attendance = UserConcert.objects.create(user=self.fans[0], concert=self.concert)
+        UserConcert.objects.filter(pk=attendance.pk).update(concert=other)
+        self.assertEqual(self._stats(), (0, 0, 0))
+        self.assertEqual(ConcertStats.objects.filter(concert=other).values_list('attendees', flat=True).get(), 1)
+
+    def test_rolled_back_writes_leave_the_counts(self):
+        with transaction.atomic():
+            UserConcert.objects.create(user=self.fans[0], concert=self.concert)
+            transaction.set_rollback(True)
+        self.assertEqual(self._stats(), (0, 0, 0))
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'songs.jsonl')
+        self.titles = [f'Song {n}' for n in range(10)]
+        with open(self.path, 'w') as f:
+            for title in self.titles:
+                f.write(json.dumps({'title': title, 'duration': 180, 'release_date': '2024-01-01', 'lyrics': ''}) + '\n')
+
+    def _imported(self):
+        return sorted(Song.objects.values_list('title', flat=True))
+
+    def test_resume_after_a_crash_between_batches(self):
+        def crash(rows, rate):
+            if rows == 6:
+                raise RuntimeError('killed')
+        with self.assertRaises(RuntimeError):
+            bulk.import_rows('song', self.path, batch_size=2, report=crash)
+        self.assertEqual(bulk.import_progress(self.path)['rows'], 6)
+
+        imported, _ = bulk.import_rows('song', self.path, batch_size=2)
+        self.assertEqual(imported, 4)
+        self.assertEqual(self._imported(), self.titles)
+        self.assertIsNone(bulk.import_progress(self.path))
+
+    def test_crash_before_the_progress_is_saved_rolls_back_the_batch(self):
+        save = ImportProgress.objects.update_or_create
+        calls = []
+
+        def crash(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 3:
+                raise RuntimeError('killed')
+            return save(**kwargs)
+        with mock.patch.object(ImportProgress.objects, 'update_or_create', side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                bulk.import_rows('song', self.path, batch_size=2)
+        self.assertEqual(Song.objects.count(), 4)
+        self.assertEqual(bulk.import_progress(self.path)['rows'], 4)
+
+        bulk.import_rows('song', self.path, batch_size=2)
+        self.assertEqual(self._imported(), self.titles)
+
+    def test_restart_ignores_the_saved_progress(self):
+        ImportProgress.objects.create(path=os.path.abspath(self.path), offset=os.path.getsize(self.path), rows=10)
+        imported, _ = bulk.import_rows('song', self.path, resume=False)
+        self.assertEqual(imported, 10)
+
+
+class AttendanceTests(TestCase):
+
+    def setUp(self):
+        self.concert = Concert.objects.create(name='Gig', location='Hall', price=20, available_tickets=5,
+                                              date=timezone.now() + timedelta(days=7))
+        self.user = User.objects.create(username='fan')
+        self.client.force_login(self.user)
+        caches[attendance.IDEMPOTENCY_CACHE].clear()
+
+    def _rows(self):
+        return list(UserConcert.objects.filter(user=self.user).values_list('concert_id', 'payment_status'))
+
+    def test_set_and_cancel_repeat_safely(self):
+        for _ in range(2):
+            self.assertTrue(attendance.set_attendance(self.user.pk, self.concert.pk, True))
+        self.assertEqual(self._rows(), [(self.concert.pk, 'pending')])
+        for _ in range(2):
+            self.assertFalse(attendance.set_attendance(self.user.pk, self.concert.pk, False))
+        self.assertEqual(self._rows(), [])
+
+    def test_toggle_flips(self):
+        self.assertTrue(attendance.toggle(self.user.pk, self.concert.pk))
+        self.assertFalse(attendance.toggle(self.user.pk, self.concert.pk))
+        self.assertEqual(self._rows(), [])
+
+    def test_repeated_idempotency_key_toggles_once(self):
+        path = f'/concert/{self.concert.pk}/toggle/'
+        for _ in range(2):
+            response = self.client.post(path, HTTP_IDEMPOTENCY_KEY='click-1')
+            self.assertEqual(response.json(), {'success': True, 'attending': True})
+        self.assertEqual(len(self._rows()), 1)
+        self.assertEqual(self.client.post(path, HTTP_IDEMPOTENCY_KEY='click-2').json()['attending'], False)
+
+    def test_paid_attendance_is_never_cancelled(self):
+        UserConcert.objects.create(user=self.user, concert=self.concert, payment_status='completed', payment_id='pay')
+        with self.assertRaises(attendance.Paid):
+            attendance.toggle(self.user.pk, self.concert.pk)
+        with self.assertRaises(attendance.Paid):
+            attendance.set_attendance(self.user.pk, self.concert.pk, False)
+        self.assertEqual(attendance.set_many(self.user.pk, {self.concert.pk: False}), {str(self.concert.pk): True})
+        response = self.client.post(f'/concert/{self.concert.pk}/toggle/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self._rows(), [(self.concert.pk, 'completed')])
+        self.assertEqual(ConcertStats.objects.get(concert=self.concert).paid, 1)
+
+
+class BrokerTests(SimpleTestCase):
+
+    def test_every_subscriber_gets_the_latest_value(self):
+        broker = events.LocalBroker()
+
+        async def scenario():
+            first, second = broker.subscribe('tickets'), broker.subscribe('tickets')
+            # From another thread, as the ticket writers do; a reader that
+            # falls behind skips to the newest count per concert
+            publisher = threading.Thread(target=lambda: [broker.publish('tickets', concert, left)
+                                                         for concert, left in ((1, 5), (2, 9), (1, 4))])
+            publisher.start()
+            publisher.join()
+            received = [await asyncio.wait_for(subscription.__anext__(), 1) for subscription in (first, second)]
+            first.close()
+            second.close()
+            return received
+
+        first, second = asyncio.run(scenario())
+        self.assertEqual(sorted(first), [(1, 4), (2, 9)])
+        self.assertEqual(first, second)
+        self.assertEqual(broker.subscribers(), 0)
+
+    def test_unchanged_values_and_other_channels_send_nothing(self):
+        broker = events.LocalBroker(keepalive=0.05)
+
+        async def scenario():
+            subscription = broker.subscribe('tickets')
+            broker.publish('tickets', 1, 5)
+            self.assertEqual(await asyncio.wait_for(subscription.__anext__(), 1), [(1, 5)])
+            broker.publish('tickets', 1, 5)
+            broker.publish('news', 1, 'hello')
+            # Only the keepalive tick wakes it, with nothing to send
+            changes = await asyncio.wait_for(subscription.__anext__(), 1)
+            subscription.close()
+            return changes
+
+        self.assertEqual(asyncio.run(scenario()), [])
+
+    def test_cache_broker_fans_out_in_order(self):
+        broker = events.CacheBroker(alias='default')
+        channel = 'tickets-cache-broker-test'
+        broker._seen[channel] = caches['default'].get(f'events:{channel}:seq', 0)
+
+        async def scenario():
+            subscription = broker.local.subscribe(channel)
+            for concert, left in ((1, 5), (1, 3), (2, 7)):
+                broker.publish(channel, concert, left)
+            broker._poll(channel, broker._seen[channel])
+            changes = await asyncio.wait_for(subscription.__anext__(), 1)
+            subscription.close()
+            return changes
+
+        self.assertEqual(sorted(asyncio.run(scenario())), [(1, 3), (2, 7)])
+
+
+class AvailabilityEventTests(TestCase):
+
+    def test_published_after_commit_with_the_current_count(self):
+        concert = Concert.objects.create(name='Gig', location='Hall', price=20, available_tickets=5,
+                                         date=timezone.now() + timedelta(days=7))
+        with mock.patch.object(events.broker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                events.availability_changed(concert.pk)
+                publish.assert_not_called()
+        publish.assert_called_once_with(events.AVAILABILITY, concert.pk, 5)
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def _windows(self, store, key):
+        # 10 hits late in one minute, then the next minute from its start
+        totals = [store.hit(key, 60, now=1050 + n) for n in range(10)]
+        self.assertEqual(totals, list(range(1, 11)))
+        # A quarter into the next minute, three quarters of the last one still count
+        self.assertAlmostEqual(store.hit(key, 60, now=1095), 1 + 10 * 0.75)
+        self.assertAlmostEqual(store.hit(key, 60, now=1110), 2 + 10 * 0.5)
+        # Two minutes on, nothing overlaps any more
+        self.assertEqual(store.hit(key, 60, now=1230), 1)
+
+    def test_local_store_slides(self):
+        self._windows(ratelimit.LocalStore(), 'view:ip:1')
+
+    def test_shared_store_slides(self):
+        self._windows(ratelimit.SharedStore('default'), 'ratelimit-test:ip:1')
+
+    def test_local_store_forgets_the_oldest_keys(self):
+        store = ratelimit.LocalStore(max_keys=2)
+        for key in ('a', 'b', 'a', 'c'):
+            store.hit(key, 60, now=1000)
+        self.assertEqual(list(store._windows), ['a', 'c'])
+
+    def test_parse(self):
+        self.assertEqual(ratelimit.parse('user:30/m'), ratelimit.Rule('user', 30, 60))
+        for bad in ('30/m', 'ip:30/w', 'session:1/s'):
+            with self.assertRaises(ValueError):
+                ratelimit.parse(bad)
+
+    def test_over_the_limit_gets_a_429_with_retry_after(self):
+        view = ratelimit.limit('test', 'ip:2/m')(lambda request: HttpResponse('ok'))
+        factory = RequestFactory()
+        with mock.patch.object(ratelimit, 'store', ratelimit.LocalStore()), \
+                mock.patch('band.ratelimit.time.time', return_value=6000 + 45):
+            statuses = [view(factory.get('/', REMOTE_ADDR='10.0.0.1')).status_code for _ in range(3)]
+            other = view(factory.get('/', REMOTE_ADDR='10.0.0.2'))
+            rejected = view(factory.post('/', {}, REMOTE_ADDR='10.0.0.1', HTTP_ACCEPT='application/json'))
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(rejected.headers['Retry-After'], '15')
+        self.assertFalse(json.loads(rejected.content)['success'])
+
+
+# MD5 keeps the tests quick; a short salt is what marks its hashes outdated
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class HashingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='admin', is_staff=True, is_superuser=True,
+                                        password=hashers.make_password('secret'))
 
-{% block title %}Payment - Our Awesome Band{% endblock %}
+    def test_full_pool_is_a_failed_login_not_a_500(self):
+        with mock.patch.object(hashing._slots, 'acquire', return_value=False):
+            admin = self.client.post('/admin/login/', {'username': 'admin', 'password': 'secret'})
+            band = self.client.post('/login/', {'username': 'admin', 'password': 'secret'})
+        self.assertEqual(admin.status_code, 200)
+        self.assertNotIn('_auth_user_id', self.client.session)
+        self.assertEqual(band.status_code, 503)
+        self.assertEqual(band.headers['Retry-After'], '5')
 
-{% block content %}
-    <h2>Complete Payment for {{ concert.name }}</h2>
-    <p>Amount: ${{ concert.price }}</p>
-    
-    <div id="google-pay-button"></div>
-    
-    <script src="https://pay.google.com/gp/p/js/pay.js"></script>
-    <script>
-        const paymentRequest = {{ payment_request|safe }};
-        const paymentsClient = new google.payments.api.PaymentsClient({
-            environment: '{{ google_pay_environment|lower }}'
-        });
-        
-        function onGooglePayLoaded() {
-            paymentsClient.isReadyToPay({
-                apiVersion: 2,
-                apiVersionMinor: 0,
-                allowedPaymentMethods: paymentRequest.allowedPaymentMethods
-            }).then(function(response) {
-                if (response.result) {
-                    addGooglePayButton();
-                }
-            }).catch(function(err) {
-                console.error('Error checking Google Pay readiness:', err);
-            });
-        }
-        
-        function addGooglePayButton() {
-            const button = paymentsClient.createButton({
-                onClick: onGooglePaymentButtonClicked,
-                buttonColor: 'black',
-                buttonType: 'pay'
-            });
-            document.getElementById('google-pay-button').appendChild(button);
-        }
-        
-        function onGooglePaymentButtonClicked() {
-            paymentsClient.loadPaymentData(paymentRequest).then(function(paymentData) {
-                processPayment(paymentData);
-            }).catch(function(err) {
-                console.error('Error loading payment data:', err);
-            });
+    def test_outdated_hash_is_upgraded_only_when_the_pool_is_idle(self):
+        outdated = hashers.MD5PasswordHasher().encode('secret', 'ab')
+        User.objects.filter(pk=self.user.pk).update(password=outdated)
+        with mock.patch.object(hashing, 'saturated', return_value=True):
+            self.assertEqual(authenticate(username='admin', password='secret'), self.user)
+        self.assertEqual(User.objects.get(pk=self.user.pk).password, outdated)
+
+        self.assertEqual(authenticate(username='admin', password='secret'), self.user)
+        upgraded = User.objects.get(pk=self.user.pk).password
+        self.assertNotEqual(upgraded, outdated)
+        self.assertTrue(hashers.check_password('secret', upgraded))
+Management Commands
+release_expired_holds.py
+python
+# band/management/commands/release_expired_holds.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from band import reservations
+
+
+class Command(BaseCommand):
+    help = 'Return tickets from expired holds to their concerts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Keep sweeping every INTERVAL seconds, for sites that run no job workers')
+
+    def handle(self, *args, **options):
+        while True:
+            released = reservations.release_expired(committer=None)
+            self.stdout.write(f"Released {released} expired holds")
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
+bench_reservations.py
+python
+# band/management/commands/bench_reservations.py
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from band import reservations, ticket_shards
+from band.models import Concert, TicketHold
+
+
+class Command(BaseCommand):
+    help = 'Simulate an on-sale: many concurrent buyers racing for a limited number of tickets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=1000)
+        parser.add_argument('--tickets', type=int, default=500)
+        parser.add_argument('--shards', type=int, default=0, help='Split the inventory over N counter rows')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark concert and users')
+
+    def handle(self, *args, **options):
+        buyers, tickets = options['buyers'], options['tickets']
+        run = uuid.uuid4().hex[:8]
+        concert = Concert.objects.create(
+            name=f'bench-{run}', location='Benchmark Hall',
+            date=timezone.now() + timedelta(days=30), price=10, available_tickets=tickets,
+        )
+        if options['shards']:
+            ticket_shards.split(concert.id, options['shards'])
+        User.objects.bulk_create([
+            User(username=f'bench-{run}-{i}', password='!') for i in range(buyers)
+        ])
+        user_ids = list(User.objects.filter(username__startswith=f'bench-{run}-').values_list('id', flat=True))
+
+        sold, rejected, errors = [], [], []
+        start_gate = threading.Event()
+
+        def buyer(user_id):
+            start_gate.wait()
+            try:
+                reservations.purchase(user_id, concert.id, str(uuid.uuid4()))
+                sold.append(user_id)
+            except reservations.SoldOut:
+                rejected.append(user_id)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+        for thread in threads:
+            thread.start()
+        started = time.perf_counter()
+        start_gate.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        remaining = ticket_shards.available(concert.id)
+        confirmed = TicketHold.objects.filter(concert=concert, status=TicketHold.CONFIRMED).count()
+        oversold = max(0, confirmed - tickets) + max(0, -remaining)
+
+        self.stdout.write(f"buyers:            {buyers}")
+        self.stdout.write(f"tickets:           {tickets}")
+        self.stdout.write(f"sold:              {len(sold)}")
+        self.stdout.write(f"sold out replies:  {len(rejected)}")
+        self.stdout.write(f"errors:            {len(errors)}")
+        self.stdout.write(f"shards:            {options['shards'] or 'off'}")
+        self.stdout.write(f"remaining:         {remaining}")
+        self.stdout.write(f"oversold:          {oversold}")
+        self.stdout.write(f"elapsed:           {elapsed:.3f}s")
+        self.stdout.write(f"purchases/sec:     {len(sold) / elapsed:.1f}")
+        self.stdout.write(f"group commits:     {reservations.committer.batches}")
+
+        if not options['keep']:
+            User.objects.filter(username__startswith=f'bench-{run}-').delete()
+            concert.delete()
+
+        if errors:
+            raise CommandError(f"{len(errors)} buyers failed: {errors[0]!r}")
+        if oversold or len(sold) + remaining != tickets:
+            raise CommandError('Ticket count mismatch: concert was oversold')
+shard_tickets.py
+python
+# band/management/commands/shard_tickets.py
+from django.core.management.base import BaseCommand, CommandError
+from band import ticket_shards
+from band.models import Concert
+
+
+class Command(BaseCommand):
+    help = "Split a concert's ticket counter into N shards (0 merges them back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('concert_id', type=int)
+        parser.add_argument('shards', type=int)
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError('shards must be 0 or more')
+        if not Concert.objects.filter(pk=options['concert_id']).exists():
+            raise CommandError(f"Concert {options['concert_id']} does not exist")
+        remaining = ticket_shards.split(options['concert_id'], options['shards'])
+        self.stdout.write(f"{remaining} tickets spread over {options['shards'] or 1} counter(s)")
+explain_queries.py
+python
+# band/management/commands/explain_queries.py
+from datetime import date, timedelta
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from band import reservations, stats, views, waiting_room
+from band.caching import query_cache
+from band.models import Song, Photo, Concert
+from band.pagination import encode_cursor
+
+VIEWS = [
+    ('songs', 'get', '/songs/', views.songs, False),
+    ('songs (page 2)', 'get', '/songs/?after={song_cursor}', views.songs, False),
+    ('api_songs', 'get', '/api/songs/', views.api_songs, False),
+    ('photos', 'get', '/photos/', views.photos, False),
+    ('api_photos', 'get', '/api/photos/', views.api_photos, False),
+    ('concerts (anonymous)', 'get', '/concerts/', views.concerts, False),
+    ('concerts (logged in)', 'get', '/concerts/', views.concerts, True),
+    ('api_concerts', 'get', '/api/concerts/?fields=id,available_tickets,is_attending', views.api_concerts, True),
+    ('toggle_attendance', 'post', '/concert/{concert_id}/toggle/', views.toggle_attendance, True),
+    ('set_attendance', 'put', '/concert/{concert_id}/attendance/', views.set_attendance, True),
+    ('unset_attendance', 'delete', '/concert/{concert_id}/attendance/', views.set_attendance, True),
+]
+
+
+class Command(BaseCommand):
+    help = 'Run every view query under EXPLAIN QUERY PLAN and flag full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strict', action='store_true', help='Exit non-zero if any query scans a table')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('EXPLAIN QUERY PLAN reports are only implemented for SQLite')
+
+        statements = []
+
+        def capture(execute, sql, params, many, context):
+            if not sql.lstrip().upper().startswith(('EXPLAIN', 'SAVEPOINT', 'RELEASE')):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        scans = 0
+        # Fixture rows and every write are rolled back at the end
+        with transaction.atomic():
+            user, context = self._fixtures()
+            factory = RequestFactory()
+            for name, method, url, view, logged_in in VIEWS:
+                for namespace in ('songs', 'photos', 'concerts'):
+                    query_cache.backend.bump_version(namespace)
+                request = getattr(factory, method)(url.format(**context))
+                request.user = user if logged_in else context['anonymous']
+                statements.clear()
+                with connection.execute_wrapper(capture):
+                    view(request, **({'concert_id': context['concert_id']} if 'concert_id' in url else {}))
+                scans += self._report(name, statements)
+
+            for name, fn in [
+                ('reservations.hold_tickets', lambda: reservations._hold(user.id, context['concert_id'], 1)),
+                ('waiting_room.capacity', lambda: waiting_room._capacity(context['concert_id'])),
+                ('reservations.purchase', lambda: reservations._purchase(user.id, context['concert_id'], 'explain', 1)),
+                ('reservations.release_expired', lambda: reservations.release_expired(committer=None)),
+                ('stats.report', lambda: stats.report(upcoming=True)),
+            ]:
+                statements.clear()
+                with connection.execute_wrapper(capture):
+                    fn()
+                scans += self._report(name, statements)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"\n{scans} queries scan a table")
+        if scans and options['strict']:
+            raise CommandError('Full table scans found')
+
+    def _fixtures(self):
+        user = User.objects.create(username='explain-queries', password='!')
+        for i in range(3):
+            Song.objects.create(title=f'Song {i}', duration=180, release_date=date.today() - timedelta(days=i), lyrics='')
+            Photo.objects.create(title=f'Photo {i}', image='photos/explain.jpg', event_date=date.today(), description='')
+        concert = Concert.objects.create(name='Explain', location='Nowhere', price=1, available_tickets=10,
+                                         date=timezone.now() + timedelta(days=1))
+        song_cursor = encode_cursor(date.today(), Song.objects.order_by('-id').first().id)
+        return user, {'concert_id': concert.id, 'song_cursor': song_cursor, 'anonymous': AnonymousUser()}
+
+    def _report(self, name, statements):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{name}"))
+        scans = 0
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+                # "SCAN t" without an index walks every row of t
+                full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+                scans += bool(full_scans)
+                status = self.style.ERROR('SCAN') if full_scans else self.style.SUCCESS('OK  ')
+                self.stdout.write(f"  {status} {' '.join(sql.split())[:110]}")
+                for step in plan:
+                    self.stdout.write(f"         {step}")
+        return scans
+build_photo_derivatives.py
+python
+# band/management/commands/build_photo_derivatives.py
+from django.core.management.base import BaseCommand
+from band import images
+from band.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail/medium/full WebP and JPEG derivatives for photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild photos that already have derivatives')
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.all() if options['all'] else Photo.objects.filter(thumbnail_path='')
+        futures = {photo.pk: images.queue_derivatives(photo.pk) for photo in photos.only('pk')}
+
+        built = failed = 0
+        for photo_id, future in futures.items():
+            try:
+                future.result()
+                built += 1
+            except Exception as exc:
+                failed += 1
+                self.stderr.write(f"photo {photo_id}: {exc}")
+        self.stdout.write(f"Built derivatives for {built} photos ({failed} failed)")
+
+        # What a visitor downloads per photo on the gallery page, before and after
+        original = thumbnail = 0
+        for photo in Photo.objects.exclude(thumbnail_path=''):
+            original += photo.image.storage.size(photo.image.name)
+            thumbnail += photo.image.storage.size(images.webp_path(photo.thumbnail_path))
+        if thumbnail:
+            self.stdout.write(f"Gallery bytes: {original} originals vs {thumbnail} WebP thumbnails "
+                              f"({original / thumbnail:.1f}x smaller)")
+run_workers.py
+python
+# band/management/commands/run_workers.py
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from band.jobs import Worker
+from band.tasks import schedule_hold_release
+
+
+def _work(once):
+    Worker().run(once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run background job workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=getattr(settings, 'JOB_WORKERS', 2))
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        # Expired ticket holds are swept by a job that re-queues itself
+        schedule_hold_release()
+        if options['processes'] <= 1:
+            processed = Worker().run(once=options['once'])
+            self.stdout.write(f"Processed {processed} jobs")
+            return
+
+        # Children must not share the parent's database connection
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=_work, args=(options['once'],)) for _ in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} workers")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+bench_servers.py
+python
+# band/management/commands/bench_servers.py
+import shlex
+import socket
+import subprocess
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from band.loadgen import run_load
+
+SERVERS = {
+    'wsgi': 'gunicorn band_website.wsgi:application --workers {workers} --worker-class gthread '
+            '--threads 32 --keep-alive 30 --bind 127.0.0.1:{port}',
+    'asgi': 'uvicorn band_website.asgi:application --workers {workers} --timeout-keep-alive 30 '
+            '--port {port} --no-access-log',
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare WSGI (gunicorn) and ASGI (uvicorn) throughput under many keep-alive clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500)
+        parser.add_argument('--duration', type=float, default=15.0)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--paths', default='/songs/,/photos/,/concerts/,/api/songs/')
+        parser.add_argument('--only', choices=sorted(SERVERS))
+
+    def handle(self, *args, **options):
+        paths = options['paths'].split(',')
+        results = {}
+        for name, command in SERVERS.items():
+            if options['only'] and name != options['only']:
+                continue
+            argv = shlex.split(command.format(workers=options['workers'], port=options['port']))
+            try:
+                server = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except FileNotFoundError:
+                raise CommandError(f"{argv[0]} is not installed; pip install {argv[0]}")
+            try:
+                self._wait_for_port(options['port'])
+                run_load(f"http://127.0.0.1:{options['port']}", paths, clients=10, duration=2)  # warm up
+                results[name] = run_load(f"http://127.0.0.1:{options['port']}", paths,
+                                         clients=options['clients'], duration=options['duration'])
+            finally:
+                server.terminate()
+                server.wait()
+
+        self.stdout.write(f"{options['clients']} keep-alive clients, {options['duration']:.0f}s, paths {paths}")
+        self.stdout.write(f"{'server':8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}  statuses")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:8}{result['throughput']:>10.1f}{result['p50']:>10.1f}{result['p95']:>10.1f}"
+                f"{result['p99']:>10.1f}{result['errors']:>8}  {result['statuses']}"
+            )
+
+    def _wait_for_port(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f"Server did not start listening on port {port}")
+rebuild_search_index.py
+python
+# band/management/commands/rebuild_search_index.py
+from django.core.management.base import BaseCommand
+from band import search
+
+
+class Command(BaseCommand):
+    help = 'Create the song full-text index and triggers, and rebuild it from band_song'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        search.install(using=options['database'], rebuild=True)
+        self.stdout.write('Song search index rebuilt')
+bench_search.py
+python
+# band/management/commands/bench_search.py
+import itertools
+import random
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from band import search
+from band.models import Song
+
+SYLLABLES = 'la mo ri ka ne so tu vi den ras mel cor fin gal hor lun'.split()
+# ~4k made-up words; drawn with Zipf-like weights so a few are everywhere and most are rare
+WORDS = [''.join(parts) for parts in itertools.product(SYLLABLES, repeat=3)]
+WEIGHTS = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+
+class Command(BaseCommand):
+    help = 'Compare FTS5 search against LIKE on a synthetic catalog (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=50)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        # Selective words, as people search for lines they remember; the last one still being typed
+        queries = [f"{rng.choice(WORDS[200:2000])} {rng.choice(WORDS[200:2000])[:-1]}" for _ in range(options['queries'])]
+
+        with transaction.atomic():
+            search.install()
+            started = time.perf_counter()
+            batch = []
+            for i in range(options['songs']):
+                batch.append(Song(
+                    title=' '.join(rng.choices(WORDS, WEIGHTS, k=3)).title(),
+                    duration=rng.randint(120, 420),
+                    release_date=date(1990, 1, 1) + timedelta(days=rng.randint(0, 12000)),
+                    lyrics=' '.join(rng.choices(WORDS, WEIGHTS, k=120)),
+                ))
+                if len(batch) == 5000:
+                    Song.objects.bulk_create(batch)
+                    batch = []
+            Song.objects.bulk_create(batch)
+            self.stdout.write(f"Seeded {options['songs']} songs in {time.perf_counter() - started:.1f}s")
+
+            fts = self._time(lambda q: search.search_songs(q), queries)
+            like = self._time(self._like, queries)
+            self.stdout.write(f"FTS5 ranked + snippets: {fts * 1000:8.2f} ms/query")
+            self.stdout.write(f"LIKE '%word%':          {like * 1000:8.2f} ms/query")
+            self.stdout.write(f"Speed-up: {like / fts:.1f}x")
+            transaction.set_rollback(True)
+
+    def _like(self, query):
+        # What the page would do without an index: scan everything, newest first
+        words = query.split()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, title FROM band_song WHERE "
+                + ' AND '.join(["(title LIKE %s OR lyrics LIKE %s)"] * len(words))
+                + " ORDER BY release_date DESC LIMIT 21",
+                [f'%{word}%' for word in words for _ in range(2)],
+            )
+            return cursor.fetchall()
+
+    def _time(self, fn, queries):
+        started = time.perf_counter()
+        for query in queries:
+            fn(query)
+        return (time.perf_counter() - started) / len(queries)
+
+bench_templates.py
+python
+# band/management/commands/bench_templates.py
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.template import Engine, RequestContext, engines
+from django.test import RequestFactory
+from band import views
+
+
+class Command(BaseCommand):
+    help = 'Time the render of each page with and without cached loaders and fragment caching'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--renders', type=int, default=200)
+
+    def handle(self, *args, **options):
+        configured = engines['django'].engine
+        loaders = getattr(settings, 'TEMPLATE_LOADERS', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ])
+
+        def engine(cached):
+            return Engine(
+                dirs=configured.dirs,
+                context_processors=configured.context_processors,
+                loaders=[('django.template.loaders.cached.Loader', loaders)] if cached else loaders,
+                libraries=configured.libraries,
+            )
+
+        catalog = views._concert_catalog()
+        pages = {
+            'home': ('band/home.html', {}),
+            'songs': ('band/songs.html', {'songs': views._song_page(None)[0]}),
+            'photos': ('band/photos.html', {'photos': views._photo_page(None)[0]}),
+            'concerts': ('band/concerts.html', {'concerts': views._with_attendance(catalog, {})}),
+            'login': ('band/login.html', {}),
+            'register': ('band/register.html', {}),
         }
-        
-        function processPayment(paymentData) {
-            const paymentToken = paymentData.paymentMethodData.tokenizationData.token;
-            
-            fetch(window.location.href, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                    'X-CSRFToken': '{{ csrf_token }}'
+        modes = [
+            ('reparsed', engine(cached=False), False),
+            ('cached loader', engine(cached=True), False),
+            ('+ fragments', engine(cached=True), True),
+        ]
+
+        self.stdout.write(f"{'page':<10}" + ''.join(f"{label:>16}" for label, _, _ in modes) + '   (ms/render)')
+        for page, (template_name, context) in pages.items():
+            results = [self._time(template_name, context, eng, warm, options['renders']) for _, eng, warm in modes]
+            self.stdout.write(f"{page:<10}" + ''.join(f"{result * 1000:16.3f}" for result in results))
+
+    def _time(self, template_name, context, engine, warm_fragments, renders):
+        fragments = caches['fragments']
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        engine.get_template(template_name).render(RequestContext(request, context))
+
+        elapsed = 0.0
+        for _ in range(renders):
+            if not warm_fragments:
+                fragments.clear()
+            started = time.perf_counter()
+            engine.get_template(template_name).render(RequestContext(request, context))
+            elapsed += time.perf_counter() - started
+        fragments.clear()
+        return elapsed / renders
+bench_page_bytes.py
+python
+# band/management/commands/bench_page_bytes.py
+import gzip
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from band import assets
+
+PAGES = ['/', '/songs/', '/photos/', '/concerts/', '/search/', '/login/']
+
+
+class Command(BaseCommand):
+    help = 'Bytes per page view with inline CSS/JS versus external, cached, compressed assets'
+
+    def handle(self, *args, **options):
+        # localhost is allowed by DEBUG's default ALLOWED_HOSTS
+        client = Client(HTTP_HOST='localhost')
+        pattern = re.compile(r'(?:href|src)="%s([^"]+)"' % re.escape(settings.STATIC_URL))
+        self.stdout.write(f"{'page':<12}{'inline':>10}{'first view':>12}{'repeat view':>13}")
+        for url in PAGES:
+            response = client.get(url)
+            if response.status_code != 200:
+                raise CommandError(f"{url} returned {response.status_code}")
+            html = response.content
+            raw = wire = 0
+            for name in set(pattern.findall(html.decode())):
+                content, compressed = self._sizes(name)
+                raw += content
+                wire += compressed
+            # inline: every view carries the assets uncompressed inside the HTML
+            self.stdout.write(f"{url:<12}{len(html) + raw:>10}{len(html) + wire:>12}{len(html):>13}")
+
+    def _sizes(self, name):
+        if settings.STATIC_ROOT and os.path.isfile(os.path.join(settings.STATIC_ROOT, name)):
+            path = staticfiles_storage.path(name)
+        else:
+            path = finders.find(name)
+        with open(path, 'rb') as f:
+            content = f.read()
+        extension = os.path.splitext(name)[1]
+        minified = content
+        if extension in assets.MINIFIERS and name.startswith('band/'):
+            minified = assets.MINIFIERS[extension](content.decode()).encode()
+        compressed = gzip.compress(minified, 9)
+        if assets.brotli is not None:
+            compressed = min(compressed, assets.brotli.compress(minified, quality=11), key=len)
+        return len(content), len(compressed)
+bulk_import.py
+python
+# band/management/commands/bulk_import.py
+from django.core.management.base import BaseCommand
+from band import bulk
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSON Lines file into songs, photos, concerts or attendances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(bulk.MODELS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved progress and start over')
+        parser.add_argument('--skip-existing', action='store_true', help='Skip rows whose id or unique key exists')
+
+    def handle(self, *args, **options):
+        progress = bulk.import_progress(options['path'])
+        if progress and not options['restart']:
+            self.stdout.write(f"Resuming after row {progress['rows']}")
+
+        rows, seconds = bulk.import_rows(
+            options['model'], options['path'], options['format'], options['batch_size'],
+            resume=not options['restart'], ignore_conflicts=options['skip_existing'],
+            report=lambda total, rate: self.stdout.write(f"  {total} rows ({rate:,.0f} rows/s)"),
+        )
+        # With --skip-existing the database does not say how many rows it skipped
+        verb = 'Processed' if options['skip_existing'] else 'Imported'
+        self.stdout.write(f"{verb} {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):,.0f} rows/s)")
+        if options['model'] == 'photo':
+            self.stdout.write('Run build_photo_derivatives to create thumbnails for imported photos')
+bulk_export.py
+python
+# band/management/commands/bulk_export.py
+from django.core.management.base import BaseCommand
+from band import bulk
+
+
+class Command(BaseCommand):
+    help = 'Stream songs, photos, concerts or attendances out to CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(bulk.MODELS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved progress and start over')
+
+    def handle(self, *args, **options):
+        rows, seconds = bulk.export_rows(
+            options['model'], options['path'], options['format'], options['batch_size'],
+            resume=not options['restart'],
+            report=lambda total, rate: self.stdout.write(f"  {total} rows ({rate:,.0f} rows/s)"),
+        )
+        self.stdout.write(f"Exported {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):,.0f} rows/s)")
+bench_routes.py
+python
+# band/management/commands/bench_routes.py
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from band import benchmark, ratelimit
+
+SCENARIOS = ('routes', 'mix', 'login', 'onsale')
+
+
+class Command(BaseCommand):
+    help = 'Drive every route with synthetic data; report latency percentiles, throughput and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='Add the synthetic dataset first')
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--songs', type=int, default=5000)
+        parser.add_argument('--photos', type=int, default=1000)
+        parser.add_argument('--concerts', type=int, default=20)
+        parser.add_argument('--attendances', type=int, default=2000)
+        parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+        parser.add_argument('--requests', type=int, default=100, help='Per route in the routes scenario')
+        parser.add_argument('--mix-requests', type=int, default=2000)
+        parser.add_argument('--login-requests', type=int, default=300)
+        parser.add_argument('--buyers', type=int, default=150, help='On-sale buyers, at most --users')
+        parser.add_argument('--onsale-tickets', type=int, default=100)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--out', default='benchmarks', help='Directory results are saved to')
+        parser.add_argument('--no-save', action='store_true')
+        parser.add_argument('--compare', metavar='FILE', help="Earlier result file, or 'latest'")
+        parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed p95/throughput drift')
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Leave band.ratelimit on; every virtual user comes from one IP')
+
+    def handle(self, *args, **options):
+        if settings.DEBUG:
+            self.stderr.write('DEBUG is on: numbers include debug overhead and connection.queries logging')
+        if options['seed']:
+            benchmark.seed(options['users'], options['songs'], options['photos'], options['concerts'],
+                           options['attendances'], log=self.stdout.write)
+        try:
+            ctx = benchmark.Context()
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        # Failures are counted in the report; a traceback per 409 or 500 would bury it
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        if not options['rate_limits']:
+            ratelimit.ENABLED = False
+
+        scenarios = SCENARIOS if options['scenario'] == 'all' else (options['scenario'],)
+        results = {}
+        for scenario in scenarios:
+            if scenario == 'routes':
+                report = {}
+                for route in benchmark.ROUTES:
+                    report.update(benchmark.run({route: 1}, options['requests'], options['threads'], ctx))
+                    report.pop('ALL')
+            elif scenario == 'mix':
+                report = benchmark.run(benchmark.MIX, options['mix_requests'], options['threads'], ctx)
+            elif scenario == 'login':
+                report = benchmark.login_rush(ctx, options['login_requests'], options['threads'])
+            else:
+                report = benchmark.onsale(ctx, options['buyers'], options['onsale_tickets'], options['threads'])
+            results[scenario] = report
+            self._print(scenario, report)
+
+        saved = None
+        if not options['no_save']:
+            saved = self._save(results, options)
+            self.stdout.write(f"\nSaved {saved}")
+        if options['compare']:
+            regressions = self._compare(results, self._baseline(options['compare'], options['out'], saved),
+                                        options['tolerance'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{regressions} regressions")
+
+    def _print(self, scenario, report):
+        self.stdout.write(f"\n{scenario}")
+        self.stdout.write(f"{'route':20}{'reqs':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+                          f"{'queries':>9}{'errors':>8}  statuses")
+        for route, row in report.items():
+            self.stdout.write(
+                f"{route:20}{row['requests']:>7}{row['throughput']:>9.1f}{row['p50']:>9.2f}{row['p95']:>9.2f}"
+                f"{row['p99']:>9.2f}{row['queries']:>9.1f}{row['errors']:>8}  {row['statuses']}"
+            )
+        if 'sold' in report.get('ALL', {}):
+            row = report['ALL']
+            self.stdout.write(f"{row['buyers']} buyers ({row['queued']} queued), {row['tickets']} tickets: "
+                              f"{row['sold']} sold, {row['oversold']} oversold")
+        if 'hasher' in report.get('ALL', {}):
+            row = report['ALL']
+            self.stdout.write(f"{row['hasher']} {row['cost']} on {row['hashing_workers']} hashing workers")
+
+    def _save(self, results, options):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                    text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = 'unknown'
+        created = timezone.now()
+        os.makedirs(options['out'], exist_ok=True)
+        path = os.path.join(options['out'], f"{created:%Y%m%d-%H%M%S}-{commit}.json")
+        with open(path, 'w') as f:
+            json.dump({
+                'commit': commit,
+                'created': created.isoformat(),
+                'options': {key: value for key, value in options.items()
+                            if key not in ('stdout', 'stderr', 'skip_checks', 'traceback', 'no_color',
+                                           'force_color', 'settings', 'pythonpath', 'verbosity')},
+                'environment': {
+                    'python': sys.version.split()[0],
+                    'django': django.get_version(),
+                    'platform': platform.platform(),
+                    'database': connection.vendor,
+                    'debug': settings.DEBUG,
                 },
-                body: `payment_token=${encodeURIComponent(paymentToken)}`
-            }).then(response => {
-                if (response.ok) {
-                    window.location.href = "{% url 'concerts' %}";
-                } else {
-                    alert('Payment processing failed');
-                }
-            }).catch(error => {
-                console.error('Error:', error);
-                alert('Payment processing failed');
-            });
+                'results': results,
+            }, f, indent=2)
+        return path
+
+    def _baseline(self, compare, out, saved):
+        if compare != 'latest':
+            return compare
+        earlier = sorted(path for path in glob.glob(os.path.join(out, '*.json')) if path != saved)
+        if not earlier:
+            raise CommandError(f"No earlier results in {out}")
+        return earlier[-1]
+
+    def _compare(self, results, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)
+        self.stdout.write(f"\nAgainst {path} ({baseline['commit']})")
+        self.stdout.write(f"{'scenario/route':32}{'p95 ms':>18}{'req/s':>18}{'queries':>14}")
+        regressions = 0
+        for scenario, report in results.items():
+            for route, row in report.items():
+                old = baseline['results'].get(scenario, {}).get(route)
+                if not old:
+                    continue
+                slower = row['p95'] > old['p95'] * (1 + tolerance)
+                fewer = row['throughput'] < old['throughput'] * (1 - tolerance)
+                more_queries = row['queries'] > old['queries'] + 0.5
+                flag = '  REGRESSION' if slower or fewer or more_queries else ''
+                regressions += bool(flag)
+                self.stdout.write(
+                    f"{scenario + '/' + route:32}{old['p95']:>8.2f} ->{row['p95']:>7.2f}"
+                    f"{old['throughput']:>8.1f} ->{row['throughput']:>7.1f}"
+                    f"{old['queries']:>5.1f} ->{row['queries']:>5.1f}{flag}"
+                )
+        return regressions
+bench_events.py
+python
+# band/management/commands/bench_events.py
+import asyncio
+import re
+import resource
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from band import events
+
+# Published values start here so they can't be mistaken for a real ticket count
+MARKER = 10 ** 9
+AVAILABLE = re.compile(rb'"available_tickets": (\d+)')
+
+
+class Command(BaseCommand):
+    help = 'Open many idle /concerts/events/ streams in this process and time the fan-out of each change'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=10000)
+        parser.add_argument('--events', type=int, default=20, help='Changes to publish, one at a time')
+        parser.add_argument('--timeout', type=float, default=300.0, help='Seconds to wait for each step')
+
+    def handle(self, *args, **options):
+        if not settings.BAND_ASYNC_VIEWS:
+            raise CommandError('Run with BAND_ASYNC_VIEWS=1; /concerts/events/ is only routed under ASGI')
+        if options['subscribers'] > getattr(settings, 'EVENTS_MAX_SUBSCRIBERS', 10000):
+            raise CommandError('--subscribers is above EVENTS_MAX_SUBSCRIBERS')
+        asyncio.run(self._run(options['subscribers'], options['events'], options['timeout']))
+
+    async def _run(self, subscribers, rounds, timeout):
+        app = ASGIHandler()
+        hang_up = asyncio.Event()
+        connected = asyncio.Event()
+        received = [0] * rounds
+        delivered = [asyncio.Event() for _ in range(rounds)]
+        arrivals = [[] for _ in range(rounds)]
+        counts = {'open': 0, 'failed': 0}
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': '/concerts/events/', 'raw_path': b'/concerts/events/',
+            'query_string': b'', 'root_path': '', 'headers': [(b'host', b'localhost')],
+            'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
         }
-        
-        window.onGooglePayLoaded = onGooglePayLoaded;
-    </script>
-    <script async src="https://pay.google.com/gp/p/js/pay.js" onload="onGooglePayLoaded()"></script>
-{% endblock %}
-payment_success.html
-html
-Run
-{% extends 'band/base.html' %}
 
-{% block title %}Payment Successful - Our Awesome Band{% endblock %}
+        async def connection():
+            state = {'sent': False, 'open': False}
 
-{% block content %}
-    <h2>Payment Successful!</h2>
-    <p>Thank you for purchasing tickets to {{ concert.name }}.</p>
-    <p>Your payment has been processed successfully.</p>
-    <p><a href="{% url 'concerts' %}">Back to concerts</a></p>
-{% endblock %}
-Admin Setup
+            async def receive():
+                if not state['sent']:
+                    state['sent'] = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await hang_up.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    if message['status'] != 200:
+                        counts['failed'] += 1
+                    return
+                if not state['open']:
+                    # The first chunk is the snapshot of every concert
+                    state['open'] = True
+                    counts['open'] += 1
+                    if counts['open'] + counts['failed'] == subscribers:
+                        connected.set()
+                    return
+                now = time.perf_counter()
+                for value in AVAILABLE.findall(message.get('body', b'')):
+                    number = int(value) - MARKER
+                    if 0 <= number < rounds:
+                        received[number] += 1
+                        arrivals[number].append(now)
+                        if received[number] == subscribers:
+                            delivered[number].set()
+
+            await app(dict(scope), receive, send)
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(connection()) for _ in range(subscribers)]
+        await asyncio.wait_for(connected.wait(), timeout)
+        connect_seconds = time.perf_counter() - started
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if counts['failed']:
+            raise CommandError(f"{counts['failed']} streams were refused")
+        self.stdout.write(
+            f"{subscribers} streams open in {connect_seconds:.2f}s, {events.broker.subscribers()} subscribed, "
+            f"~{(rss_after - rss_before) / subscribers:.1f} KB peak RSS each")
+
+        fanout, first = [], []
+        for number in range(rounds):
+            published = time.perf_counter()
+            # Publish from another thread, like the ticket writer does
+            threading.Thread(target=events.broker.publish,
+                             args=(events.AVAILABILITY, 0, MARKER + number)).start()
+            await asyncio.wait_for(delivered[number].wait(), timeout)
+            fanout.append((max(arrivals[number]) - published) * 1000)
+            first.append((min(arrivals[number]) - published) * 1000)
+
+        hang_up.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        # Subscriptions close as the cancelled streams unwind
+        await asyncio.sleep(0)
+        self.stdout.write(
+            f"{rounds} changes, each delivered to all {subscribers}: first arrival p50 "
+            f"{statistics.median(first):.1f} ms; last arrival p50 {statistics.median(fanout):.1f} ms, "
+            f"max {max(fanout):.1f} ms")
+        self.stdout.write(f"{events.broker.subscribers()} subscriptions left after hang-up")
+bench_sessions.py
 python
-# band/admin.py
-from django.contrib import admin
-from .models import Song, Photo, Concert, UserConcert
+# band/management/commands/bench_sessions.py
+import time
+from importlib import import_module
 
-admin.site.register(Song)
-admin.site.register(Photo)
-admin.site.register(Concert)
-admin.site.register(UserConcert)
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from band import benchmark
+from band.loadgen import percentile
+
+ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'band.sessions.cached_db',
+    'shared': 'band.sessions.shared',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+
+class Command(BaseCommand):
+    help = 'Signed-in requests under each SESSION_ENGINE: latency, session queries and writes per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+        parser.add_argument('--users', type=int, default=50, help='Signed-in clients, taken in turn')
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--path', default='/concerts/')
+
+    def handle(self, *args, **options):
+        users = list(User.objects.filter(username__startswith='bench-user-')[:options['users']])
+        if not users:
+            raise CommandError('No bench users; run bench_routes --seed first')
+        self.stdout.write(f"{len(users)} users, {options['requests']} x GET {options['path']} "
+                          f"(SESSION_ENGINE is {settings.SESSION_ENGINE})")
+        self.stdout.write(f"{'engine':16}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'queries':>9}"
+                          f"{'session q':>11}{'writes':>8}{'resave writes':>15}")
+        for name in options['engines']:
+            with override_settings(SESSION_ENGINE=ENGINES[name]):
+                row = self._measure(users, options['requests'], options['path'])
+            self.stdout.write(
+                f"{name:16}{row['throughput']:>9.1f}{row['p50']:>9.2f}{row['p95']:>9.2f}{row['queries']:>9.2f}"
+                f"{row['session_queries']:>11.2f}{row['writes']:>8.2f}{row['resave_writes']:>15}")
+
+    def _measure(self, users, requests, path):
+        clients = []
+        for user in users:
+            client = Client(HTTP_HOST=benchmark._host())
+            client.force_login(user)
+            client.get(path)  # first read fills any session cache
+            clients.append(client)
+
+        counts = {'queries': 0, 'session': 0, 'writes': 0}
+
+        def count(execute, sql, params, many, context):
+            counts['queries'] += 1
+            if 'django_session' in sql:
+                counts['session'] += 1
+                counts['writes'] += not sql.lstrip().upper().startswith('SELECT')
+            return execute(sql, params, many, context)
+
+        latencies = []
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            for i in range(requests):
+                began = time.perf_counter()
+                response = clients[i % len(clients)].get(path)
+                latencies.append(time.perf_counter() - began)
+                if response.status_code != 200:
+                    raise CommandError(f"GET {path} answered {response.status_code}")
+            elapsed = time.perf_counter() - started
+            row = {'requests': requests, 'throughput': requests / elapsed,
+                   'queries': counts['queries'] / requests, 'session_queries': counts['session'] / requests,
+                   'writes': counts['writes'] / requests}
+
+            # What a view that re-sets a key to the value it already has costs
+            store = import_module(settings.SESSION_ENGINE).SessionStore
+            counts['writes'] = 0
+            for client in clients:
+                session = store(client.cookies[settings.SESSION_COOKIE_NAME].value)
+                session['_auth_user_id'] = session['_auth_user_id']
+                session.save()
+            row['resave_writes'] = counts['writes']
+
+        latencies.sort()
+        row.update(p50=percentile(latencies, 50) * 1000, p95=percentile(latencies, 95) * 1000)
+        return row
+reconcile_concert_stats.py
+python
+# band/management/commands/reconcile_concert_stats.py
+from django.core.management.base import BaseCommand, CommandError
+from band import stats
+
+
+class Command(BaseCommand):
+    help = 'Recount band_concertstats from band_userconcert in one pass, reinstalling the triggers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--check', action='store_true', help='Only report drift; exit non-zero if any')
 
+    def handle(self, *args, **options):
+        if options['check']:
+            drifted = stats.rebuild(using=options['database'], dry_run=True)
+        else:
+            drifted = stats.install(using=options['database'])
+        columns = ', '.join(stats.COUNTS)
+        for concert_id, stored, recounted in drifted:
+            self.stdout.write(f"concert {concert_id} ({columns}): {stored} -> {recounted}")
+        if options['check'] and drifted:
+            raise CommandError(f"{len(drifted)} concerts have drifted")
+        self.stdout.write(f"{len(drifted)} concerts {'drifted' if options['check'] else 'corrected'}")